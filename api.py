@@ -0,0 +1,378 @@
+"""Read-mostly JSON API over the catalog for kiosks and signage screens
+
+Serves filtered book pages, genres and collection statistics, and accepts
+book suggestions, from the same database as the Streamlit app:
+
+    GET  /books?genre=&age_group=&q=&available=1&fuzzy=1&limit=30&cursor=
+    GET  /genres
+    GET  /stats
+    POST /suggestions   {"title", "author", "genre", "age_group", "description", "cover_url"}
+
+GET responses carry a weak ETag built from the catalog version, so a client
+that sends it back in If-None-Match gets an empty 304 until books change.
+Bodies are gzipped for clients that accept it, encoded responses are kept
+per catalog version, and connections are kept alive between requests. Run
+with:
+
+    python api.py --port 8502 --db library.db
+"""
+import argparse
+import base64
+import binascii
+import gzip
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import database
+from instrumentation import timer
+
+# Largest page of books a client may ask for
+MAX_PAGE_SIZE = 100
+
+# Bodies shorter than this are sent uncompressed; gzip would barely help
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+
+# Encoded GET responses kept, each valid for one catalog version
+RESPONSE_CACHE_SIZE = 512
+
+# Idle keep-alive connections are closed after this many seconds
+KEEPALIVE_SECONDS = 15
+
+# Largest suggestion body accepted
+MAX_BODY_BYTES = 16 * 1024
+
+# Longest accepted value for each suggestion field, as in the app's form
+SUGGESTION_FIELD_LENGTHS = {
+    'title': 100,
+    'author': 100,
+    'genre': 100,
+    'age_group': 20,
+    'description': 500,
+    'cover_url': 2000,
+}
+
+response_cache = database.QueryCache(RESPONSE_CACHE_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+class RequestError(Exception):
+    """A client error, answered with its HTTP status and message"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def encode_cursor(cursor):
+    """Turn a page cursor tuple into an opaque URL-safe string"""
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode().rstrip("=")
+
+
+def decode_cursor(text, search_query=None):
+    """Reverse encode_cursor(); raises RequestError for anything it did not produce
+
+    A search page is keyed on three values and a plain listing on two, so
+    the cursor must be the one for the query it is sent with.
+    """
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(text + "=" * (-len(text) % 4)))
+    except (ValueError, binascii.Error):
+        raise RequestError(400, "invalid cursor") from None
+    size = 3 if database.build_search_expression(search_query) else 2
+    if (not isinstance(cursor, list) or len(cursor) != size
+            or not all(isinstance(value, (int, float)) for value in cursor)):
+        raise RequestError(400, "invalid cursor")
+    return tuple(cursor)
+
+
+def _param(params, name):
+    values = params.get(name)
+    if not values:
+        return None
+    return values[-1].strip() or None
+
+
+def _flag(params, name):
+    return _param(params, name) in ("1", "true", "yes")
+
+
+def get_books(params):
+    """One page of books matching the query string filters
+
+    Plain listings and searches are paged with an opaque cursor; a fuzzy
+    search returns its best matches in one page. Each book says whether a
+    copy is on the shelf.
+    """
+    genre = _param(params, 'genre')
+    age_group = _param(params, 'age_group')
+    search_query = _param(params, 'q')
+    available_only = _flag(params, 'available')
+    if age_group is not None and age_group not in database.AGE_GROUPS:
+        raise RequestError(400, f"age_group must be one of {', '.join(database.AGE_GROUPS)}")
+    try:
+        limit = int(_param(params, 'limit') or database.PAGE_SIZE)
+    except ValueError:
+        raise RequestError(400, "limit must be a number") from None
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise RequestError(400, f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+    if _flag(params, 'fuzzy') and search_query:
+        books = database.get_books_fuzzy(search_query, genre, age_group, limit=limit,
+                                         available_only=available_only)
+        next_cursor = None
+        total = len(books)
+    else:
+        cursor = _param(params, 'cursor')
+        books, next_cursor = database.get_books_page(
+            genre, age_group, search_query, decode_cursor(cursor, search_query) if cursor else None, limit,
+            available_only
+        )
+        total = database.count_books(genre, age_group, search_query, available_only)
+
+    availability = database.get_availability(book['id'] for book in books)
+    return {
+        'books': [
+            {**book, 'available': book['id'] in availability
+             and availability[book['id']]['copies_available'] > 0}
+            for book in books
+        ],
+        'total': total,
+        'next_cursor': encode_cursor(next_cursor),
+    }
+
+
+def get_genres(params):
+    """Every genre in the catalog"""
+    return {'genres': database.get_all_genres()}
+
+
+def get_stats(params):
+    """The collection overview shown in the app's sidebar"""
+    stats = database.get_collection_stats()
+    return {**stats, 'genre_counts': [{'genre': genre, 'books': count}
+                                      for genre, count in stats['genre_counts']]}
+
+
+GET_ROUTES = {
+    '/books': get_books,
+    '/genres': get_genres,
+    '/stats': get_stats,
+}
+
+
+def validate_suggestion(body):
+    """Return the suggestion fields from a decoded JSON body, or raise RequestError"""
+    if not isinstance(body, dict):
+        raise RequestError(400, "expected a JSON object")
+    fields = {}
+    for field, max_length in SUGGESTION_FIELD_LENGTHS.items():
+        value = body.get(field)
+        if value is not None and not isinstance(value, str):
+            raise RequestError(400, f"{field} must be a string")
+        value = (value or "").strip()
+        if len(value) > max_length:
+            raise RequestError(400, f"{field} longer than {max_length} characters")
+        fields[field] = value
+
+    missing = [field for field in ('title', 'author', 'genre', 'age_group') if not fields[field]]
+    if missing:
+        raise RequestError(400, f"missing {', '.join(missing)}")
+    if fields['age_group'] not in database.AGE_GROUPS:
+        raise RequestError(400, f"age_group must be one of {', '.join(database.AGE_GROUPS)}")
+    if fields['cover_url'] and not fields['cover_url'].startswith(('http://', 'https://')):
+        raise RequestError(400, "cover_url must be an http(s) URL")
+    return fields
+
+
+def accepts_gzip(accept_encoding):
+    """Whether an Accept-Encoding header allows gzip"""
+    for coding in accept_encoding.split(","):
+        name, _, parameters = coding.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            quality = parameters.strip().removeprefix("q=") or "1"
+            try:
+                return float(quality) > 0
+            except ValueError:
+                return False
+    return False
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header names ``etag``, compared weakly"""
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in tags)
+
+
+def encode_json(payload, use_gzip):
+    """Return ``(body, content_encoding)`` for a payload"""
+    body = json.dumps(payload, separators=(",", ":"), default=str).encode()
+    if use_gzip and len(body) >= GZIP_MIN_BYTES:
+        return gzip.compress(body, GZIP_LEVEL, mtime=0), "gzip"
+    return body, None
+
+
+class CatalogRequestHandler(BaseHTTPRequestHandler):
+    """Answers the catalog API; HTTP/1.1, so connections are kept alive"""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "LibraryAPI/1.0"
+    timeout = KEEPALIVE_SECONDS
+    # Headers and body are separate writes; with Nagle's algorithm on, the
+    # body waits for the client's delayed ACK, about 40 ms per kept-alive
+    # request
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = GET_ROUTES.get(url.path)
+        if route is None:
+            self.send_error_json(url.path)
+            return
+
+        # Read the version before the data, so a body can only ever be
+        # newer than its ETag and a stale page is never confirmed with 304
+        version = database.get_catalog_version()
+        etag = f'W/"{version}"'
+        if etag_matches(self.headers.get("If-None-Match", ""), etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+
+        use_gzip = accepts_gzip(self.headers.get("Accept-Encoding", ""))
+        key = (url.path, url.query, use_gzip)
+        found, response = response_cache.get(key, version)
+        if not found:
+            try:
+                with timer(f"api.{route.__name__}"):
+                    payload = route(parse_qs(url.query))
+            except RequestError as e:
+                self.send_json(e.status, {'error': str(e)})
+                return
+            except Exception:  # Answer rather than drop the connection
+                self.send_server_error()
+                return
+            response = encode_json(payload, use_gzip)
+            response_cache.put(key, version, response)
+        self.send_body(200, *response, etag=etag)
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        if path != "/suggestions":
+            # Any body is left unread, so this connection cannot be reused
+            self.close_connection = True
+            self.send_error_json(path)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self.close_connection = True
+            self.send_json(411, {'error': "Content-Length required"})
+            return
+        if length < 0:
+            self.close_connection = True
+            self.send_json(400, {'error': "Content-Length must not be negative"})
+            return
+        if length > MAX_BODY_BYTES:
+            # The body is left unread, so this connection cannot be reused
+            self.close_connection = True
+            self.send_json(413, {'error': f"body larger than {MAX_BODY_BYTES} bytes"})
+            return
+
+        try:
+            try:
+                body = json.loads(self.rfile.read(length))
+            except ValueError:
+                raise RequestError(400, "body is not valid JSON") from None
+            fields = validate_suggestion(body)
+        except RequestError as e:
+            self.send_json(e.status, {'error': str(e)})
+            return
+        try:
+            with timer("api.add_book_suggestion"):
+                result = database.add_book_suggestion(
+                    fields['title'], fields['author'], fields['genre'], fields['age_group'],
+                    fields['description'], fields['cover_url']
+                )
+        except Exception:  # Answer rather than drop the connection
+            self.send_server_error()
+            return
+        self.send_json(201 if result['status'] == 'added' else 200, result)
+
+    def send_error_json(self, path):
+        """Answer a request for a path this method does not serve"""
+        if path in GET_ROUTES or path == "/suggestions":
+            self.send_json(405, {'error': f"{self.command} is not allowed on {path}"})
+        else:
+            self.send_json(404, {'error': f"no such resource {path}"})
+
+    def send_server_error(self):
+        """Log the exception being handled and answer with a 500"""
+        logger.exception("API error on %s %s", self.command, self.path)
+        self.send_json(500, {'error': "internal error"})
+
+    def send_json(self, status, payload):
+        """Send a payload that is not cached, gzipped if the client accepts it"""
+        use_gzip = accepts_gzip(self.headers.get("Accept-Encoding", ""))
+        self.send_body(status, *encode_json(payload, use_gzip))
+
+    def send_body(self, status, body, content_encoding, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        if content_encoding:
+            self.send_header("Content-Encoding", content_encoding)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Only errors are logged; a kiosk polling every few seconds would
+        # otherwise fill the console with one line per request
+        pass
+
+    def log_error(self, format, *args):
+        message = format % args
+        if not message.startswith("Request timed out"):  # An idle keep-alive connection
+            logger.warning("API %s: %s", self.address_string(), message)
+
+
+def make_server(host="127.0.0.1", port=8502):
+    """Create the threaded API server; call serve_forever() on it to run it"""
+    database.initialize_database()
+    server = ThreadingHTTPServer((host, port), CatalogRequestHandler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--db", default=database.DB_FILE, help="database file to serve")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    database.DB_FILE = args.db
+    server = make_server(args.host, args.port)
+    print(f"Serving the catalog API on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,45 @@
+import hmac
+import json
+import os
 import streamlit as st
 import pandas as pd
 import plotly.express as px
+import instrumentation
 from database import (
     initialize_database,
-    get_all_books,
-    get_books_by_filter,
+    get_books_page,
+    get_books_fuzzy,
+    count_books,
     add_book_suggestion,
-    get_all_genres
+    get_suggestions,
+    count_suggestions,
+    approve_suggestions,
+    reject_suggestions,
+    get_all_genres,
+    get_collection_stats,
+    get_visit_availability,
+    book_visit,
+    get_availability,
+    checkout_book,
+    return_book,
+    place_hold,
+    cancel_hold,
+    get_patron_circulation,
+    PAGE_SIZE,
+    VISIT_SLOTS
 )
-from utils import format_book_card, DEFAULT_COVER_IMAGE_URL
+from cover_worker import start_background_worker
+from recommendations import start_background_refresh
+from events import start_background_writer, record_impressions, record_search, record_checkout
+from exports import export_books, EXPORT_FORMATS
+from utils import render_book_grid, format_visit_slot, DEFAULT_COVER_IMAGE_URL
+
+# Librarians sign in with this code in the sidebar to review suggestions and
+# work the circulation desk; with none set, staff tabs are never shown
+STAFF_ACCESS_CODE = os.environ.get("LIBRARY_STAFF_CODE", "")
+
+# Time this rerun phase by phase; see the performance panel at ?admin=1
+instrumentation.begin_rerun()
 
 # Set page config
 st.set_page_config(
@@ -21,6 +52,16 @@ st.set_page_config(
 # Initialize database
 initialize_database()
 
+# Check cover URLs and prefetch covers in the background (once per process)
+start_background_worker()
+
+# Keep the "more like this" lists current as books are added (once per process)
+start_background_refresh()
+
+# Write usage events behind the page and roll them up into popularity (once per process)
+start_background_writer()
+instrumentation.checkpoint("app.startup")
+
 # App states in session state
 if 'page' not in st.session_state:
     st.session_state.page = 'home'  # Default to home page
@@ -30,6 +71,16 @@ if 'selected_age_group' not in st.session_state:
     st.session_state.selected_age_group = 'All'
 if 'search_query' not in st.session_state:
     st.session_state.search_query = ''
+if 'catalog_cursors' not in st.session_state:
+    st.session_state.catalog_cursors = [None]  # Start cursor of each visited page
+if 'catalog_filters' not in st.session_state:
+    st.session_state.catalog_filters = None
+if 'review_round' not in st.session_state:
+    st.session_state.review_round = 0  # Bumped after each review so selections reset
+if 'seen_books' not in st.session_state:
+    st.session_state.seen_books = set()  # Books this session has recorded an impression for
+if 'is_staff' not in st.session_state:
+    st.session_state.is_staff = False  # Signed in with STAFF_ACCESS_CODE
 
 # Function to set page state
 def set_page(page_name):
@@ -42,6 +93,12 @@ def reset_all_filters():
     st.session_state.search_query = ''
     st.session_state.page = 'home'
 
+# Function to delete this session's prepared export, once downloaded or outdated
+def discard_export():
+    export = st.session_state.pop('export', None)
+    if export is not None:
+        export[0].close()  # A temporary file is deleted when closed
+
 # Al Khor Community Library Branding - Improved header with modern design
 st.markdown("""
 <div style="
@@ -102,8 +159,14 @@ st.markdown("""
     </div>
 """, unsafe_allow_html=True)
 
-# Create tabs for Book Catalog, Suggestion Form, and Library Visit Scheduler
-tab1, tab2, tab3 = st.tabs(["📖 Book Catalog", "✏️ Suggest a Book", "🗓️ Visit Scheduler"])
+# Create tabs for Book Catalog, Suggestion Form and Library Visit Scheduler,
+# plus the suggestion review and circulation desk for signed-in staff
+tab_labels = ["📖 Book Catalog", "✏️ Suggest a Book", "🗓️ Visit Scheduler"]
+if st.session_state.is_staff:
+    tab_labels += ["🗂️ Review Suggestions", "📚 Circulation Desk"]
+tab1, tab2, tab3, *staff_tabs = st.tabs(tab_labels)
+tab4, tab5 = staff_tabs or (None, None)
+instrumentation.checkpoint("app.header")
 
 with tab1:
     # Sidebar for filters with enhanced styling
@@ -138,9 +201,17 @@ with tab1:
         # Search box with clear instructions
         st.markdown("##### Search")
         search_query = st.text_input(
-            "Search by title or author name",
-            placeholder="Enter title or author...",
-            help="Search across both book titles and author names"
+            "Search by title, author or description",
+            placeholder="Enter title, author or keywords...",
+            help="Search across book titles, author names and descriptions"
+        )
+        fuzzy_search = st.checkbox(
+            "Typo-tolerant search",
+            help="Also find titles and authors spelled a little differently, like 'Tolkein' or 'Rowlings'"
+        )
+        available_only = st.checkbox(
+            "Available now",
+            help="Only show books with a copy on the shelf right now"
         )
         
         # Apply filters button
@@ -150,6 +221,8 @@ with tab1:
         with col2:
             reset_filters = st.button("Reset All", use_container_width=True)
         
+        instrumentation.checkpoint("app.sidebar_filters")
+        
         # Add genre distribution chart in sidebar
         st.markdown("""
         <div style="margin-top: 25px; margin-bottom: 10px;">
@@ -157,26 +230,20 @@ with tab1:
         </div>
         """, unsafe_allow_html=True)
         
-        books_df = pd.DataFrame(get_all_books())
-        if not books_df.empty:
+        collection_stats = get_collection_stats()
+        if collection_stats['total_books']:
             # Show total book count
-            total_books = len(books_df)
-            st.metric("Total Books in Collection", total_books)
+            st.metric("Total Books in Collection", collection_stats['total_books'])
             
-            # Get count of unique genres and authors
-            unique_genres = len(books_df['genre'].unique())
-            unique_authors = len(books_df['author'].unique())
-            
-            # Display in two columns
+            # Display unique genre and author counts in two columns
             stat_col1, stat_col2 = st.columns(2)
             with stat_col1:
-                st.metric("Genres", unique_genres)
+                st.metric("Genres", collection_stats['unique_genres'])
             with stat_col2:
-                st.metric("Authors", unique_authors)
+                st.metric("Authors", collection_stats['unique_authors'])
             
             # Genre distribution chart
-            genre_counts = books_df['genre'].value_counts().reset_index()
-            genre_counts.columns = ['Genre', 'Count']
+            genre_counts = pd.DataFrame(collection_stats['genre_counts'], columns=['Genre', 'Count'])
             
             fig = px.pie(
                 genre_counts, 
@@ -191,20 +258,49 @@ with tab1:
                 legend=dict(orientation="h", yanchor="bottom", y=-0.3, xanchor="center", x=0.5)
             )
             st.plotly_chart(fig, use_container_width=True)
+    instrumentation.checkpoint("app.collection_chart")
     
     # Main content area for books
     # Get books based on filters or reset if requested
     if reset_filters:
-        books = get_all_books()
         st.rerun()  # Rerun the app to reset all filters (using the newer st.rerun instead of experimental_rerun)
-    elif filter_pressed or search_query or selected_genre != "All" or age_group != "All":
-        books = get_books_by_filter(
-            genre=None if selected_genre == "All" else selected_genre,
-            age_group=None if age_group == "All" else age_group,
-            search_query=search_query
-        )
-    else:
-        books = get_all_books()
+    
+    filters = {
+        'genre': None if selected_genre == "All" else selected_genre,
+        'age_group': None if age_group == "All" else age_group,
+        'search_query': search_query or None,
+        'available_only': available_only
+    }
+    
+    # Go back to the first page whenever the filters change
+    previous_filters = st.session_state.catalog_filters
+    if previous_filters != filters:
+        st.session_state.catalog_filters = filters
+        st.session_state.catalog_cursors = [None]
+    
+    # Fetch only the current page of books plus the total number of matches
+    page_index = len(st.session_state.catalog_cursors) - 1
+    books, next_cursor = get_books_page(cursor=st.session_state.catalog_cursors[-1], **filters)
+    total_books_found = count_books(**filters)
+    
+    # Typo-tolerant search replaces the paged results when switched on, and
+    # steps in by itself when an exact search finds nothing
+    show_fuzzy = bool(filters['search_query']) and (fuzzy_search or not total_books_found)
+    if show_fuzzy:
+        books = get_books_fuzzy(**filters)
+        next_cursor = None
+        page_index = 0
+        total_books_found = len(books)
+    
+    # Usage events only go into an in-memory buffer; a background thread
+    # writes them, so recording never slows the page down. A book shown again
+    # in the same session is not counted again.
+    if filters['search_query'] and filters['search_query'] != (previous_filters or {}).get('search_query'):
+        record_search(filters['search_query'], total_books_found)
+    new_impressions = [book['id'] for book in books if book['id'] not in st.session_state.seen_books]
+    st.session_state.seen_books.update(new_impressions)
+    record_impressions(new_impressions)
+    instrumentation.checkpoint("app.catalog_query")
     
     # Results section with better styling
     if not books:
@@ -215,7 +311,7 @@ with tab1:
         with col1:
             st.markdown(f"""
             <h3 style="margin-bottom: 0px; color: #333;">
-                Found {len(books)} books
+                Found {total_books_found} {"close matches" if show_fuzzy else "books"}
             </h3>
             """, unsafe_allow_html=True)
             
@@ -227,6 +323,8 @@ with tab1:
                 active_filters.append(f"Age: {age_group}")
             if search_query:
                 active_filters.append(f"Search: '{search_query}'")
+            if available_only:
+                active_filters.append("Available now")
                 
             if active_filters:
                 st.markdown(f"""
@@ -235,37 +333,71 @@ with tab1:
                 </div>
                 """, unsafe_allow_html=True)
         
-        with col2:
-            # Add download button for current results
-            books_df = pd.DataFrame(books)
-            csv = books_df.to_csv(index=False)
-            st.download_button(
-                "📥 Download Results",
-                csv,
-                "library_books.csv",
-                "text/csv",
-                key='download-csv',
-                help="Download the current book list as a CSV file",
-                use_container_width=True
-            )
+        # Close matches are a short ranked list, not an exportable result set
+        if not show_fuzzy:
+            with col2:
+                # Exports are only generated when requested, then kept on disk for
+                # this session until downloaded or the filters or format change
+                export_format = st.selectbox(
+                    "Export format",
+                    list(EXPORT_FORMATS),
+                    label_visibility="collapsed",
+                    help="CSV for spreadsheets, Parquet for loading the catalog into data tools"
+                )
+                export_request = (tuple(filters.items()), export_format)
+                if st.session_state.get('export_request') != export_request:
+                    discard_export()
+            
+                if 'export' not in st.session_state:
+                    if st.button("📥 Prepare Download", use_container_width=True,
+                                 help="Export all books matching the current filters"):
+                        export_file, export_name, export_mime = export_books(export_format, **filters)
+                        export_file.rollover()  # Move even a small export out of memory
+                        st.session_state.export_request = export_request
+                        st.session_state.export = (export_file, export_name, export_mime)
+                        st.rerun()
+            
+                if 'export' in st.session_state:
+                    export_file, export_name, export_mime = st.session_state.export
+                    # The download button needs the file as bytes; they are read
+                    # for this rerun only, and the file goes once it is downloaded
+                    export_file.seek(0)
+                    st.download_button(
+                        "📥 Download Results",
+                        export_file.read(),
+                        export_name,
+                        export_mime,
+                        key='download-export',
+                        on_click=discard_export,
+                        help="Download the current book list",
+                        use_container_width=True
+                    )
         
         # Display books in a responsive grid (3 columns on desktop, adjust for mobile)
-        # For better mobile responsiveness
-        if len(books) > 0:
-            st.write("---")
-            
-            # Create a better grid layout for books
-            for i in range(0, len(books), 3):
-                row_books = books[i:min(i+3, len(books))]
-                cols = st.columns(3)
-                
-                # Fill each column with a book
-                for j, book in enumerate(row_books):
-                    with cols[j]:
-                        format_book_card(book)
-                
-                # Add a divider between rows for better visual separation
-                st.write("---")
+        # rendered as a single HTML fragment for the whole page
+        st.write("---")
+        render_book_grid(books)
+        st.write("---")
+        
+        # Page navigation: moving forward remembers the cursor of the next page
+        # so moving back never has to re-scan earlier pages
+        total_pages = max(1, -(-total_books_found // PAGE_SIZE))
+        nav_col1, nav_col2, nav_col3 = st.columns([1, 2, 1])
+        with nav_col1:
+            if st.button("← Previous", disabled=page_index == 0, use_container_width=True):
+                st.session_state.catalog_cursors.pop()
+                st.rerun()
+        with nav_col2:
+            st.markdown(f"""
+            <p style="text-align: center; margin-top: 8px; color: #666;">
+                Page {page_index + 1} of {total_pages}
+            </p>
+            """, unsafe_allow_html=True)
+        with nav_col3:
+            if st.button("Next →", disabled=next_cursor is None, use_container_width=True):
+                st.session_state.catalog_cursors.append(next_cursor)
+                st.rerun()
+    instrumentation.checkpoint("app.catalog_render")
 
 with tab2:
     st.header("📝 Suggest a Book for the Library")
@@ -318,9 +450,12 @@ with tab2:
                                             help="Click to submit your book suggestion")
             
             if submitted:
-                if suggested_title and suggested_author:
-                    # Add suggestion to database
-                    add_book_suggestion(
+                suggested_cover_url = suggested_cover_url.strip()
+                if suggested_cover_url and not suggested_cover_url.lower().startswith(("http://", "https://")):
+                    st.error("The cover image URL must start with http:// or https://.")
+                elif suggested_title and suggested_author:
+                    # Add suggestion to database unless we already know the book
+                    result = add_book_suggestion(
                         title=suggested_title,
                         author=suggested_author,
                         genre=suggested_genre,
@@ -328,7 +463,17 @@ with tab2:
                         description=suggested_description,
                         cover_url=suggested_cover_url
                     )
-                    st.success("Thank you for your suggestion! The library staff will review it.")
+                    if result['status'] == 'in_catalog':
+                        book = result['book']
+                        st.info(f"Good news: we already have this! Look for \"{book['title']}\" "
+                                f"by {book['author']} in the Book Catalog.")
+                    elif result['status'] == 'already_suggested':
+                        times = result['times_suggested']
+                        st.success(f"Thank you! This book was already suggested {times} "
+                                   f"time{'s' if times != 1 else ''}, so we've counted your "
+                                   "vote. The library staff will review it.")
+                    else:
+                        st.success("Thank you for your suggestion! The library staff will review it.")
                 else:
                     st.error("Please provide at least the book title and author.")
     
@@ -360,6 +505,7 @@ with tab2:
             </ul>
         </div>
         """, unsafe_allow_html=True)
+    instrumentation.checkpoint("app.suggestion_tab")
 
 with tab3:
     st.header("🗓️ Al Khor Community Library Visit Scheduler")
@@ -378,6 +524,17 @@ with tab3:
     col1, col2 = st.columns([3, 2])
     
     with col1:
+        # Places left in every slot over the next two weeks, from one query
+        st.subheader("Places Available")
+        today = pd.Timestamp.now().date()
+        availability = pd.DataFrame(get_visit_availability(today, today + pd.Timedelta(days=13)))
+        availability['Slot'] = [format_visit_slot((row.start_time, row.end_time))
+                                for row in availability.itertuples()]
+        availability['Date'] = pd.to_datetime(availability['visit_date']).dt.strftime('%a %d %b')
+        places = availability.pivot(index='Date', columns='Slot', values='remaining')
+        places = places.loc[availability['Date'].unique(), [format_visit_slot(slot) for slot in VISIT_SLOTS]]
+        st.dataframe(places, use_container_width=True)
+        
         # Visitor information section
         st.subheader("Visitor Information")
         
@@ -423,15 +580,10 @@ with tab3:
                     help="Select your preferred visit date"
                 )
             with col1b:
-                visit_time = st.selectbox(
+                visit_slot = st.selectbox(
                     "Preferred Time",
-                    [
-                        "9:00 AM - 11:00 AM",
-                        "11:00 AM - 1:00 PM",
-                        "1:00 PM - 3:00 PM",
-                        "3:00 PM - 5:00 PM",
-                        "5:00 PM - 7:00 PM"
-                    ],
+                    VISIT_SLOTS,
+                    format_func=format_visit_slot,
                     help="Select your preferred visit time"
                 )
             
@@ -448,16 +600,32 @@ with tab3:
             
             if submit_visit:
                 if visitor_name and visitor_email and visit_date:
-                    st.success(f"Thank you, {visitor_name}! Your visit has been scheduled for {visit_date.strftime('%A, %B %d, %Y')} at {visit_time}. A confirmation email has been sent to {visitor_email}.")
-                    
-                    # Display a QR code (for demo purposes)
-                    st.markdown("""
-                        <div style="background-color: #f8f8f8; padding: 15px; border-radius: 5px; text-align: center; margin-top: 20px;">
-                            <h4>📱 Save to Calendar</h4>
-                            <p>Scan this QR code to add this visit to your calendar</p>
-                            <img src="https://cdn.pixabay.com/photo/2020/08/04/08/21/qr-code-5462633_960_720.png" width="150px">
-                        </div>
-                    """, unsafe_allow_html=True)
+                    # Take the places for the whole group, or none if the slot is full
+                    booking = book_visit(
+                        visit_date,
+                        visit_slot[0],
+                        num_visitors,
+                        visitor_name,
+                        visitor_email,
+                        visitor_phone=visitor_phone or None,
+                        purpose=other_purpose if visit_purpose == "Other (please specify)" else visit_purpose,
+                        notes=additional_notes or None
+                    )
+                    if booking['status'] == 'full':
+                        st.error(f"Sorry, that time only has {booking['remaining']} "
+                                 f"place{'s' if booking['remaining'] != 1 else ''} left for {num_visitors} "
+                                 "visitors. Please choose another time or date.")
+                    else:
+                        st.success(f"Thank you, {visitor_name}! Your visit has been scheduled for {visit_date.strftime('%A, %B %d, %Y')} at {format_visit_slot(visit_slot)}. Your booking reference is #{booking['visit_id']}. A confirmation email has been sent to {visitor_email}.")
+                        
+                        # Display a QR code (for demo purposes)
+                        st.markdown("""
+                            <div style="background-color: #f8f8f8; padding: 15px; border-radius: 5px; text-align: center; margin-top: 20px;">
+                                <h4>📱 Save to Calendar</h4>
+                                <p>Scan this QR code to add this visit to your calendar</p>
+                                <img src="https://cdn.pixabay.com/photo/2020/08/04/08/21/qr-code-5462633_960_720.png" width="150px">
+                            </div>
+                        """, unsafe_allow_html=True)
                 else:
                     st.error("Please fill in all required fields (name, email, and visit date).")
     
@@ -508,3 +676,255 @@ with tab3:
             </p>
         </div>
         """, unsafe_allow_html=True)
+    instrumentation.checkpoint("app.visit_tab")
+
+# Number of suggestions listed for review at once, most requested first
+REVIEW_LIMIT = 1000
+
+if tab4 is not None:
+    with tab4:
+        st.header("🗂️ Review Book Suggestions")
+        st.markdown("""
+            <div style="background-color: #f0f7ff; padding: 20px; border-radius: 10px; margin-bottom: 25px; border-left: 5px solid #873600;">
+                <h4 style="margin-top: 0; color: #873600;">For Library Staff</h4>
+                <p style="margin-bottom: 0;">Tick the suggestions to act on, then approve them into the catalog or reject them.
+                Approved books become searchable straight away; suggestions for books already in the catalog are simply cleared.</p>
+            </div>
+        """, unsafe_allow_html=True)
+    
+        if 'review_message' in st.session_state:
+            st.success(st.session_state.pop('review_message'))
+    
+        total_suggestions = count_suggestions()
+        if not total_suggestions:
+            st.info("There are no suggestions waiting for review.")
+        else:
+            suggestions = pd.DataFrame(get_suggestions(REVIEW_LIMIT))
+            st.markdown(f"**{total_suggestions} suggestions waiting**"
+                        + (f" (showing the {REVIEW_LIMIT} most requested)" if total_suggestions > REVIEW_LIMIT else ""))
+        
+            select_all = st.checkbox("Select all shown", key=f"review_select_all_{st.session_state.review_round}")
+            suggestions.insert(0, 'select', select_all)
+            edited = st.data_editor(
+                suggestions,
+                key=f"review_editor_{st.session_state.review_round}",
+                hide_index=True,
+                use_container_width=True,
+                disabled=[column for column in suggestions.columns if column != 'select'],
+                column_order=['select', 'title', 'author', 'genre', 'age_group', 'times_suggested',
+                              'submission_date', 'description'],
+                column_config={
+                    'select': st.column_config.CheckboxColumn("Select"),
+                    'title': "Title",
+                    'author': "Author",
+                    'genre': "Genre",
+                    'age_group': "Age Group",
+                    'times_suggested': st.column_config.NumberColumn("Times Suggested"),
+                    'submission_date': "First Suggested",
+                    'description': "Description",
+                }
+            )
+            selected_ids = edited.loc[edited['select'], 'id'].tolist()
+        
+            review_col1, review_col2 = st.columns(2)
+            with review_col1:
+                if st.button(f"✅ Approve {len(selected_ids)} selected", disabled=not selected_ids,
+                             use_container_width=True):
+                    result = approve_suggestions(selected_ids)
+                    skipped = result['removed'] - result['added']
+                    st.session_state.review_message = (
+                        f"Added {result['added']} books to the catalog"
+                        + (f"; {skipped} were already in it" if skipped else "") + "."
+                    )
+                    st.session_state.review_round += 1
+                    st.rerun()
+            with review_col2:
+                if st.button(f"🗑️ Reject {len(selected_ids)} selected", disabled=not selected_ids,
+                             use_container_width=True):
+                    removed = reject_suggestions(selected_ids)
+                    st.session_state.review_message = f"Rejected {removed} suggestions."
+                    st.session_state.review_round += 1
+                    st.rerun()
+        instrumentation.checkpoint("app.review_tab")
+
+if tab5 is not None:
+    with tab5:
+        st.header("📚 Circulation Desk")
+        st.markdown("""
+            <div style="background-color: #f0f7ff; padding: 20px; border-radius: 10px; margin-bottom: 25px; border-left: 5px solid #873600;">
+                <h4 style="margin-top: 0; color: #873600;">For Library Staff</h4>
+                <p style="margin-bottom: 0;">Enter the patron's library card number, then lend, return or reserve books.
+                Returned copies go to the first patron waiting for them; everyone else joins the queue in order.</p>
+            </div>
+        """, unsafe_allow_html=True)
+    
+        if 'circulation_message' in st.session_state:
+            st.success(st.session_state.pop('circulation_message'))
+    
+        patron = st.text_input("Library card number", key="circulation_patron").strip()
+    
+        desk_col1, desk_col2 = st.columns(2)
+        with desk_col1:
+            st.subheader("Lend or Reserve")
+            book_search = st.text_input("Find a book", placeholder="Title or author...",
+                                        key="circulation_search")
+            desk_books = get_books_page(search_query=book_search)[0] if book_search else []
+            if book_search and not desk_books:
+                st.info("No books match that search.")
+            if desk_books:
+                availability = get_availability(book['id'] for book in desk_books)
+            
+                def describe_book(book):
+                    counts = availability.get(book['id'])
+                    if counts is None:
+                        return f"{book['title']} – {book['author']} (no copies)"
+                    shelf = f"{counts['copies_available']} of {counts['copies_total']} on the shelf"
+                    if counts['holds_waiting']:
+                        shelf += f", {counts['holds_waiting']} waiting"
+                    return f"{book['title']} – {book['author']} ({shelf})"
+            
+                desk_book = st.selectbox("Book", desk_books, format_func=describe_book,
+                                         key="circulation_book")
+                lend_col, hold_col = st.columns(2)
+                with lend_col:
+                    if st.button("📤 Check out", disabled=not patron, use_container_width=True):
+                        result = checkout_book(desk_book['id'], patron)
+                        if result['status'] == 'loaned':
+                            record_checkout(desk_book['id'])
+                            st.session_state.circulation_message = (
+                                f"Lent copy #{result['copy_id']} of \"{desk_book['title']}\" to {patron}, "
+                                f"due back {result['due_date']}."
+                            )
+                            st.rerun()
+                        else:
+                            st.warning("No copy is on the shelf. Place a hold to join the queue.")
+                with hold_col:
+                    if st.button("🔖 Place hold", disabled=not patron, use_container_width=True):
+                        result = place_hold(desk_book['id'], patron)
+                        if result['status'] == 'available':
+                            st.warning("A copy is on the shelf, so it can be checked out straight away.")
+                        else:
+                            st.session_state.circulation_message = (
+                                f"{patron} is number {result['position']} in the queue for "
+                                f"\"{desk_book['title']}\"." if result['position']
+                                else f"A copy of \"{desk_book['title']}\" is waiting for {patron} at the desk."
+                            )
+                            st.rerun()
+    
+        with desk_col2:
+            st.subheader("Return")
+            with st.form("return_form", clear_on_submit=True):
+                copy_id = st.number_input("Copy number", min_value=1, step=1)
+                if st.form_submit_button("📥 Check in", use_container_width=True):
+                    result = return_book(int(copy_id))
+                    if result['status'] == 'not_on_loan':
+                        st.warning(f"Copy #{copy_id} is not on loan.")
+                    else:
+                        st.session_state.circulation_message = (
+                            f"Copy #{copy_id} is set aside for {result['held_for']}, who was first in the queue."
+                            if result['held_for'] else f"Copy #{copy_id} is back on the shelf."
+                        )
+                        st.rerun()
+    
+        if patron:
+            loans, holds = get_patron_circulation(patron)
+            st.subheader(f"Books on loan to {patron}")
+            if loans:
+                st.dataframe(
+                    pd.DataFrame(loans)[['copy_id', 'title', 'author', 'loaned_at', 'due_date']],
+                    hide_index=True,
+                    use_container_width=True,
+                    column_config={
+                        'copy_id': "Copy",
+                        'title': "Title",
+                        'author': "Author",
+                        'loaned_at': "Lent",
+                        'due_date': "Due",
+                    }
+                )
+            else:
+                st.caption("No books on loan.")
+        
+            st.subheader(f"Holds for {patron}")
+            if holds:
+                for hold in holds:
+                    hold_col1, hold_col2 = st.columns([4, 1])
+                    with hold_col1:
+                        status = (f"copy #{hold['copy_id']} ready at the desk" if hold['status'] == 'ready'
+                                  else f"number {hold['position']} in the queue")
+                        st.markdown(f"**{hold['title']}** by {hold['author']} – {status}")
+                    with hold_col2:
+                        if st.button("Cancel", key=f"cancel_hold_{hold['hold_id']}", use_container_width=True):
+                            cancel_hold(hold['hold_id'])
+                            st.session_state.circulation_message = f"Cancelled the hold on \"{hold['title']}\"."
+                            st.rerun()
+            else:
+                st.caption("No holds.")
+        instrumentation.checkpoint("app.circulation_tab")
+
+# Staff sign-in at the foot of the sidebar, kept for the rest of the session
+if STAFF_ACCESS_CODE:
+    with st.sidebar.expander("🔑 Staff sign-in", expanded=False):
+        if st.session_state.is_staff:
+            if st.button("Sign out", use_container_width=True):
+                st.session_state.is_staff = False
+                st.rerun()
+        else:
+            with st.form("staff_sign_in", clear_on_submit=True):
+                access_code = st.text_input("Access code", type="password")
+                if st.form_submit_button("Sign in", use_container_width=True):
+                    if hmac.compare_digest(access_code.encode(), STAFF_ACCESS_CODE.encode()):
+                        st.session_state.is_staff = True
+                        st.rerun()
+                    else:
+                        st.error("That access code is not right.")
+
+last_rerun = instrumentation.end_rerun()
+
+# Hidden performance panel for signed-in staff, opened with ?admin=1 in the URL
+if st.query_params.get("admin") == "1" and st.session_state.is_staff:
+    with st.expander("⏱️ Performance", expanded=True):
+        instrumentation.SLOW_QUERY_MS = st.number_input(
+            "Slow query threshold (ms)",
+            min_value=1.0,
+            value=float(instrumentation.SLOW_QUERY_MS),
+            step=10.0,
+            help="Statements at least this slow are added to the slow query log"
+        )
+        metrics = instrumentation.snapshot()
+        
+        st.markdown(f"**This rerun: {last_rerun['total_ms']:.1f} ms**")
+        st.dataframe(
+            pd.DataFrame([{'phase': name, **phase} for name, phase in last_rerun['phases'].items()]),
+            hide_index=True,
+            use_container_width=True
+        )
+        
+        st.markdown("**Rolling timings** (percentiles over the most recent calls)")
+        st.dataframe(
+            pd.DataFrame([{'name': name, **summary} for name, summary in metrics['timings'].items()])
+            .sort_values('total_ms', ascending=False),
+            hide_index=True,
+            use_container_width=True
+        )
+        
+        st.markdown(f"**Slow queries** ({len(metrics['slow_queries'])} at or above "
+                    f"{metrics['slow_query_ms']:.0f} ms, newest first)")
+        if metrics['slow_queries']:
+            st.dataframe(pd.DataFrame(metrics['slow_queries'][::-1]), hide_index=True, use_container_width=True)
+        
+        panel_col1, panel_col2 = st.columns(2)
+        with panel_col1:
+            st.download_button(
+                "📥 Download metrics JSON",
+                json.dumps(metrics, indent=1),
+                "library_metrics.json",
+                "application/json",
+                use_container_width=True
+            )
+        with panel_col2:
+            if st.button("Reset timings", use_container_width=True):
+                instrumentation.reset()
+                st.rerun()
+        st.caption(f"Also written to {instrumentation.METRICS_FILE} every "
+                   f"{instrumentation.METRICS_WRITE_SECONDS:.0f} seconds while the app is in use.")
@@ -0,0 +1,126 @@
+"""Asyncio counterparts of the catalog database functions
+
+database.py blocks on sqlite3, which is right for Streamlit's per-session
+threads but would stall an event loop. The coroutines here run the same
+functions off the loop instead: reads on a pool of reader threads, one per
+pooled connection, and writes one at a time on a single writer thread, so
+writers queue in order rather than contend for SQLite's write lock.
+
+Every call takes a ``timeout`` in seconds (None waits for ever). A call that
+times out or is cancelled while still queued never runs; a read already
+running is interrupted. A write that has started is always left to finish,
+so a cancelled suggestion may still have been stored.
+
+    books = await async_database.get_books_by_filter(genre="Fantasy")
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+
+# One reader per pooled connection; more would open connections beyond the pool
+READER_THREADS = database.POOL_SIZE
+
+# Seconds a call may queue and run before it is cancelled
+DEFAULT_TIMEOUT_SECONDS = 30.0
+
+_readers = None
+_writer = None
+_executor_lock = threading.Lock()
+
+
+def _executors():
+    """Return the reader and writer executors, started once per process"""
+    global _readers, _writer
+    with _executor_lock:
+        if _readers is None:
+            _readers = ThreadPoolExecutor(READER_THREADS, thread_name_prefix="db-reader")
+            _writer = ThreadPoolExecutor(1, thread_name_prefix="db-writer")
+        return _readers, _writer
+
+
+def shutdown(wait=True):
+    """Stop the reader and writer threads, dropping calls that have not started"""
+    global _readers, _writer
+    with _executor_lock:
+        executors = (_readers, _writer)
+        _readers = _writer = None
+    for executor in executors:
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+class _Call:
+    """The thread a submitted call is running on, for interrupting it"""
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.thread_id = None
+
+    def run(self):
+        with self.lock:
+            self.thread_id = threading.get_ident()
+        try:
+            return self.func(*self.args, **self.kwargs)
+        finally:
+            with self.lock:
+                self.thread_id = None
+
+    def interrupt(self):
+        # Under the lock, so the thread cannot have moved on to another call
+        with self.lock:
+            if self.thread_id is not None:
+                database.interrupt_thread(self.thread_id)
+
+
+async def _submit(executor, interruptible, func, args, kwargs, timeout):
+    call = _Call(func, args, kwargs)
+    future = executor.submit(call.run)
+    try:
+        async with asyncio.timeout(timeout):
+            # Cancelling the wrapper cancels the future if it has not started
+            return await asyncio.wrap_future(future)
+    except (asyncio.CancelledError, TimeoutError):
+        if interruptible and not future.cancel():
+            call.interrupt()
+        raise
+
+
+async def run_read(func, *args, timeout=DEFAULT_TIMEOUT_SECONDS, **kwargs):
+    """Await a blocking read function run on a reader thread"""
+    readers, _ = _executors()
+    return await _submit(readers, True, func, args, kwargs, timeout)
+
+
+async def run_write(func, *args, timeout=DEFAULT_TIMEOUT_SECONDS, **kwargs):
+    """Await a blocking write function run on the writer thread, after the writes queued before it"""
+    _, writer = _executors()
+    return await _submit(writer, False, func, args, kwargs, timeout)
+
+
+async def get_all_books(timeout=DEFAULT_TIMEOUT_SECONDS):
+    """Async database.get_all_books()"""
+    return await run_read(database.get_all_books, timeout=timeout)
+
+
+async def get_books_by_filter(genre=None, age_group=None, search_query=None, available_only=False,
+                              timeout=DEFAULT_TIMEOUT_SECONDS):
+    """Async database.get_books_by_filter()"""
+    return await run_read(database.get_books_by_filter, genre, age_group, search_query,
+                          available_only, timeout=timeout)
+
+
+async def get_all_genres(timeout=DEFAULT_TIMEOUT_SECONDS):
+    """Async database.get_all_genres()"""
+    return await run_read(database.get_all_genres, timeout=timeout)
+
+
+async def add_book_suggestion(title, author, genre, age_group, description, cover_url,
+                              timeout=DEFAULT_TIMEOUT_SECONDS):
+    """Async database.add_book_suggestion()"""
+    return await run_write(database.add_book_suggestion, title, author, genre, age_group,
+                           description, cover_url, timeout=timeout)
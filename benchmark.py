@@ -0,0 +1,2083 @@
+"""Performance benchmarks and checks for the library book finder
+
+Each benchmark runs against a throwaway copy of the database so the real
+``library.db`` is never touched. Run one with:
+
+    python benchmark.py pool --threads 8 --seconds 3
+    python benchmark.py cache
+    python benchmark.py instrumentation
+    python benchmark.py startup
+    python benchmark.py render
+    python benchmark.py plans
+    python benchmark.py fuzzy --rows 100000
+    python benchmark.py similar --rows 20000
+    python benchmark.py duplicates --rows 100000
+    python benchmark.py approve --suggestions 5000
+    python benchmark.py visits --processes 4 --threads 8
+    python benchmark.py circulation --processes 4 --threads 8
+    python benchmark.py events --threads 8 --events 1000000
+    python benchmark.py scaling --sizes 10000 100000 1000000 --baseline scaling.json
+    python benchmark.py generate --books 100000 --output catalog.jsonl
+    python benchmark.py sessions --sessions 1 2 4 8 16 --actions 20
+    python benchmark.py api --threads 8 --seconds 3
+    python benchmark.py async --concurrency 1 10 100 1000
+    python benchmark.py snapshot --readers 4 --writers 2
+"""
+import argparse
+import asyncio
+import datetime
+import gzip
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlencode
+import multiprocessing
+
+import async_database
+import database
+import events
+import instrumentation
+import query_plans
+
+
+@contextmanager
+def temporary_database():
+    """Point the database module at a fresh, initialized temporary database"""
+    original_db_file = database.DB_FILE
+    tmp_dir = tempfile.mkdtemp(prefix="library-bench-")
+    database.DB_FILE = os.path.join(tmp_dir, "library.db")
+    try:
+        database.initialize_database()
+        yield database.DB_FILE
+    finally:
+        # Buffered usage events belong to this database, not the real one
+        events.flush_events()
+        database.close_pool()
+        database.DB_FILE = original_db_file
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def simulate_rerun():
+    """Run the queries a single Streamlit rerun of the catalog tab issues; return its page"""
+    filters = {'genre': "Fantasy", 'age_group': None, 'search_query': "Harry"}
+    database.get_all_genres()
+    database.get_collection_stats()
+    books, _ = database.get_books_page(**filters)
+    database.count_books(**filters)
+    database.get_books_by_filter(**filters)
+    return books
+
+
+def simulate_page_rerun():
+    """Run a catalog tab rerun's queries and build its page of book cards"""
+    import utils
+
+    utils.book_grid_html(simulate_rerun())
+
+
+def run_sessions(num_threads, seconds, work):
+    """Call ``work`` from ``num_threads`` threads for ``seconds``; return call count"""
+    deadline = time.perf_counter() + seconds
+    counts = [0] * num_threads
+
+    def session(index):
+        while time.perf_counter() < deadline:
+            work()
+            counts[index] += 1
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts)
+
+
+def bench_pool(args):
+    """Compare rerun throughput with and without the connection pool"""
+    queries_per_rerun = 5
+    results = {}
+    with temporary_database():
+        # Measure connection handling alone, not the result cache
+        database.USE_QUERY_CACHE = False
+        try:
+            for use_pool in (False, True):
+                database.USE_CONNECTION_POOL = use_pool
+                reruns = run_sessions(args.threads, args.seconds, simulate_rerun)
+                results[use_pool] = reruns * queries_per_rerun / args.seconds
+        finally:
+            database.USE_CONNECTION_POOL = True
+            database.USE_QUERY_CACHE = True
+
+    print(f"{args.threads} concurrent sessions, {args.seconds:.1f}s each")
+    print(f"  without pool: {results[False]:10.0f} queries/s")
+    print(f"  with pool:    {results[True]:10.0f} queries/s")
+    print(f"  speedup:      {results[True] / results[False]:10.2f}x")
+
+
+def bench_cache(args):
+    """Compare rerun throughput with and without the query result cache"""
+    results = {}
+    with temporary_database():
+        pad_catalog(args.rows)
+        for use_cache in (False, True):
+            database.USE_QUERY_CACHE = use_cache
+            database.query_cache.clear()
+            try:
+                reruns = run_sessions(args.threads, args.seconds, simulate_rerun)
+            finally:
+                database.USE_QUERY_CACHE = True
+            results[use_cache] = reruns / args.seconds
+        stats = database.get_cache_stats()
+
+    print(f"{args.threads} concurrent sessions, {args.rows} books, {args.seconds:.1f}s each")
+    print(f"  without cache: {results[False]:10.0f} reruns/s")
+    print(f"  with cache:    {results[True]:10.0f} reruns/s")
+    print(f"  speedup:       {results[True] / results[False]:10.2f}x")
+    print(f"  cache stats:   {stats}")
+
+
+def bench_instrumentation(args):
+    """Compare rerun throughput with timing instrumentation on and off"""
+    results = Counter()
+    with temporary_database():
+        pad_catalog(args.rows)
+        try:
+            # Alternate off and on and keep each one's best round, so a
+            # burst of other work on the machine does not read as overhead
+            for use_cache in (False, True):
+                database.USE_QUERY_CACHE = use_cache
+                for _ in range(args.rounds):
+                    for enabled in (False, True):
+                        instrumentation.ENABLED = enabled
+                        reruns = run_sessions(args.threads, args.seconds, simulate_page_rerun)
+                        results[use_cache, enabled] = max(results[use_cache, enabled], reruns / args.seconds)
+        finally:
+            instrumentation.ENABLED = True
+            database.USE_QUERY_CACHE = True
+        timings = instrumentation.snapshot()['timings']
+
+        # Log every statement, and look for a library card in the log
+        instrumentation.SLOW_QUERY_MS, slow_query_ms = 0.0, instrumentation.SLOW_QUERY_MS
+        try:
+            database.get_patron_circulation("CARD-0042")
+        finally:
+            instrumentation.SLOW_QUERY_MS = slow_query_ms
+        logged = instrumentation.snapshot()['slow_queries']
+
+    print(f"{args.threads} concurrent sessions, {args.rows} books, "
+          f"best of {args.rounds} rounds of {args.seconds:.1f}s, each building the page's card grid")
+    for use_cache, label in ((False, "uncached"), (True, "cached")):
+        off, on = results[use_cache, False], results[use_cache, True]
+        print(f"  {label:<9} reruns: {off:8.0f}/s off, {on:8.0f}/s on ({(off - on) / off:6.1%} overhead)")
+    for name in ("database.get_books_page", "database.count_books", "utils.book_grid_html", "sql"):
+        summary = timings[name]
+        print(f"  {name:<24} p50 {summary['p50_ms']:.3f} ms, p95 {summary['p95_ms']:.3f} ms, "
+              f"p99 {summary['p99_ms']:.3f} ms over {summary['count']} calls")
+    leaked = [entry for entry in logged if "CARD-0042" in entry['params']]
+    if not logged or leaked:
+        raise SystemExit(f"{len(leaked)} of {len(logged)} slow-query entries show a library card")
+    print(f"  ok: {len(logged)} slow-query entries, parameters redacted")
+
+
+def time_calls(func, repeat):
+    """Return the mean wall time of ``func()`` in milliseconds"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def legacy_initialize():
+    """Run the statements the original initialize_database issued per rerun"""
+    conn = database.get_db_connection()
+    conn.execute("CREATE TABLE IF NOT EXISTS books (id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE IF NOT EXISTS suggestions (id INTEGER PRIMARY KEY)")
+    conn.execute("SELECT COUNT(*) FROM books").fetchone()
+    conn.commit()
+    conn.close()
+
+
+def bench_startup(args):
+    """Time schema initialization at first start, process start and per rerun"""
+    with temporary_database() as db_file:
+        # temporary_database() already ran the migrations once; start over
+        database.close_pool()
+        os.remove(db_file)
+        database._initialized_files.clear()
+        cold = time_calls(database.initialize_database, 1)
+
+        def process_start():
+            database._initialized_files.clear()
+            database.initialize_database()
+
+        warm = time_calls(process_start, args.repeat)
+        rerun = time_calls(database.initialize_database, args.repeat)
+        legacy = time_calls(legacy_initialize, args.repeat)
+
+    print(f"  new database (migrate + seed):      {cold:10.3f} ms")
+    print(f"  process start, schema up to date:   {warm:10.3f} ms")
+    print(f"  per rerun, legacy initialization:   {legacy:10.3f} ms")
+    print(f"  per rerun, now:                     {rerun:10.5f} ms")
+
+
+def render_per_card(books):
+    """App script body: the original grid of columns with one card per column"""
+    import streamlit as st
+    from utils import format_book_card
+
+    for i in range(0, len(books), 3):
+        cols = st.columns(3)
+        for j, book in enumerate(books[i:i + 3]):
+            with cols[j]:
+                format_book_card(book)
+        st.write("---")
+
+
+def render_batched(books):
+    """App script body: the whole page of cards as one HTML fragment"""
+    from utils import render_book_grid
+
+    render_book_grid(books)
+
+
+def bench_render(args):
+    """Compare page render time and element count of the two card renderers"""
+    from streamlit.testing.v1 import AppTest
+
+    # The renderers look up broken covers and similar books, so they run
+    # against the temporary database too
+    with temporary_database():
+        pad_catalog(args.books)
+        books = database.get_all_books()[:args.books]
+
+        print(f"{len(books)} book cards per page, mean of {args.repeat} runs")
+        for name, script in (("per card", render_per_card), ("batched", render_batched)):
+            app = AppTest.from_function(script, args=(books,), default_timeout=60)
+            app.run()  # Warm up imports
+            if app.exception:
+                raise SystemExit(f"{name} render failed: {app.exception[0].value}")
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                app.run()
+            elapsed = (time.perf_counter() - start) / args.repeat * 1000
+            elements = sum(1 for _ in app.main)
+            print(f"  {name:9} {elapsed:9.1f} ms/render {elements:6} elements")
+
+
+def pad_catalog(num_books):
+    """Grow the catalog to ``num_books`` rows by repeating the sample books"""
+    books = database.get_all_books()
+    with database.connection() as conn:
+        conn.executemany('''
+        INSERT INTO books (title, author, genre, age_group, description, cover_url, popularity)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            (
+                f"{book['title']} ({i})",
+                book['author'],
+                book['genre'],
+                book['age_group'],
+                book['description'],
+                book['cover_url'],
+                (book['popularity'] + i) % 5 + 1
+            )
+            for i in range(num_books - len(books))
+            for book in [books[i % len(books)]]
+        ))
+        conn.execute("ANALYZE")
+        conn.commit()
+
+
+def check_plans(args):
+    """Fail if any query plan scans a table or sorts in a temp B-tree"""
+    with temporary_database():
+        pad_catalog(args.rows)
+        with database.connection() as conn:
+            results = query_plans.explain_queries(conn)
+    failures = 0
+    for name, plan, problems in results:
+        status = "FAIL" if problems else "ok"
+        print(f"[{status}] {name}")
+        for line in plan:
+            print(f"         {line}")
+        failures += bool(problems)
+
+    if failures:
+        raise SystemExit(f"{failures} query plan(s) regressed")
+
+
+SYLLABLES = (
+    "al", "an", "ar", "ba", "bel", "cor", "da", "dor", "el", "en", "fa", "gar",
+    "ha", "in", "is", "ka", "lan", "li", "lo", "ma", "mar", "mi", "na", "nor",
+    "o", "ra", "ri", "sa", "sel", "ta", "ten", "tha", "u", "va", "vin", "wen",
+)
+SURNAMES = (
+    "Tolkien", "Rowling", "Morrison", "Achebe", "Al-Mahmoud", "Alsanea",
+    "Carle", "Sendak", "Fitzgerald", "Seuss", "Mahfouz", "Adichie",
+)
+
+
+# Genres as (genre, share of the catalog, share of its books for small kids),
+# roughly the mix of a public library's lending stock
+GENRE_MIX = (
+    ("Fiction", 16, 0.0),
+    ("Children's Picture Book", 12, 1.0),
+    ("Children's Fiction", 11, 0.9),
+    ("Fantasy", 9, 0.25),
+    ("Mystery", 8, 0.1),
+    ("Non-Fiction", 8, 0.1),
+    ("Romance", 6, 0.0),
+    ("Science Fiction", 5, 0.1),
+    ("History", 5, 0.05),
+    ("Biography", 4, 0.05),
+    ("Classic Literature", 4, 0.05),
+    ("Education", 3, 0.4),
+    ("Coming-of-Age Fiction", 2, 0.2),
+    ("Dystopian Fiction", 2, 0.0),
+    ("Poetry", 2, 0.3),
+    ("Local History", 1, 0.0),
+    ("Art & Architecture", 1, 0.1),
+    ("Cultural Studies", 1, 0.0),
+)
+
+# Relative number of books at each popularity rating from 0 to 5
+POPULARITY_MIX = (30, 25, 20, 13, 8, 4)
+
+
+def synthetic_books(num_books, seed=0):
+    """Yield ``num_books`` random book dicts with made-up titles, authors and descriptions
+
+    The same seed always yields the same books. Genres and age groups follow
+    GENRE_MIX and ratings POPULARITY_MIX. Words follow a Zipf-like
+    distribution over a few thousand invented words, so some words are
+    common and most are rare, as in a real catalog; a few authors write
+    many books and most write one or two. Books for small kids have shorter
+    titles and descriptions. No two books share a title and author, so
+    none are merged on import.
+    """
+    rng = random.Random(seed)
+    words = sorted({
+        "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        for _ in range(8000)
+    })
+    rng.shuffle(words)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    surnames = list(SURNAMES) + [word.title() for word in words[:2000]]
+    authors = [
+        f"{rng.choice(words).title()} {rng.choice(surnames)}"
+        for _ in range(max(1000, num_books // 4))
+    ]
+    author_weights = list(itertools.accumulate(1 / (rank + 50) for rank in range(len(authors))))
+    genre_weights = list(itertools.accumulate(share for _, share, _ in GENRE_MIX))
+    seen = set()
+    for _ in range(num_books):
+        genre, _, kids_share = rng.choices(GENRE_MIX, cum_weights=genre_weights)[0]
+        kids = rng.random() < kids_share
+        title_length = rng.choice((1, 2, 2, 3, 3, 4) if kids else (1, 2, 3, 3, 4, 5))
+        title = " ".join(word.title() for word in rng.choices(words, cum_weights=weights, k=title_length))
+        author = rng.choices(authors, cum_weights=author_weights)[0]
+        volume = 1
+        while (title, author) in seen:
+            volume += 1
+            title = f"{title.rsplit(', Volume ', 1)[0]}, Volume {volume}"
+        seen.add((title, author))
+        description_length = min(200, max(5, round(rng.lognormvariate(3.0 if kids else 3.8, 0.5))))
+        yield {
+            'title': title,
+            'author': author,
+            'genre': genre,
+            'age_group': "Small Kids" if kids else "Teens & Adults",
+            'description': " ".join(rng.choices(words, cum_weights=weights, k=description_length)).capitalize() + ".",
+            'cover_url': None,
+            'popularity': rng.choices(range(6), weights=POPULARITY_MIX)[0],
+        }
+
+
+def load_synthetic_catalog(num_books, batch_size=5000, seed=0):
+    """Bulk load ``num_books`` synthetic books the way catalog_import does"""
+    books = synthetic_books(num_books, seed)
+    with database.connection() as conn:
+        with database.bulk_load(conn):
+            while True:
+                batch = [book for _, book in zip(range(batch_size), books)]
+                if not batch:
+                    break
+                conn.execute("BEGIN IMMEDIATE")
+                database.upsert_books(conn, batch)
+                conn.commit()
+        conn.execute("ANALYZE")
+        conn.commit()
+
+
+def generate_catalog(args):
+    """Write a synthetic catalog as JSON Lines for catalog_import.py"""
+    with open(args.output, "w", encoding="utf-8") as output:
+        for book in synthetic_books(args.books, args.seed):
+            output.write(json.dumps(book) + "\n")
+    print(f"wrote {args.books} books to {args.output}; load them with:")
+    print(f"  python catalog_import.py {args.output}")
+
+
+def misspell(word, rng):
+    """Apply one random typo to a word: drop, swap, double or replace a letter"""
+    i = rng.randrange(1, len(word) - 1)
+    typo = rng.choice(("drop", "swap", "double", "replace"))
+    if typo == "drop":
+        return word[:i] + word[i + 1:]
+    if typo == "swap":
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    if typo == "double":
+        return word[:i] + word[i] + word[i:]
+    return word[:i] + rng.choice("aeiourstn") + word[i + 1:]
+
+
+# Slowest 95th-percentile misspelled search allowed at 100k books or more
+FUZZY_P95_MS = 10
+
+
+def bench_fuzzy(args):
+    """Time typo-tolerant searches and check they find the misspelled book
+
+    Fails if the 95th percentile reaches FUZZY_P95_MS on a catalog of 100k
+    books or more.
+    """
+    rng = random.Random(1)
+    with temporary_database():
+        start = time.perf_counter()
+        load_synthetic_catalog(args.rows)
+        load_seconds = time.perf_counter() - start
+        with database.connection() as conn:
+            terms = conn.execute("SELECT COUNT(*) FROM search_terms").fetchone()[0]
+            sample = conn.execute(
+                "SELECT id, title, author, genre FROM books ORDER BY random() LIMIT ?",
+                (args.queries,)
+            ).fetchall()
+        
+        # Misspell the author's surname and the longest title word of each
+        # sample book; half of the searches also filter on its genre
+        searches = [(None, "tolkein", None), (None, "rowlings", None)]
+        for i, book in enumerate(sample):
+            surname = database.normalize_words(book['author'])[-1]
+            title_word = max(database.normalize_words(book['title']), key=len)
+            query = " ".join(misspell(word, rng) if len(word) > 3 else word
+                             for word in (title_word, surname))
+            searches.append((book['id'], query, book['genre'] if i % 2 else None))
+        
+        # Measure cold queries, not the result cache
+        database.USE_QUERY_CACHE = False
+        try:
+            timings = []
+            found = 0
+            for book_id, query, genre in searches:
+                start = time.perf_counter()
+                books = database.get_books_fuzzy(query, genre=genre)
+                timings.append((time.perf_counter() - start) * 1000)
+                found += any(book['id'] == book_id for book in books)
+            examples = {query: [(book['title'], book['author']) for book in database.get_books_fuzzy(query)[:1]]
+                        for query in ("tolkein", "rowlings")}
+        finally:
+            database.USE_QUERY_CACHE = True
+
+        # Approving a book indexes its words, so a misspelling finds it at once
+        # and searches have nothing left to write
+        suggestion = database.add_book_suggestion("The Quillwright", "Marisol Vantongeren", "Fantasy",
+                                                  "Teens & Adults", None, None)
+        database.approve_suggestions([suggestion['suggestion_id']])
+        approved = [book['title'] for book in database.get_books_fuzzy("quilwright vantongern")]
+        with database.connection() as conn:
+            pending = conn.execute("SELECT COUNT(*) FROM search_terms_pending").fetchone()[0]
+
+    timings.sort()
+    print(f"{args.rows} books, {terms} indexed words, loaded and indexed in {load_seconds:.1f}s")
+    for query, top in examples.items():
+        print(f"  {query!r:12} -> {top}")
+    print(f"{len(timings)} misspelled searches")
+    print(f"  p50:  {timings[len(timings) // 2]:8.2f} ms")
+    print(f"  p95:  {timings[int(len(timings) * 0.95)]:8.2f} ms")
+    print(f"  max:  {timings[-1]:8.2f} ms")
+    print(f"  misspelled book found: {found / (len(searches) - 2):.0%}")
+    if args.rows >= 100000 and timings[int(len(timings) * 0.95)] >= FUZZY_P95_MS:
+        raise SystemExit(f"fuzzy search p95 is over {FUZZY_P95_MS} ms at {args.rows} books")
+    if examples["rowlings"][:1] != [("Harry Potter and the Sorcerer's Stone", "J.K. Rowling")]:
+        raise SystemExit(f"'rowlings' does not find J.K. Rowling first ({examples['rowlings'][:1]})")
+    print("  ok: the p95 is within budget and 'rowlings' finds J.K. Rowling first")
+    if approved[:1] != ["The Quillwright"] or pending:
+        raise SystemExit(f"a just-approved book was not found by a misspelling ({approved[:1]}), "
+                         f"{pending} books left waiting to be indexed")
+    print("  ok: a just-approved book is found by a misspelling")
+
+
+def bench_similar(args):
+    """Time the similar-books rebuild, an incremental update and the page lookup
+
+    A writer runs alongside the rebuild to show how long it waits for the
+    write lock.
+    After books are edited and deleted, the incremental term counts are
+    checked against a recount and no list may name a deleted book.
+    """
+    import recommendations
+
+    with temporary_database():
+        load_synthetic_catalog(args.rows)
+        instrumentation.reset()
+        write_waits = []
+        stop = threading.Event()
+
+        def write_alongside():
+            while not stop.is_set():
+                with database.connection() as conn:
+                    start = time.perf_counter()
+                    conn.execute("BEGIN IMMEDIATE")
+                    write_waits.append((time.perf_counter() - start) * 1000)
+                    conn.execute("UPDATE books SET popularity = popularity + 1 WHERE id = 1")
+                    conn.commit()
+                time.sleep(0.05)
+
+        writer = threading.Thread(target=write_alongside)
+        writer.start()
+        start = time.perf_counter()
+        try:
+            recommendations.refresh_similar_books(full=True)
+        finally:
+            stop.set()
+            writer.join()
+        rebuild_seconds = time.perf_counter() - start
+
+        # Add books the way a live import does, with the triggers queueing them
+        new_books = list(synthetic_books(args.add, seed=1))
+        for book in new_books:
+            book['title'] += " (new)"
+        with database.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            database.upsert_books(conn, new_books)
+            conn.commit()
+        start = time.perf_counter()
+        updated = recommendations.refresh_similar_books()
+        update_seconds = time.perf_counter() - start
+
+        # Edit and delete some books, then check the incremental update against a recount
+        with database.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            edited = [row[0] for row in conn.execute("SELECT id FROM books ORDER BY random() LIMIT ?", (args.add,))]
+            conn.executemany(
+                "UPDATE books SET author = 'Revised Author', description = 'revised ' || description WHERE id = ?",
+                ((book_id,) for book_id in edited[:args.add // 2])
+            )
+            conn.executemany("DELETE FROM books WHERE id = ?", ((book_id,) for book_id in edited[args.add // 2:]))
+            conn.commit()
+        start = time.perf_counter()
+        changed = recommendations.refresh_similar_books()
+        change_seconds = time.perf_counter() - start
+        update_write = instrumentation.snapshot()['timings']['recommendations.write_update']['max_ms']
+        with database.connection() as conn:
+            expected = Counter(
+                term
+                for book in conn.execute(recommendations.BOOK_QUERY)
+                for term in recommendations.book_terms(book)
+            )
+            counted = dict(conn.execute("SELECT term, book_count FROM recommendation_terms").fetchall())
+            dangling = conn.execute('''
+            SELECT COUNT(*) FROM similar_books
+            WHERE similar_id NOT IN (SELECT id FROM books) OR book_id NOT IN (SELECT id FROM books)
+            ''').fetchone()[0]
+
+        page_ids = tuple(book['id'] for book in database.get_books_page()[0])
+        database.USE_QUERY_CACHE = False
+        try:
+            lookup = time_calls(lambda: database.get_similar_books(page_ids), args.repeat)
+        finally:
+            database.USE_QUERY_CACHE = True
+        with database.connection() as conn:
+            stored = conn.execute("SELECT COUNT(*) FROM similar_books").fetchone()[0]
+
+    print(f"{args.rows} books, {stored} neighbours stored")
+    print(f"  full rebuild:                 {rebuild_seconds:10.2f} s")
+    print(f"    writer alongside, lock wait:{max(write_waits, default=0.0):10.1f} ms max "
+          f"over {len(write_waits)} writes")
+    print(f"  incremental, {updated:5} new books: {update_seconds * 1000:10.1f} ms")
+    print(f"  incremental, {changed:5} edited:    {change_seconds * 1000:10.1f} ms")
+    print(f"    longest write transaction:  {update_write:10.1f} ms")
+    print(f"  lookup for a page of {len(page_ids)}:      {lookup:10.3f} ms")
+    wrong = [term for term in expected.keys() | counted.keys() if expected[term] != counted.get(term, 0)]
+    if wrong or dangling:
+        raise SystemExit(f"{len(wrong)} term counts differ from a recount, "
+                         f"{dangling} neighbours name a deleted book")
+
+
+ACCENTS = {"a": "á", "e": "é", "i": "í", "o": "ö", "u": "ü"}
+
+
+def respell(title, author, rng):
+    """Write a title and author the way another person might type them
+
+    Changes letter case and punctuation, adds accents or a leading article,
+    or puts the author's surname first.
+    """
+    change = rng.choice(("case", "punctuation", "accents", "article", "surname"))
+    if change == "case":
+        return rng.choice((str.upper, str.lower))(title), author.lower()
+    if change == "punctuation":
+        return title.replace(" ", rng.choice((": ", " - ", ", ")), 1) + rng.choice(("!", ".", "?")), author
+    if change == "accents":
+        return "".join(ACCENTS.get(ch, ch) if rng.random() < 0.3 else ch for ch in title), author
+    if change == "article":
+        return f"The {title}", author
+    first, _, surname = author.rpartition(" ")
+    return title, f"{surname}, {first}"
+
+
+def bench_duplicates(args):
+    """Time duplicate checks on suggestion and the batch dedupe of suggestions"""
+    rng = random.Random(2)
+    with temporary_database():
+        start = time.perf_counter()
+        load_synthetic_catalog(args.rows)
+        load_seconds = time.perf_counter() - start
+        with database.connection() as conn:
+            owned = conn.execute(
+                "SELECT title, author FROM books ORDER BY random() LIMIT ?", (args.suggestions,)
+            ).fetchall()
+        
+        # Respelled books the library owns, and new books each suggested one
+        # to three times under different spellings; the first suggestion of
+        # a new book should be added and the others counted against it
+        new_books = [(book['title'] + " Returns", book['author'])
+                     for book in synthetic_books(args.suggestions, seed=3)]
+        submissions = [(None, *respell(title, author, rng)) for title, author in owned]
+        for index, (title, author) in enumerate(new_books):
+            submissions.append((index, title, author))
+            for _ in range(rng.randint(0, 2)):
+                submissions.append((index, *respell(title, author, rng)))
+        rng.shuffle(submissions)
+        
+        timings = []
+        outcomes = Counter()
+        seen = set()
+        for index, title, author in submissions:
+            if index is None:
+                expected = "in_catalog"
+            else:
+                expected = "already_suggested" if index in seen else "added"
+                seen.add(index)
+            start = time.perf_counter()
+            result = database.add_book_suggestion(title, author, "Fantasy", "Small Kids", "", "")
+            timings.append((time.perf_counter() - start) * 1000)
+            outcomes[expected, result['status']] += 1
+        
+        # Batch mode: load every submission as a raw row and merge them
+        with database.connection() as conn:
+            conn.execute("DELETE FROM suggestions")
+            conn.executemany(
+                "INSERT INTO suggestions (title, author, genre, age_group) VALUES (?, ?, 'Fantasy', 'Small Kids')",
+                [(title, author) for index, title, author in submissions if index is not None]
+            )
+            conn.commit()
+        start = time.perf_counter()
+        counts = database.dedupe_suggestions()
+        dedupe_seconds = time.perf_counter() - start
+        with database.connection() as conn:
+            survivors = {(row['title'], row['author']): row['times_suggested']
+                         for row in conn.execute("SELECT title, author, times_suggested FROM suggestions")}
+
+    # Each new book should be left as its first submission, counting them all
+    first_submissions = {}
+    for index, title, author in submissions:
+        if index is not None:
+            first_submissions.setdefault(index, (title, author))
+    submitted = Counter(index for index, _, _ in submissions if index is not None)
+    expected_survivors = {first_submissions[index]: count for index, count in submitted.items()}
+    timings.sort()
+    print(f"{args.rows} books loaded and indexed in {load_seconds:.1f}s")
+    print(f"{len(timings)} suggestions submitted")
+    print(f"  p50:  {timings[len(timings) // 2]:8.2f} ms")
+    print(f"  p95:  {timings[int(len(timings) * 0.95)]:8.2f} ms")
+    print(f"  max:  {timings[-1]:8.2f} ms")
+    for expected in ("in_catalog", "already_suggested", "added"):
+        total = sum(count for (wanted, _), count in outcomes.items() if wanted == expected)
+        print(f"  expected {expected + ':':19} {outcomes[expected, expected] / total:6.1%} of {total}")
+    print(f"batch dedupe of {counts['suggestions']} suggestions: {dedupe_seconds * 1000:.0f} ms, "
+          f"{counts['removed']} merged into {counts['groups']} (expected {len(new_books)} left)")
+    misfiled = sum(count for (expected, status), count in outcomes.items() if expected != status)
+    if misfiled:
+        raise SystemExit(f"{misfiled} submissions were not recognized as expected")
+    if survivors != expected_survivors:
+        wrong = set(survivors.items()) ^ set(expected_survivors.items())
+        raise SystemExit(f"the batch dedupe left {len(survivors)} suggestions, expected "
+                         f"{len(expected_survivors)}; {len(wrong)} rows or counts differ")
+    print("  ok: exactly the first submission of each new book is left, counting every submission")
+
+
+def queue_suggestions(num_suggestions, seed):
+    """Queue ``num_suggestions`` synthetic suggestions and return every queued id"""
+    with database.connection() as conn:
+        conn.executemany('''
+        INSERT INTO suggestions (title, author, genre, age_group, description, cover_url)
+        VALUES (:title, :author, :genre, :age_group, :description, :cover_url)
+        ''', ({**book, 'title': f"{book['title']} Suggested"}
+              for book in synthetic_books(num_suggestions, seed=seed)))
+        conn.commit()
+        return [row[0] for row in conn.execute("SELECT id FROM suggestions")]
+
+
+def bench_approve(args):
+    """Time bulk approval and rejection of suggestions against one at a time"""
+    with temporary_database():
+        load_synthetic_catalog(args.rows)
+        
+        ids = queue_suggestions(args.suggestions, seed=1)
+        start = time.perf_counter()
+        for suggestion_id in ids:
+            database.approve_suggestions([suggestion_id])
+        one_by_one = time.perf_counter() - start
+        
+        ids = queue_suggestions(args.suggestions, seed=2)
+        start = time.perf_counter()
+        approved = database.approve_suggestions(ids)
+        bulk = time.perf_counter() - start
+        
+        ids = queue_suggestions(args.suggestions, seed=3)
+        start = time.perf_counter()
+        rejected = database.reject_suggestions(ids)
+        reject = time.perf_counter() - start
+        
+        # The triggers must have kept every derived structure in step
+        stats = database.get_collection_stats()
+        with database.connection() as conn:
+            total_books = conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+            conn.execute("INSERT INTO books_fts (books_fts) VALUES ('integrity-check')")
+            unshelved = conn.execute('''
+            SELECT COUNT(*) FROM books
+            WHERE NOT EXISTS (SELECT 1 FROM book_copies WHERE book_id = books.id)
+               OR NOT EXISTS (SELECT 1 FROM book_availability WHERE book_id = books.id)
+            ''').fetchone()[0]
+            problems = circulation_problems(conn)
+        searchable = database.count_books(search_query="Suggested")
+
+    print(f"{args.rows} books, {args.suggestions} suggestions per run")
+    print(f"  one at a time:  {one_by_one * 1000:8.0f} ms")
+    print(f"  bulk approve:   {bulk * 1000:8.0f} ms  ({approved['added']} added, {approved['removed']} removed)")
+    print(f"  bulk reject:    {reject * 1000:8.0f} ms  ({rejected} removed)")
+    print(f"  speedup:        {one_by_one / bulk:8.1f}x")
+    print(f"  catalog total {stats['total_books']} (table has {total_books}), "
+          f"{searchable} approved books searchable, full-text index consistent")
+    if unshelved or problems:
+        raise SystemExit(f"{unshelved} books have no copy or counters, "
+                         f"{len(problems)} counters disagree with the copies")
+    print("  ok: every book has a copy on the shelf")
+
+
+def book_visits(db_file, seed, num_threads, bookings, visit_date, start_time):
+    """Book random-sized groups into one slot from ``num_threads`` threads at once
+
+    Runs in its own process; returns (group size, result, milliseconds) tuples.
+    """
+    database.DB_FILE = db_file
+    barrier = threading.Barrier(num_threads)
+    results = []
+
+    def session(index):
+        rng = random.Random(seed * 1000 + index)
+        barrier.wait()
+        for _ in range(bookings):
+            size = rng.randint(1, 4)
+            start = time.perf_counter()
+            result = database.book_visit(visit_date, start_time, size,
+                                         f"Visitor {seed}-{index}", "visitor@example.com")
+            results.append((size, result, (time.perf_counter() - start) * 1000))
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    database.close_pool()
+    return results
+
+
+def bench_visits(args):
+    """Run many parallel bookings against one visit slot and check it never overbooks"""
+    visit_date, start_time = "2030-01-01", database.VISIT_SLOTS[0][0]
+    with temporary_database() as db_file:
+        with ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+            runs = [executor.submit(book_visits, db_file, seed, args.threads, args.bookings,
+                                    visit_date, start_time)
+                    for seed in range(args.processes)]
+            attempts = [attempt for run in runs for attempt in run.result()]
+        with database.connection() as conn:
+            booked, capacity = conn.execute(
+                "SELECT booked, capacity FROM visit_slots WHERE visit_date = ? AND start_time = ?",
+                (visit_date, start_time)
+            ).fetchone()
+            visitors = conn.execute(
+                "SELECT COALESCE(SUM(num_visitors), 0) FROM visits WHERE visit_date = ? AND start_time = ?",
+                (visit_date, start_time)
+            ).fetchone()[0]
+        remaining = database.get_visit_availability(visit_date, visit_date)[0]['remaining']
+
+    results = [(size, result) for size, result, _ in attempts]
+    timings = sorted(milliseconds for _, _, milliseconds in attempts)
+    accepted = sum(size for size, result in results if result['status'] == 'booked')
+    refused = [(size, result) for size, result in results if result['status'] == 'full']
+    problems = []
+    if booked > capacity:
+        problems.append(f"slot overbooked: {booked} places taken of {capacity}")
+    if not booked == visitors == accepted == capacity - remaining:
+        problems.append(f"counts disagree: slot {booked}, visits {visitors}, "
+                        f"accepted {accepted}, availability {capacity - remaining}")
+    if any(result['remaining'] >= size for size, result in refused):
+        problems.append("a booking was refused although the slot had room for it")
+
+    print(f"{args.processes} processes x {args.threads} threads x {args.bookings} bookings "
+          f"against one slot of {capacity} places")
+    print(f"  {len(results)} attempts, {len(results) - len(refused)} booked, {len(refused)} refused as full")
+    print(f"  booking latency p50 {timings[len(timings) // 2]:.2f} ms, "
+          f"p95 {timings[int(len(timings) * 0.95)]:.2f} ms, max {timings[-1]:.2f} ms")
+    print(f"  places taken: {booked} of {capacity}, visits table: {visitors}, remaining: {remaining}")
+    for problem in problems:
+        print(f"  FAIL {problem}")
+    if problems:
+        raise SystemExit("visit slot bookings are not consistent")
+    print("  ok: never overbooked and all counts agree")
+
+
+def run_desk(db_file, seed, num_threads, operations, book_ids):
+    """Lend, return, reserve and cancel at random from ``num_threads`` threads at once
+
+    Runs in its own process, each thread acting for a few patrons of its
+    own; returns (operation, status, milliseconds) tuples.
+    """
+    database.DB_FILE = db_file
+    barrier = threading.Barrier(num_threads)
+    results = []
+
+    def session(index):
+        rng = random.Random(seed * 1000 + index)
+        patrons = [f"P{seed}-{index}-{n}" for n in range(3)]
+        barrier.wait()
+        for _ in range(operations):
+            patron = rng.choice(patrons)
+            loans, holds = database.get_patron_circulation(patron)
+            ready = [hold for hold in holds if hold['status'] == 'ready']
+            action = rng.random()
+            start = time.perf_counter()
+            if ready:
+                operation = "collect hold"
+                result = database.checkout_book(ready[0]['book_id'], patron)
+            elif loans and action < 0.6:
+                operation = "return"
+                result = database.return_book(rng.choice(loans)['copy_id'])
+            elif holds and action > 0.8:
+                operation = "cancel hold"
+                result = {'status': database.cancel_hold(rng.choice(holds)['hold_id'])}
+            else:
+                book_id = rng.choice(book_ids)
+                operation = "check out"
+                result = database.checkout_book(book_id, patron)
+                if result['status'] == 'unavailable':
+                    operation = "place hold"
+                    result = database.place_hold(book_id, patron)
+            results.append((operation, result['status'], (time.perf_counter() - start) * 1000))
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    database.close_pool()
+    return results
+
+
+def circulation_problems(conn):
+    """Return descriptions of every way the circulation tables disagree"""
+    problems = []
+    rows = conn.execute('''
+    SELECT a.book_id, a.copies_total, a.copies_available, a.holds_waiting,
+           (SELECT COUNT(*) FROM book_copies c WHERE c.book_id = a.book_id) AS copies,
+           (SELECT COUNT(*) FROM book_copies c WHERE c.book_id = a.book_id AND c.status = 'available') AS shelved,
+           (SELECT COUNT(*) FROM book_copies c WHERE c.book_id = a.book_id AND c.status = 'on_loan') AS lent,
+           (SELECT COUNT(*) FROM book_copies c WHERE c.book_id = a.book_id AND c.status = 'on_hold') AS set_aside,
+           (SELECT COUNT(*) FROM loans l WHERE l.book_id = a.book_id AND l.returned_at IS NULL) AS open_loans,
+           (SELECT COUNT(*) FROM holds h WHERE h.book_id = a.book_id AND h.status = 'waiting') AS waiting,
+           (SELECT COUNT(DISTINCT h.copy_id) FROM holds h
+            WHERE h.book_id = a.book_id AND h.status = 'ready') AS ready,
+           (SELECT MAX(h.id) FROM holds h
+            WHERE h.book_id = a.book_id AND h.copy_id IS NOT NULL) AS last_served,
+           (SELECT MIN(h.id) FROM holds h WHERE h.book_id = a.book_id AND h.status = 'waiting') AS first_waiting
+    FROM book_availability a
+    ''').fetchall()
+    for row in rows:
+        book = f"book {row['book_id']}"
+        if row['copies_total'] != row['copies']:
+            problems.append(f"{book}: {row['copies_total']} copies counted, {row['copies']} exist")
+        if row['copies_available'] != row['shelved']:
+            problems.append(f"{book}: {row['copies_available']} available counted, {row['shelved']} on the shelf")
+        if row['holds_waiting'] != row['waiting']:
+            problems.append(f"{book}: {row['holds_waiting']} holds counted, {row['waiting']} waiting")
+        if row['lent'] != row['open_loans']:
+            problems.append(f"{book}: {row['lent']} copies out, {row['open_loans']} open loans")
+        if row['set_aside'] != row['ready']:
+            problems.append(f"{book}: {row['set_aside']} copies set aside, {row['ready']} ready holds")
+        if row['waiting'] and row['shelved']:
+            problems.append(f"{book}: holds waiting while {row['shelved']} copies sit on the shelf")
+        if row['first_waiting'] and row['last_served'] and row['last_served'] > row['first_waiting']:
+            problems.append(f"{book}: hold {row['last_served']} was served before hold {row['first_waiting']}")
+    return problems
+
+
+def bench_circulation(args):
+    """Run many parallel desk sessions against a few titles and check the counters"""
+    with temporary_database() as db_file:
+        book_ids = [book['id'] for book in database.get_books_page()[0][:args.titles]]
+        for book_id in book_ids:
+            database.add_copies(book_id, args.copies - 1)
+        database.count_books(available_only=True)
+        with ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+            runs = [executor.submit(run_desk, db_file, seed, args.threads, args.operations, book_ids)
+                    for seed in range(args.processes)]
+            attempts = [attempt for run in runs for attempt in run.result()]
+        with database.connection() as conn:
+            problems = circulation_problems(conn)
+            on_shelf = conn.execute('''
+            SELECT COUNT(*) FROM books
+            WHERE id IN (SELECT book_id FROM book_copies WHERE status = 'available')
+            ''').fetchone()[0]
+            totals = conn.execute('''
+            SELECT (SELECT COUNT(*) FROM loans WHERE returned_at IS NULL),
+                   (SELECT COUNT(*) FROM holds WHERE status = 'waiting'),
+                   (SELECT COUNT(*) FROM holds WHERE status = 'ready')
+            ''').fetchone()
+        # Cached in this process before the run, so this also checks that
+        # titles going on and off the shelf invalidated the cache
+        listed = database.count_books(available_only=True)
+        if listed != on_shelf:
+            problems.append(f"available now lists {listed} books, {on_shelf} have a copy on the shelf")
+
+    timings = sorted(milliseconds for _, _, milliseconds in attempts)
+    outcomes = Counter((operation, status) for operation, status, _ in attempts)
+    print(f"{args.processes} processes x {args.threads} threads x {args.operations} operations "
+          f"on {len(book_ids)} titles of {args.copies} copies")
+    for (operation, status), count in sorted(outcomes.items()):
+        print(f"  {operation:<12} {status!s:<14} {count:6d}")
+    print(f"  latency p50 {timings[len(timings) // 2]:.2f} ms, "
+          f"p95 {timings[int(len(timings) * 0.95)]:.2f} ms, max {timings[-1]:.2f} ms")
+    print(f"  open loans {totals[0]}, holds waiting {totals[1]}, copies set aside {totals[2]}")
+    for problem in problems:
+        print(f"  FAIL {problem}")
+    if problems:
+        raise SystemExit("circulation counters are not consistent")
+    print("  ok: counters match the copies, loans and holds, and holds were served in order")
+
+
+def percentiles(timings):
+    """Format the p50, p95 and p99 of a list of millisecond timings"""
+    timings = sorted(timings)
+    return ", ".join(f"p{p} {timings[min(len(timings) - 1, len(timings) * p // 100)]:.3f} ms"
+                     for p in (50, 95, 99))
+
+
+def record_pages(num_threads, pages, book_ids, record):
+    """Record a page of impressions ``pages`` times from each thread; return ms per page"""
+    barrier = threading.Barrier(num_threads)
+    timings = []
+
+    def session(index):
+        rng = random.Random(index)
+        barrier.wait()
+        for _ in range(pages):
+            page = rng.sample(book_ids, database.PAGE_SIZE)
+            start = time.perf_counter()
+            record(page)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings
+
+
+def write_impressions(book_ids):
+    """Write a page of impressions straight to the database, as an inline logger would"""
+    now = time.time()
+    with database.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO events (kind, book_id, created_at) VALUES ('impression', ?, ?)",
+            ((book_id, now) for book_id in book_ids)
+        )
+        conn.commit()
+
+
+def bench_events(args):
+    """Time recording page events inline against the write-behind buffer, then the rollup"""
+    with temporary_database():
+        load_synthetic_catalog(args.rows)
+        with database.connection() as conn:
+            book_ids = [row[0] for row in conn.execute("SELECT id FROM books")]
+
+        inline = record_pages(args.threads, args.pages, book_ids, write_impressions)
+        with database.connection() as conn:
+            conn.execute("DELETE FROM events")
+            conn.commit()
+
+        events.start_background_writer()
+        start = time.perf_counter()
+        buffered = record_pages(args.threads, args.pages, book_ids, events.record_impressions)
+        recorded = time.perf_counter() - start
+        # Wait for the writer to catch up rather than flushing from here
+        while events.get_buffer_stats()['buffered']:
+            time.sleep(0.05)
+        drained = time.perf_counter() - start
+        events.flush_events()
+        with database.connection() as conn:
+            written = conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+            conn.execute("DELETE FROM events")
+            conn.commit()
+
+        # A few months of impressions and checkouts, skewed towards a few
+        # popular books as real traffic is
+        rng = random.Random(0)
+        now = time.time()
+        weights = list(itertools.accumulate(1 / rank for rank in range(1, len(book_ids) + 1)))
+        with database.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO events (kind, book_id, created_at) VALUES (?, ?, ?)",
+                (
+                    ("checkout" if rng.random() < 0.02 else "impression",
+                     rng.choices(book_ids, cum_weights=weights)[0],
+                     now - rng.random() * 120 * 24 * 3600)
+                    for _ in range(args.events)
+                )
+            )
+            conn.commit()
+        start = time.perf_counter()
+        first = events.rollup_popularity()
+        first_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        quiet = events.rollup_popularity()
+        quiet_elapsed = time.perf_counter() - start
+        with database.connection() as conn:
+            stars = dict(conn.execute(
+                "SELECT popularity, COUNT(*) FROM books GROUP BY popularity"
+            ).fetchall())
+
+    expected = args.threads * args.pages * database.PAGE_SIZE
+    print(f"{args.threads} threads x {args.pages} pages of {database.PAGE_SIZE} impressions, "
+          f"{args.rows} books")
+    print(f"  inline write per page:   {percentiles(inline)}")
+    print(f"  buffered record per page: {percentiles(buffered)}")
+    print(f"  {expected} events buffered in {recorded:.2f}s, all written {drained:.2f}s after the first; "
+          f"{written} rows, dropped {events.get_buffer_stats()['dropped']}")
+    print(f"  rollup of {first['events']} events: {first_elapsed:.2f}s ({first['changed']} books changed), "
+          f"then {quiet_elapsed:.2f}s with nothing new ({quiet['changed']} changed)")
+    print(f"  books per star rating: {dict(sorted(stars.items()))}")
+    if written != expected:
+        raise SystemExit(f"{expected - written} buffered events were never written")
+
+
+def measure(func, repeat, budget_seconds):
+    """Time calls of ``func`` and the peak memory of one more; return a result dict
+
+    Calls stop after ``repeat`` calls or once ``budget_seconds`` have passed,
+    whichever is first. The memory is what tracemalloc sees Python allocate,
+    measured on a separate call because tracing slows calls down.
+    """
+    func()  # Warm up the page cache and any imports
+    timings = []
+    deadline = time.perf_counter() + budget_seconds
+    while len(timings) < repeat and (not timings or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    timings.sort()
+    mean = sum(timings) / len(timings)
+    result = {'calls': len(timings), 'mean_ms': round(mean, 3)}
+    for p in (50, 95):
+        result[f'p{p}_ms'] = round(timings[min(len(timings) - 1, len(timings) * p // 100)], 3)
+    result['max_ms'] = round(timings[-1], 3)
+    result['per_second'] = round(1000 / mean, 1)
+    result['peak_kib'] = round(peak / 1024, 1)
+    return result
+
+
+def shelve_synthetic_copies():
+    """Leave four in five books one copy on the shelf, so "Available now" has work to do"""
+    with database.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        # Loaded books come with a copy each; start again from none
+        conn.execute("DELETE FROM book_copies")
+        conn.execute("DELETE FROM book_availability")
+        conn.execute("INSERT INTO book_copies (book_id) SELECT id FROM books WHERE id % 5 != 0 ORDER BY id")
+        conn.execute('''
+        INSERT INTO book_availability (book_id, copies_total, copies_available)
+        SELECT book_id, COUNT(*), COUNT(*) FROM book_copies GROUP BY book_id
+        ''')
+        conn.commit()
+        # Statistics from before the copies existed make SQLite scan them
+        conn.execute("ANALYZE")
+        conn.commit()
+
+
+def render_collection_chart():
+    """The sidebar overview: collection stats into a DataFrame and a Plotly donut"""
+    import pandas as pd
+    import plotly.express as px
+    import plotly.io as pio
+
+    stats = database.get_collection_stats()
+    genre_counts = pd.DataFrame(stats['genre_counts'], columns=['Genre', 'Count'])
+    fig = px.pie(genre_counts, values='Count', names='Genre', title='Books by Genre', hole=0.4)
+    # st.plotly_chart sends the figure to the browser as JSON
+    return pio.to_json(fig)
+
+
+def export_csv(**filters):
+    """Export the filtered books as CSV and read the file through, as a download does"""
+    import exports
+
+    export_file, _, _ = exports.export_books("CSV", **filters)
+    with export_file:
+        while export_file.read(1024 * 1024):
+            pass
+
+
+def scaling_sample():
+    """Pick the filter values and searches the scaling cases use from the loaded catalog
+
+    They come from one book of the catalog, so every size gets comparable work.
+    """
+    with database.connection() as conn:
+        book = dict(conn.execute("SELECT * FROM books ORDER BY id LIMIT 1 OFFSET 100").fetchone())
+    word = max(database.normalize_words(book['title']), key=len)
+    surname = database.normalize_words(book['author'])[-1]
+    return {
+        'genre': book['genre'],
+        'age_group': book['age_group'],
+        'search_query': word,
+        'misspelled': " ".join(misspell(w, random.Random(0)) if len(w) > 3 else w for w in (word, surname)),
+        'title': book['title'].lower(),
+        'author': book['author'],
+    }
+
+
+def scaling_cases(sample):
+    """Yield (name, func) for each catalog read and render path the app runs"""
+    import utils
+
+    genre, age_group, word = sample['genre'], sample['age_group'], sample['search_query']
+    page_ids = tuple(book['id'] for book in database.get_books_page()[0])
+
+    yield "get_all_genres", database.get_all_genres
+    yield "get_collection_stats", database.get_collection_stats
+    yield "get_books_page()", database.get_books_page
+    yield "get_books_page(genre, age_group)", lambda: database.get_books_page(genre, age_group)
+    yield "get_books_page(search_query)", lambda: database.get_books_page(search_query=word)
+    yield "get_books_page(available_only)", lambda: database.get_books_page(available_only=True)
+    yield "count_books()", database.count_books
+    yield "count_books(genre, age_group)", lambda: database.count_books(genre, age_group)
+    yield "count_books(search_query)", lambda: database.count_books(search_query=word)
+    yield "count_books(available_only)", lambda: database.count_books(available_only=True)
+    yield "get_books_by_filter(genre)", lambda: database.get_books_by_filter(genre)
+    yield "get_books_by_filter(search_query)", lambda: database.get_books_by_filter(search_query=word)
+    yield "get_all_books", database.get_all_books
+    yield "get_books_fuzzy(misspelled)", lambda: database.get_books_fuzzy(sample['misspelled'])
+    yield "find_duplicates", lambda: database.find_duplicates(sample['title'], sample['author'])
+    yield "get_availability(page)", lambda: database.get_availability(page_ids)
+    yield "render collection chart", render_collection_chart
+    yield "render card grid (page)", lambda: utils.book_grid_html(database.get_books_page()[0])
+    yield "export CSV (genre)", lambda: export_csv(genre=genre)
+    yield "export CSV (whole catalog)", export_csv
+
+
+def compare_scaling(results, baseline, tolerance):
+    """Print the change from a baseline run; return the regressions found
+
+    A case regresses when its median time or peak memory grew by more than
+    ``tolerance`` (1.0 is a doubling) and by more than 1 ms or 1 MiB, so
+    tiny, noisy cases do not fail the comparison.
+    """
+    regressions = []
+    for size, run in results['sizes'].items():
+        before = baseline['sizes'].get(size)
+        if before is None:
+            print(f"{size} books: not in the baseline")
+            continue
+        print(f"{size} books vs baseline")
+        print(f"  {'case':<36} {'p50':>8} {'memory':>8}")
+        for name, result in run['cases'].items():
+            old = before['cases'].get(name)
+            if old is None:
+                print(f"  {name:<36} new")
+                continue
+            changes = []
+            for key, slack in (('p50_ms', 1.0), ('peak_kib', 1024.0)):
+                change = (result[key] - old[key]) / old[key] if old[key] else 0.0
+                if change > tolerance and result[key] - old[key] > slack:
+                    regressions.append(f"{size} books: {name} {key} {old[key]} -> {result[key]}")
+                changes.append(change)
+            print(f"  {name:<36} {changes[0]:+8.0%} {changes[1]:+8.0%}")
+    return regressions
+
+
+def bench_scaling(args):
+    """Time every catalog read and render path at growing catalog sizes
+
+    Each size gets a fresh database bulk loaded with the same synthetic
+    catalog. Timings are of cold queries, with the result cache off. The
+    results are written to ``--output`` as JSON; pass an earlier file as
+    ``--baseline`` to fail on regressions.
+    """
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {
+        'generated_at': time.time(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'sizes': {},
+    }
+    database.USE_QUERY_CACHE = False
+    try:
+        for size in args.sizes:
+            with temporary_database() as db_file:
+                start = time.perf_counter()
+                load_synthetic_catalog(size, seed=args.seed)
+                shelve_synthetic_copies()
+                load_seconds = time.perf_counter() - start
+                sample = scaling_sample()
+                run = {
+                    'load_seconds': round(load_seconds, 2),
+                    'database_bytes': os.path.getsize(db_file),
+                    'sample': sample,
+                    'cases': {},
+                }
+                print(f"{size} books, loaded in {load_seconds:.1f}s, "
+                      f"{run['database_bytes'] / 2 ** 20:.0f} MiB on disk")
+                print(f"  genre={sample['genre']!r}, age_group={sample['age_group']!r}, "
+                      f"search_query={sample['search_query']!r}, misspelled={sample['misspelled']!r}")
+                print(f"  {'case':<36} {'p50 ms':>9} {'p95 ms':>9} {'calls/s':>9} {'peak MiB':>9}")
+                for name, func in scaling_cases(sample):
+                    result = measure(func, args.repeat, args.budget)
+                    run['cases'][name] = result
+                    print(f"  {name:<36} {result['p50_ms']:9.2f} {result['p95_ms']:9.2f} "
+                          f"{result['per_second']:9.1f} {result['peak_kib'] / 1024:9.1f}")
+            results['sizes'][str(size)] = run
+    finally:
+        database.USE_QUERY_CACHE = True
+
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump(results, output, indent=1)
+    print(f"results written to {args.output}")
+
+    if baseline is not None:
+        regressions = compare_scaling(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"  FAIL {regression}")
+        if regressions:
+            raise SystemExit(f"{len(regressions)} case(s) regressed against {args.baseline}")
+
+
+APP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+API_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api.py")
+
+# What simulated patrons do between page loads, with their relative weights
+SESSION_ACTIONS = (
+    ("filter", 3),
+    ("search", 3),
+    ("available", 1),
+    ("next page", 2),
+    ("suggest", 1),
+    ("book visit", 1),
+)
+
+
+def widget(elements, label):
+    """The AppTest widget with ``label`` among ``elements``, or None"""
+    return next((element for element in elements if element.label == label), None)
+
+
+def patron_action(app, action, rng, words):
+    """Set up one patron action on an AppTest app; the caller runs it
+
+    Returns the action taken: "next page" falls back to "filter" when the
+    results fit on one page.
+    """
+    if action == "next page":
+        button = widget(app.button, "Next →")
+        if button is None or button.disabled:
+            action = "filter"
+        else:
+            button.click()
+    if action == "filter":
+        genre = widget(app.selectbox, "Select Genre")
+        genre.select_index(rng.randrange(len(genre.options)))
+        age_group = widget(app.radio, "Select Age Group")
+        age_group.set_value(rng.choice(age_group.options))
+    elif action == "search":
+        query = " ".join(rng.sample(words, rng.randint(1, 2))) if rng.random() < 0.8 else ""
+        widget(app.text_input, "Search by title, author or description").set_value(query)
+    elif action == "available":
+        available = widget(app.checkbox, "Available now")
+        available.set_value(not available.value)
+    elif action == "suggest":
+        title = " ".join(word.title() for word in rng.sample(words, rng.randint(1, 3)))
+        widget(app.text_input, "Book Title").set_value(title)
+        widget(app.text_input, "Author").set_value(f"{rng.choice(words).title()} {rng.choice(SURNAMES)}")
+        widget(app.button, "Submit Suggestion").click()
+    elif action == "book visit":
+        name = f"{rng.choice(words).title()} {rng.choice(SURNAMES)}"
+        widget(app.text_input, "Full Name").set_value(name)
+        widget(app.text_input, "Email Address").set_value(f"{name.replace(' ', '.').lower()}@example.org")
+        widget(app.number_input, "Number of Visitors").set_value(rng.randint(1, 4))
+        widget(app.date_input, "Preferred Date").set_value(
+            datetime.date.today() + datetime.timedelta(days=rng.randrange(14))
+        )
+        widget(app.selectbox, "Preferred Time").select_index(rng.randrange(len(database.VISIT_SLOTS)))
+        widget(app.button, "Schedule Visit").click()
+    return action
+
+
+@contextmanager
+def shared_app_runtime():
+    """Let AppTest apps run in parallel threads
+
+    AppTest installs a mock Runtime singleton and sets the global.appTest
+    option at the start of each run and undoes both at the end, which
+    breaks runs still going on other threads. A Streamlit server has one
+    Runtime for all of its sessions, so while this is active the most
+    recently installed one stays in place and the option stays set. All
+    runs also share one script cache, as in a server, instead of each
+    compiling the app again.
+    """
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import local_script_runner
+    from streamlit.testing.v1.util import patch_config_options
+
+    saved = Runtime.__dict__['instance'], Runtime.__dict__['exists']
+    latest = []
+
+    def instance(cls):
+        if cls._instance is not None:
+            latest[:] = [cls._instance]
+        if not latest:
+            raise RuntimeError("Runtime hasn't been created!")
+        return latest[0]
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or bool(latest))
+    script_cache = ScriptCache()
+    local_script_runner.ScriptCache = lambda: script_cache
+    try:
+        with patch_config_options({"global.appTest": True}):
+            # Compile up front: Python 3.11's parser is not safe to run on
+            # several threads at once
+            script_cache.get_bytecode(APP_SCRIPT)
+            yield
+    finally:
+        Runtime.instance, Runtime.exists = saved
+        local_script_runner.ScriptCache = ScriptCache
+
+
+def drive_sessions(num_sessions, actions, words, seed):
+    """Run ``num_sessions`` patrons through the app at once
+
+    Each session loads the page, then runs ``actions`` random actions, one
+    rerun each. Returns a list of (action, ms) per rerun, a list of errors
+    and the wall time in seconds.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    timings = []
+    errors = []
+    barrier = threading.Barrier(num_sessions)
+
+    def session(index):
+        rng = random.Random(seed * 1000 + index)
+        app = AppTest.from_file(APP_SCRIPT, default_timeout=120)
+        barrier.wait()
+        action = "page load"
+        try:
+            for step in range(actions + 1):
+                if step:
+                    action = patron_action(app, rng.choices(*zip(*SESSION_ACTIONS))[0], rng, words)
+                start = time.perf_counter()
+                app.run()
+                timings.append((action, (time.perf_counter() - start) * 1000))
+                errors.extend(f"{action}: {exception.value}" for exception in app.exception)
+        except Exception as e:  # A widget went missing because the page broke
+            errors.append(f"session {index} stopped at {action}: {e!r}")
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(num_sessions)]
+    start = time.perf_counter()
+    with shared_app_runtime():
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return timings, errors, time.perf_counter() - start
+
+
+def bench_sessions(args):
+    """Drive concurrent headless app sessions and report rerun latency as they grow
+
+    Sessions are Streamlit AppTest instances in threads of this one process,
+    as browser sessions are in a Streamlit server. Lock wait is the time
+    writers spent in BEGIN IMMEDIATE waiting for SQLite's write lock.
+    """
+    import recommendations
+    import logging
+
+    # Streamlit logs its deprecation notices for the app on every rerun, and
+    # warns about the session threads, which AppTest gives their own context
+    logging.getLogger("streamlit.deprecation_util").disabled = True
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").disabled = True
+    original_metrics_file = instrumentation.METRICS_FILE
+    results = []
+    with temporary_database() as db_file:
+        instrumentation.METRICS_FILE = os.path.join(os.path.dirname(db_file), "metrics.json")
+        try:
+            load_synthetic_catalog(args.rows)
+            shelve_synthetic_copies()
+            with database.connection() as conn:
+                titles = [row[0] for row in conn.execute("SELECT title FROM books ORDER BY random() LIMIT 500")]
+            words = sorted({word for title in titles for word in database.normalize_words(title)})
+            # Catch up on the work the app's background threads would find after
+            # the load, so they do not hold the write lock during the runs
+            recommendations.refresh_similar_books()
+            events.rollup_popularity()
+            drive_sessions(1, 1, words, args.seed)  # Warm up imports and caches
+
+            print(f"{args.rows} books, {args.actions} actions per session after the first page load")
+            print(f"  {'sessions':>8} {'reruns':>7} {'reruns/s':>9} {'p50 ms':>9} {'p99 ms':>9} "
+                  f"{'lock waits':>10} {'lock ms':>9} {'lock p99':>9} {'errors':>7}")
+            for num_sessions in args.sessions:
+                instrumentation.reset()
+                timings, errors, elapsed = drive_sessions(num_sessions, args.actions, words, args.seed)
+                lock = instrumentation.snapshot()['timings'].get('sql.lock_wait', {})
+                latencies = sorted(ms for _, ms in timings)
+                p50 = latencies[len(latencies) // 2]
+                p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+                results.append((num_sessions, p99, timings, errors))
+                print(f"  {num_sessions:8} {len(timings):7} {len(timings) / elapsed:9.1f} {p50:9.1f} {p99:9.1f} "
+                      f"{lock.get('count', 0):10} {lock.get('total_ms', 0.0):9.1f} "
+                      f"{lock.get('p99_ms', 0.0):9.2f} {len(errors):7}")
+        finally:
+            instrumentation.METRICS_FILE = original_metrics_file
+
+    num_sessions, _, timings, _ = results[-1]
+    print(f"per action at {num_sessions} sessions:")
+    for action, _ in (("page load", 0),) + SESSION_ACTIONS:
+        latencies = [ms for name, ms in timings if name == action]
+        if latencies:
+            print(f"  {action:<11} {len(latencies):5} reruns, {percentiles(latencies)}")
+    within = [n for n, p99, _, _ in results if p99 <= args.max_p99]
+    if within:
+        print(f"p99 rerun latency stays within {args.max_p99:.0f} ms up to {max(within)} concurrent sessions")
+    else:
+        print(f"p99 rerun latency exceeds {args.max_p99:.0f} ms even at {results[0][0]} session(s)")
+
+    errors = [error for _, _, _, run_errors in results for error in run_errors]
+    for error in errors[:10]:
+        print(f"  FAIL {error}")
+    if errors:
+        raise SystemExit(f"{len(errors)} rerun(s) raised an exception")
+
+
+@contextmanager
+def api_server(db_file):
+    """Run api.py on a free port in a process of its own; yield the port"""
+    process = subprocess.Popen(
+        [sys.executable, API_SCRIPT, "--port", "0", "--db", db_file],
+        stdout=subprocess.PIPE, text=True
+    )
+    try:
+        line = process.stdout.readline()
+        if not line:
+            raise SystemExit("the API server did not start")
+        yield int(line.rsplit(":", 1)[1])
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def api_request(conn, method, path, headers=None, body=None):
+    """Send one request on an http.client connection; return (status, headers, body)"""
+    conn.request(method, path, body=body, headers=headers or {})
+    response = conn.getresponse()
+    return response.status, response.headers, response.read()
+
+
+def api_problems(port):
+    """Check the API's caching, encoding, paging and suggestion handling over one connection"""
+    problems = []
+
+    def expect(condition, problem):
+        if not condition:
+            problems.append(problem)
+
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    status, headers, body = api_request(conn, "GET", "/books")
+    sock = conn.sock
+    page = json.loads(body)
+    etag = headers['ETag']
+    expect(status == 200 and etag and len(page['books']) == database.PAGE_SIZE,
+           f"GET /books: {status}, ETag {etag}, {len(page['books'])} books")
+
+    status, headers, body = api_request(conn, "GET", "/books", {"If-None-Match": etag})
+    expect(status == 304 and not body, f"GET /books with its ETag: {status} and {len(body)} bytes, not an empty 304")
+
+    status, headers, zipped = api_request(conn, "GET", "/books", {"Accept-Encoding": "gzip"})
+    expect(headers['Content-Encoding'] == "gzip" and json.loads(gzip.decompress(zipped)) == page,
+           "gzipped GET /books differs from the plain one")
+
+    status, _, body = api_request(conn, "GET", f"/books?cursor={page['next_cursor']}")
+    expect(status == 200 and json.loads(body)['books'][0]['id'] not in {book['id'] for book in page['books']},
+           "the next page repeats books from the first")
+    status, _, _ = api_request(conn, "GET", "/books?cursor=not-a-cursor")
+    expect(status == 400, f"a bad cursor gave {status}, not 400")
+    status, _, _ = api_request(conn, "GET", f"/books?q=dragon&cursor={page['next_cursor']}")
+    expect(status == 400, f"a listing cursor sent with a search gave {status}, not 400")
+
+    suggestion = json.dumps({'title': "The Benchmark Api", 'author': "Ada Tester",
+                             'genre': "Fantasy", 'age_group': "Teens & Adults"})
+    status, _, body = api_request(conn, "POST", "/suggestions", {"Content-Type": "application/json"}, suggestion)
+    added = json.loads(body)
+    expect(status == 201 and added['status'] == "added", f"new suggestion: {status} {added}")
+    status, _, body = api_request(conn, "POST", "/suggestions", {"Content-Type": "application/json"}, suggestion)
+    expect(status == 200 and json.loads(body)['status'] == "already_suggested", f"repeated suggestion: {status} {body}")
+    status, _, _ = api_request(conn, "POST", "/suggestions", {}, '{"title": "No author"}')
+    expect(status == 400, f"a suggestion without an author gave {status}, not 400")
+    status, _, _ = api_request(conn, "POST", "/suggestions", {}, "not json")
+    expect(status == 400, f"a body that is not JSON gave {status}, not 400")
+
+    # Adding the suggested book to the catalog must invalidate the ETag
+    database.approve_suggestions([added['suggestion_id']])
+    status, headers, _ = api_request(conn, "GET", "/books", {"If-None-Match": etag})
+    expect(status == 200 and headers['ETag'] != etag, f"after a catalog change the old ETag gave {status}")
+    expect(conn.sock is sock, "the connection was not kept alive between requests")
+    conn.close()
+
+    # Read as "until the client closes", a negative length would hang the handler
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        status, _, _ = api_request(conn, "POST", "/suggestions", {"Content-Length": "-1"})
+    except TimeoutError:
+        status = "no answer"
+    expect(status == 400, f"a negative Content-Length gave {status}, not 400")
+    conn.close()
+    return problems
+
+
+def api_load(port, num_threads, seconds, paths, keep_alive, use_gzip, conditional):
+    """Request random ``paths`` from ``num_threads`` clients for ``seconds``
+
+    Returns the millisecond timings, the bytes received and a count of the
+    statuses. Conditional clients send back the last ETag of each path.
+    """
+    deadline = time.perf_counter() + seconds
+    timings = []
+    received = []
+    statuses = Counter()
+
+    def client(index):
+        rng = random.Random(index)
+        etags = {}
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        while time.perf_counter() < deadline:
+            path = rng.choice(paths)
+            headers = {} if keep_alive else {"Connection": "close"}
+            if use_gzip:
+                headers["Accept-Encoding"] = "gzip"
+            if conditional and path in etags:
+                headers["If-None-Match"] = etags[path]
+            start = time.perf_counter()
+            status, response_headers, body = api_request(conn, "GET", path, headers)
+            timings.append((time.perf_counter() - start) * 1000)
+            received.append(len(body))
+            statuses[status] += 1
+            if response_headers['ETag']:
+                etags[path] = response_headers['ETag']
+            if not keep_alive:
+                conn.close()
+        conn.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, received, statuses
+
+
+def bench_api(args):
+    """Check the JSON API, then time it with and without keep-alive, gzip and ETags
+
+    The server is api.py in its own process, as it would be deployed;
+    clients are threads of this process, each with one connection.
+    """
+    with temporary_database() as db_file:
+        load_synthetic_catalog(args.rows)
+        shelve_synthetic_copies()
+        genres = database.get_all_genres()
+        with database.connection() as conn:
+            titles = [row[0] for row in conn.execute("SELECT title FROM books ORDER BY random() LIMIT 20")]
+        # What kiosks ask for: the genre and age group listings and a few
+        # searches, each a handful of pages deep
+        paths = ["/genres", "/stats"]
+        for genre in genres:
+            for age_group in database.AGE_GROUPS:
+                paths.append("/books?" + urlencode({'genre': genre, 'age_group': age_group}))
+        paths += ["/books?" + urlencode({'q': title.split()[0]}) for title in titles]
+        paths += [f"/books?available=1&limit={limit}" for limit in (10, 30, 60)]
+
+        with api_server(db_file) as port:
+            problems = api_problems(port)
+            for problem in problems:
+                print(f"  FAIL {problem}")
+            if problems:
+                raise SystemExit("the API does not behave as documented")
+            print(f"{args.rows} books, {len(paths)} distinct URLs, {args.threads} clients, {args.seconds:.1f}s each")
+            print("  ok: ETags give 304s and change with the catalog, gzip, paging and suggestions work")
+            for label, keep_alive, use_gzip, conditional in (
+                ("new connection per request", False, False, False),
+                ("keep-alive", True, False, False),
+                ("keep-alive, gzip", True, True, False),
+                ("keep-alive, gzip, If-None-Match", True, True, True),
+            ):
+                timings, received, statuses = api_load(port, args.threads, args.seconds, paths,
+                                                       keep_alive, use_gzip, conditional)
+                print(f"  {label:<32} {len(timings) / args.seconds:8.0f} requests/s, "
+                      f"{sum(received) / len(received):7.0f} bytes/response, {percentiles(timings)}, "
+                      f"statuses {dict(sorted(statuses.items()))}")
+
+
+ASYNC_SLOW_QUERY = """
+WITH RECURSIVE counter(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM counter WHERE n < 100000000)
+SELECT count(*) FROM counter
+"""
+
+
+def run_slow_query():
+    """A read that keeps SQLite busy for many seconds unless interrupted"""
+    with database.connection() as conn:
+        return conn.execute(ASYNC_SLOW_QUERY).fetchone()[0]
+
+
+async def async_problems():
+    """Check that timeouts interrupt running reads and cancelled writes never run"""
+    problems = []
+    start = time.perf_counter()
+    try:
+        await async_database.run_read(run_slow_query, timeout=0.1)
+        problems.append("the slow read finished inside its timeout")
+    except TimeoutError:
+        pass
+    # Every reader must be free again, so this waits for none of them
+    await asyncio.gather(*(async_database.get_all_genres() for _ in range(async_database.READER_THREADS)))
+    if time.perf_counter() - start > 1.0:
+        problems.append(f"a timed-out read held its reader for {time.perf_counter() - start:.1f}s")
+
+    # A suggestion cancelled while queued behind a write must not be stored
+    blocker = asyncio.ensure_future(async_database.run_write(time.sleep, 0.2))
+    queued = asyncio.ensure_future(async_database.add_book_suggestion(
+        "The Cancelled Suggestion", "Ada Tester", "Fantasy", "Teens & Adults", "", ""))
+    await asyncio.sleep(0.05)
+    queued.cancel()
+    await blocker
+    with database.connection() as conn:
+        stored = conn.execute("SELECT COUNT(*) FROM suggestions WHERE title = 'The Cancelled Suggestion'").fetchone()[0]
+    if stored:
+        problems.append("a suggestion cancelled in the writer queue was stored")
+    return problems
+
+
+async def measure_loop_lag(stop, interval=0.005):
+    """Return the longest the event loop overslept a ``interval`` sleep, in ms, until ``stop`` is set"""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst * 1000
+
+
+async def async_load(mode, concurrency, requests, words, genres, seed):
+    """Serve ``requests`` catalog requests, ``concurrency`` at a time, the way ``mode`` says
+
+    One request in ten suggests a new book; the rest list a genre, search or
+    fetch the genres. Returns the request timings in ms, the wall time, the
+    worst event loop lag and the errors by type.
+    """
+    rng = random.Random(seed)
+    calls = []
+    for i in range(requests):
+        roll = rng.random()
+        if roll < 0.1:
+            calls.append((True, database.add_book_suggestion,
+                          (f"{rng.choice(words).title()} Async {seed}-{i}", f"Writer {i}", rng.choice(genres),
+                           rng.choice(database.AGE_GROUPS), "", "")))
+        elif roll < 0.5:
+            calls.append((False, database.get_books_by_filter, (rng.choice(genres), rng.choice(database.AGE_GROUPS))))
+        elif roll < 0.9:
+            calls.append((False, database.get_books_by_filter, (None, None, rng.choice(words))))
+        else:
+            calls.append((False, database.get_all_genres, ()))
+
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+    errors = Counter()
+
+    async def serve(is_write, func, args):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                if mode == "blocking":
+                    func(*args)
+                elif mode == "to_thread":
+                    await asyncio.to_thread(func, *args)
+                elif is_write:
+                    await async_database.run_write(func, *args)
+                else:
+                    await async_database.run_read(func, *args)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            timings.append((time.perf_counter() - start) * 1000)
+
+    stop = asyncio.Event()
+    lag = asyncio.ensure_future(measure_loop_lag(stop))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*(serve(*call) for call in calls))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return timings, elapsed, await lag, errors
+
+
+def bench_async(args):
+    """Compare async_database with blocking and to_thread calls under many concurrent requests
+
+    "blocking" calls database.py straight from coroutines, as a naive async
+    server would; "to_thread" hands every call to asyncio's default executor,
+    writes included. Query caching is off so each request reaches SQLite.
+    A blocking call never waits for the loop once it starts, so its latency
+    leaves out the time it queued behind the others; the loop lag, how late
+    a 5 ms sleep wakes up, shows what every other coroutine waited.
+    """
+    with temporary_database():
+        load_synthetic_catalog(args.rows)
+        shelve_synthetic_copies()
+        genres = database.get_all_genres()
+        with database.connection() as conn:
+            titles = [row[0] for row in conn.execute("SELECT title FROM books ORDER BY random() LIMIT 200")]
+        words = sorted({word for title in titles for word in database.normalize_words(title) if len(word) > 3})
+
+        problems = asyncio.run(async_problems())
+        for problem in problems:
+            print(f"  FAIL {problem}")
+        if problems:
+            raise SystemExit("async_database does not cancel calls as documented")
+        print("  ok: timeouts interrupt running reads and cancelled writes never run")
+
+        database.USE_QUERY_CACHE = False
+        try:
+            print(f"{args.rows} books, {args.requests} requests per run, 10% of them suggestions")
+            for concurrency in args.concurrency:
+                for mode in ("blocking", "to_thread", "async_database"):
+                    timings, elapsed, lag, errors = asyncio.run(
+                        async_load(mode, concurrency, args.requests, words, genres, args.seed + concurrency))
+                    print(f"  {concurrency:5} concurrent, {mode:<15} {len(timings) / elapsed:7.0f} requests/s, "
+                          f"{percentiles(timings)}, loop lag {lag:7.1f} ms"
+                          + (f", errors {dict(errors)}" if errors else ""))
+        finally:
+            database.USE_QUERY_CACHE = True
+            async_database.shutdown()
+
+
+def snapshot_problems():
+    """Check that an approved book reaches snapshot reads within a few refreshes"""
+    problems = []
+    before = database.get_catalog_version()
+    result = database.add_book_suggestion("Qwertyuiop Snapshot", "Ada Tester", "Fantasy", "Teens & Adults", "", "")
+    database.approve_suggestions([result['suggestion_id']])
+    if database.get_books_by_filter(search_query="qwertyuiop"):
+        problems.append("a snapshot read saw a write before the snapshot was renewed")
+    deadline = time.monotonic() + 3 * database.SNAPSHOT_REFRESH_SECONDS + 1.0
+    while database.get_catalog_version() == before and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if database.get_catalog_version() == before:
+        problems.append("the snapshot was not renewed after the catalog changed")
+    elif not database.get_books_by_filter(search_query="qwertyuiop"):
+        problems.append("the renewed snapshot is missing the approved book")
+    return problems
+
+
+def snapshot_load(num_readers, num_writers, seconds, words, genres, write_interval, seed=0):
+    """Run catalog reads on ``num_readers`` threads while ``num_writers`` threads write
+
+    Writers suggest a new book every ``write_interval`` seconds and approve
+    one suggestion in ten, which changes the catalog. Returns the read
+    timings in ms, the writes by kind and the errors by type.
+    """
+    deadline = time.perf_counter() + seconds
+    timings = []
+    writes = Counter()
+    errors = Counter()
+
+    def reader(index):
+        rng = random.Random(f"{seed}-reader-{index}")
+        while time.perf_counter() < deadline:
+            roll = rng.random()
+            start = time.perf_counter()
+            try:
+                if roll < 0.4:
+                    database.get_books_page(rng.choice(genres), rng.choice(database.AGE_GROUPS))
+                    database.count_books(rng.choice(genres), rng.choice(database.AGE_GROUPS))
+                elif roll < 0.8:
+                    database.get_books_page(search_query=rng.choice(words))
+                elif roll < 0.9:
+                    database.get_books_fuzzy(rng.choice(words)[:-1] + "x")
+                else:
+                    database.get_collection_stats()
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            timings.append((time.perf_counter() - start) * 1000)
+
+    def writer(index):
+        rng = random.Random(f"{seed}-writer-{index}")
+        count = 0
+        while time.perf_counter() < deadline:
+            count += 1
+            # Titles and authors of random words, so few look like duplicates
+            title = " ".join(rng.sample(words, 3)).title()
+            author = " ".join(rng.sample(words, 2)).title()
+            try:
+                result = database.add_book_suggestion(title, author, rng.choice(genres),
+                                                      rng.choice(database.AGE_GROUPS), "", "")
+                writes['suggestion'] += 1
+                if count % 10 == 0 and result['status'] == 'added':
+                    database.approve_suggestions([result['suggestion_id']])
+                    writes['approval'] += 1
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            time.sleep(write_interval)
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(num_readers)]
+    threads += [threading.Thread(target=writer, args=(i,)) for i in range(num_writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, writes, errors
+
+
+def bench_snapshot(args):
+    """Compare catalog read latency from disk and from the in-memory snapshot, with and without writers
+
+    Query caching is off so every read reaches SQLite.
+    """
+    with temporary_database():
+        load_synthetic_catalog(args.rows)
+        shelve_synthetic_copies()
+        genres = database.get_all_genres()
+        with database.connection() as conn:
+            titles = [row[0] for row in conn.execute("SELECT title FROM books ORDER BY random() LIMIT 200")]
+        words = sorted({word for title in titles for word in database.normalize_words(title) if len(word) > 3})
+
+        database.USE_MEMORY_SNAPSHOT = True
+        try:
+            problems = snapshot_problems()
+            for problem in problems:
+                print(f"  FAIL {problem}")
+            if problems:
+                raise SystemExit("snapshot reads do not follow the catalog as documented")
+            print("  ok: snapshot reads see a catalog change only once the snapshot is renewed, within a refresh")
+
+            database.USE_QUERY_CACHE = False
+            print(f"{args.rows} books, {args.readers} readers, {args.seconds:.0f}s per run; "
+                  f"writers suggest every {args.write_interval * 1000:.0f} ms and approve one in ten")
+            for run, (use_snapshot, num_writers) in enumerate(itertools.product((False, True), (0, args.writers))):
+                database.USE_MEMORY_SNAPSHOT = use_snapshot
+                database.close_snapshot()
+                if use_snapshot:
+                    database.get_snapshot()
+                instrumentation.reset()
+                timings, writes, errors = snapshot_load(args.readers, num_writers, args.seconds, words, genres,
+                                                        args.write_interval, seed=run)
+                timings_ms = instrumentation.snapshot()['timings']
+                line = (f"  {'snapshot' if use_snapshot else 'disk':<8} {num_writers} writers: "
+                        f"{len(timings) / args.seconds:6.0f} reads/s, {percentiles(timings)}")
+                if num_writers:
+                    lock_wait = timings_ms.get("sql.lock_wait", {})
+                    line += (f"; {sum(writes.values()) / args.seconds:4.0f} writes/s, "
+                             f"lock wait p99 {lock_wait.get('p99_ms', 0.0):.1f} ms")
+                refreshes = timings_ms.get("database.take_snapshot")
+                if refreshes:
+                    line += f", {refreshes['count']} snapshots taken, {refreshes['mean_ms']:.0f} ms each"
+                if errors:
+                    line += f", errors {dict(errors)}"
+                print(line)
+        finally:
+            database.USE_QUERY_CACHE = True
+            database.USE_MEMORY_SNAPSHOT = False
+            database.close_snapshot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    pool_parser = subparsers.add_parser("pool", help=bench_pool.__doc__)
+    pool_parser.add_argument("--threads", type=int, default=8)
+    pool_parser.add_argument("--seconds", type=float, default=3.0)
+    pool_parser.set_defaults(func=bench_pool)
+
+    cache_parser = subparsers.add_parser("cache", help=bench_cache.__doc__)
+    cache_parser.add_argument("--threads", type=int, default=8)
+    cache_parser.add_argument("--seconds", type=float, default=3.0)
+    cache_parser.add_argument("--rows", type=int, default=5000)
+    cache_parser.set_defaults(func=bench_cache)
+
+    instrumentation_parser = subparsers.add_parser("instrumentation", help=bench_instrumentation.__doc__)
+    instrumentation_parser.add_argument("--threads", type=int, default=8)
+    instrumentation_parser.add_argument("--seconds", type=float, default=3.0)
+    instrumentation_parser.add_argument("--rows", type=int, default=5000)
+    instrumentation_parser.add_argument("--rounds", type=int, default=3)
+    instrumentation_parser.set_defaults(func=bench_instrumentation)
+
+    startup_parser = subparsers.add_parser("startup", help=bench_startup.__doc__)
+    startup_parser.add_argument("--repeat", type=int, default=200)
+    startup_parser.set_defaults(func=bench_startup)
+
+    render_parser = subparsers.add_parser("render", help=bench_render.__doc__)
+    render_parser.add_argument("--books", type=int, default=60)
+    render_parser.add_argument("--repeat", type=int, default=5)
+    render_parser.set_defaults(func=bench_render)
+
+    plans_parser = subparsers.add_parser("plans", help=check_plans.__doc__)
+    plans_parser.add_argument("--rows", type=int, default=5000)
+    plans_parser.set_defaults(func=check_plans)
+
+    fuzzy_parser = subparsers.add_parser("fuzzy", help=bench_fuzzy.__doc__)
+    fuzzy_parser.add_argument("--rows", type=int, default=100000)
+    fuzzy_parser.add_argument("--queries", type=int, default=200)
+    fuzzy_parser.set_defaults(func=bench_fuzzy)
+
+    similar_parser = subparsers.add_parser("similar", help=bench_similar.__doc__)
+    similar_parser.add_argument("--rows", type=int, default=20000)
+    similar_parser.add_argument("--add", type=int, default=100)
+    similar_parser.add_argument("--repeat", type=int, default=200)
+    similar_parser.set_defaults(func=bench_similar)
+
+    duplicates_parser = subparsers.add_parser("duplicates", help=bench_duplicates.__doc__)
+    duplicates_parser.add_argument("--rows", type=int, default=100000)
+    duplicates_parser.add_argument("--suggestions", type=int, default=1000)
+    duplicates_parser.set_defaults(func=bench_duplicates)
+
+    approve_parser = subparsers.add_parser("approve", help=bench_approve.__doc__)
+    approve_parser.add_argument("--rows", type=int, default=20000)
+    approve_parser.add_argument("--suggestions", type=int, default=5000)
+    approve_parser.set_defaults(func=bench_approve)
+
+    visits_parser = subparsers.add_parser("visits", help=bench_visits.__doc__)
+    visits_parser.add_argument("--processes", type=int, default=4)
+    visits_parser.add_argument("--threads", type=int, default=8)
+    visits_parser.add_argument("--bookings", type=int, default=5)
+    visits_parser.set_defaults(func=bench_visits)
+
+    circulation_parser = subparsers.add_parser("circulation", help=bench_circulation.__doc__)
+    circulation_parser.add_argument("--processes", type=int, default=4)
+    circulation_parser.add_argument("--threads", type=int, default=8)
+    circulation_parser.add_argument("--operations", type=int, default=50)
+    circulation_parser.add_argument("--titles", type=int, default=5)
+    circulation_parser.add_argument("--copies", type=int, default=3)
+    circulation_parser.set_defaults(func=bench_circulation)
+
+    events_parser = subparsers.add_parser("events", help=bench_events.__doc__)
+    events_parser.add_argument("--rows", type=int, default=100000)
+    events_parser.add_argument("--threads", type=int, default=8)
+    events_parser.add_argument("--pages", type=int, default=200)
+    events_parser.add_argument("--events", type=int, default=1000000)
+    events_parser.set_defaults(func=bench_events)
+
+    scaling_parser = subparsers.add_parser("scaling", help=bench_scaling.__doc__.splitlines()[0])
+    scaling_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    scaling_parser.add_argument("--seed", type=int, default=0)
+    scaling_parser.add_argument("--repeat", type=int, default=20)
+    scaling_parser.add_argument("--budget", type=float, default=5.0, help="seconds of timed calls per case")
+    scaling_parser.add_argument("--output", default="scaling.json")
+    scaling_parser.add_argument("--baseline", help="earlier --output file to compare against")
+    scaling_parser.add_argument("--tolerance", type=float, default=1.0,
+                                help="allowed growth before a case fails, as a fraction")
+    scaling_parser.set_defaults(func=bench_scaling)
+
+    generate_parser = subparsers.add_parser("generate", help=generate_catalog.__doc__)
+    generate_parser.add_argument("--books", type=int, default=100000)
+    generate_parser.add_argument("--seed", type=int, default=0)
+    generate_parser.add_argument("--output", default="catalog.jsonl")
+    generate_parser.set_defaults(func=generate_catalog)
+
+    sessions_parser = subparsers.add_parser("sessions", help=bench_sessions.__doc__.splitlines()[0])
+    sessions_parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    sessions_parser.add_argument("--actions", type=int, default=20)
+    sessions_parser.add_argument("--rows", type=int, default=20000)
+    sessions_parser.add_argument("--seed", type=int, default=0)
+    sessions_parser.add_argument("--max-p99", type=float, default=1000.0,
+                                 help="rerun latency in ms a session should stay within")
+    sessions_parser.set_defaults(func=bench_sessions)
+
+    api_parser = subparsers.add_parser("api", help=bench_api.__doc__.splitlines()[0])
+    api_parser.add_argument("--rows", type=int, default=20000)
+    api_parser.add_argument("--threads", type=int, default=8)
+    api_parser.add_argument("--seconds", type=float, default=3.0)
+    api_parser.set_defaults(func=bench_api)
+
+    async_parser = subparsers.add_parser("async", help=bench_async.__doc__.splitlines()[0])
+    async_parser.add_argument("--rows", type=int, default=20000)
+    async_parser.add_argument("--requests", type=int, default=2000)
+    async_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100, 1000])
+    async_parser.add_argument("--seed", type=int, default=0)
+    async_parser.set_defaults(func=bench_async)
+
+    snapshot_parser = subparsers.add_parser("snapshot", help=bench_snapshot.__doc__.splitlines()[0])
+    snapshot_parser.add_argument("--rows", type=int, default=20000)
+    snapshot_parser.add_argument("--readers", type=int, default=4)
+    snapshot_parser.add_argument("--writers", type=int, default=2)
+    snapshot_parser.add_argument("--write-interval", type=float, default=0.02)
+    snapshot_parser.add_argument("--seconds", type=float, default=5.0)
+    snapshot_parser.set_defaults(func=bench_snapshot)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
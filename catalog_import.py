@@ -0,0 +1,209 @@
+"""Streaming bulk import of the library catalog from CSV or JSONL exports
+
+Rows are read one at a time, validated, and upserted into ``books`` in batched
+transactions keyed on (title, author), so memory stays flat however large the
+input is. Run with:
+
+    python catalog_import.py catalog.csv --rejects rejects.jsonl
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import database
+
+# Number of rows written per transaction
+BATCH_SIZE = 5000
+
+# Longest accepted value for each text field
+MAX_FIELD_LENGTHS = {
+    'title': 300,
+    'author': 200,
+    'genre': 100,
+    'description': 5000,
+    'cover_url': 2000,
+}
+
+REQUIRED_FIELDS = ('title', 'author', 'genre', 'age_group')
+
+
+def read_csv(path):
+    """Yield (line_number, row) pairs from a CSV file with a header row"""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def read_jsonl(path):
+    """Yield (line_number, row) pairs from a JSON Lines file
+
+    Lines that are not JSON objects are yielded as their error message so the
+    importer can report them as rejected rows.
+    """
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, f"invalid JSON: {e.msg}"
+                continue
+            if not isinstance(row, dict):
+                yield line_number, "expected a JSON object"
+                continue
+            yield line_number, row
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+def detect_format(path):
+    """Guess the input format from the file extension"""
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    if extension in ('json', 'ndjson'):
+        return 'jsonl'
+    if extension not in READERS:
+        raise ValueError(f"cannot tell the format of {path!r}; pass --format")
+    return extension
+
+
+def validate_book(row):
+    """Return a clean book dict for ``books``, or raise ValueError"""
+    book = {}
+    for field in ('title', 'author', 'genre', 'age_group', 'description', 'cover_url'):
+        value = row.get(field)
+        book[field] = str(value).strip() if value is not None else ''
+
+    missing = [field for field in REQUIRED_FIELDS if not book[field]]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+
+    if book['age_group'] not in database.AGE_GROUPS:
+        raise ValueError(f"unknown age_group {book['age_group']!r}")
+
+    for field, max_length in MAX_FIELD_LENGTHS.items():
+        if len(book[field]) > max_length:
+            raise ValueError(f"{field} longer than {max_length} characters")
+
+    if book['cover_url'] and not book['cover_url'].startswith(('http://', 'https://')):
+        raise ValueError("cover_url must be an http(s) URL")
+
+    popularity = row.get('popularity')
+    if popularity in (None, ''):
+        book['popularity'] = 0
+    else:
+        try:
+            book['popularity'] = int(popularity)
+        except (TypeError, ValueError):
+            raise ValueError(f"popularity {popularity!r} is not an integer") from None
+        if not 0 <= book['popularity'] <= 5:
+            raise ValueError("popularity must be between 0 and 5")
+
+    book['description'] = book['description'] or None
+    book['cover_url'] = book['cover_url'] or None
+    return book
+
+
+def import_catalog(path, file_format=None, batch_size=BATCH_SIZE, defer_indexes=True,
+                   rejects_file=None, progress=None):
+    """Import books from a CSV or JSONL file and return a summary dict
+
+    Each rejected row is written to ``rejects_file`` (if given) as a JSON line
+    with its line number and reason. ``progress`` is called with the running
+    summary after every committed batch.
+    """
+    reader = READERS[file_format or detect_format(path)]
+    summary = {'read': 0, 'inserted': 0, 'updated': 0, 'rejected': 0, 'seconds': 0.0}
+    start = time.perf_counter()
+
+    def write_batch(conn, batch):
+        conn.execute("BEGIN IMMEDIATE")
+        inserted, updated = database.upsert_books(conn, batch)
+        conn.commit()
+        summary['inserted'] += inserted
+        summary['updated'] += updated
+        summary['seconds'] = time.perf_counter() - start
+        if progress:
+            progress(summary)
+
+    def load(conn):
+        batch = []
+        for line_number, row in reader(path):
+            summary['read'] += 1
+            try:
+                if isinstance(row, str):
+                    raise ValueError(row)
+                batch.append(validate_book(row))
+            except ValueError as e:
+                summary['rejected'] += 1
+                if rejects_file:
+                    rejects_file.write(json.dumps({'line': line_number, 'reason': str(e)}) + "\n")
+                continue
+            if len(batch) >= batch_size:
+                write_batch(conn, batch)
+                batch = []
+        if batch:
+            write_batch(conn, batch)
+
+    database.initialize_database()
+    with database.connection() as conn:
+        if defer_indexes:
+            with database.bulk_load(conn):
+                load(conn)
+        else:
+            load(conn)
+
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def format_summary(summary):
+    """Describe import progress in one line"""
+    rate = summary['read'] / summary['seconds'] if summary['seconds'] else 0.0
+    return (
+        f"{summary['read']} rows read, {summary['inserted']} inserted, "
+        f"{summary['updated']} updated, {summary['rejected']} rejected "
+        f"in {summary['seconds']:.1f}s ({rate:,.0f} rows/s)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="CSV or JSONL file to import")
+    parser.add_argument("--format", choices=sorted(READERS), help="input format (default: from extension)")
+    parser.add_argument("--db", default=database.DB_FILE, help="database file to import into")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--rejects", help="write rejected rows to this JSONL file")
+    parser.add_argument(
+        "--live-indexes", action="store_true",
+        help="keep search index and triggers updating row by row (for small imports into a busy catalog)"
+    )
+    args = parser.parse_args()
+
+    database.DB_FILE = args.db
+    rejects_file = open(args.rejects, "w", encoding="utf-8") if args.rejects else None
+    try:
+        summary = import_catalog(
+            args.path,
+            file_format=args.format,
+            batch_size=args.batch_size,
+            defer_indexes=not args.live_indexes,
+            rejects_file=rejects_file,
+            progress=lambda summary: print(format_summary(summary), file=sys.stderr)
+        )
+    finally:
+        if rejects_file:
+            rejects_file.close()
+    print(format_summary(summary))
+
+
+if __name__ == "__main__":
+    main()
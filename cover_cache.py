@@ -0,0 +1,300 @@
+import collections
+import contextlib
+import functools
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Without Pillow covers are simply not cached locally
+    Image = None
+
+# Whether covers can be cached; thumbnails need Pillow
+CACHE_AVAILABLE = Image is not None
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Downloaded originals, named by the SHA-256 of their URL
+ORIGINALS_DIR = os.path.join(APP_DIR, ".cover_cache")
+
+# Thumbnails live under Streamlit's static directory so the browser can load
+# them from the app itself (requires server.enableStaticServing)
+THUMBNAIL_DIR = os.path.join(APP_DIR, "static", "covers")
+THUMBNAIL_URL_PREFIX = "app/static/covers"
+
+# Thumbnail size in pixels: the card cover area at 2x for high-DPI screens
+THUMBNAIL_SIZE = (480, 300)
+THUMBNAIL_QUALITY = 80
+
+# Total disk space for originals and thumbnails before the least recently
+# used covers are evicted
+MAX_CACHE_BYTES = 200 * 1024 * 1024
+
+# Covers larger than this are not downloaded
+MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024
+
+DOWNLOAD_TIMEOUT = 10
+DOWNLOAD_WORKERS = 4
+
+# Seconds to wait before retrying a cover whose download failed
+FAILED_RETRY_SECONDS = 600
+
+# Seconds between rescans of the cache directories, which pick up covers
+# fetched or evicted by another process such as cover_worker.py
+RESCAN_SECONDS = 60
+
+# Covers are only ever fetched over the web; file:// and friends would let a
+# cover URL read files on the server into the publicly served thumbnails
+ALLOWED_SCHEMES = ("http", "https")
+
+def is_remote_url(url):
+    """Whether a cover URL is an http(s) URL the cache may fetch"""
+    return urllib.parse.urlsplit(url).scheme.lower() in ALLOWED_SCHEMES
+
+class _RemoteRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follow redirects only to other http(s) URLs"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if not is_remote_url(newurl):
+            raise urllib.error.HTTPError(newurl, code, f"redirect to a non-http(s) URL: {newurl}", headers, fp)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+_opener = urllib.request.build_opener(_RemoteRedirectHandler)
+
+def open_url(url_or_request, timeout=DOWNLOAD_TIMEOUT):
+    """urlopen() for http(s) URLs only; raises ValueError for any other scheme"""
+    url = getattr(url_or_request, 'full_url', url_or_request)
+    if not is_remote_url(url):
+        raise ValueError(f"not an http(s) URL: {url}")
+    return _opener.open(url_or_request, timeout=timeout)
+
+@functools.lru_cache(maxsize=4096)
+def cover_key(url):
+    """Content address of a cover: the SHA-256 hex digest of its URL"""
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+class CoverCache:
+    """Download cover images once and serve fixed-size local thumbnails
+
+    Only http(s) URLs are fetched; any other URL raises ValueError. The
+    cached files, their sizes and how recently they were used are tracked
+    in memory, so serving a thumbnail touches no files and eviction scans
+    no directories. The directories are rescanned every RESCAN_SECONDS,
+    when this process's recency is also written back as file times.
+    """
+
+    def __init__(self, originals_dir=ORIGINALS_DIR, thumbnail_dir=THUMBNAIL_DIR,
+                 max_bytes=MAX_CACHE_BYTES):
+        self.originals_dir = originals_dir
+        self.thumbnail_dir = thumbnail_dir
+        self.max_bytes = max_bytes
+        self._pending = set()
+        self._failed = {}  # url -> time of the last failed download
+        self._lock = threading.Lock()
+        self._executor = None
+        self._files = collections.OrderedDict()  # path -> bytes, least recently used first
+        self._bytes = 0
+        self._used = set()  # paths used since the last rescan
+        self._scanned_at = None
+
+    def original_path(self, url):
+        return os.path.join(self.originals_dir, cover_key(url))
+
+    def thumbnail_path(self, url):
+        return os.path.join(self.thumbnail_dir, cover_key(url) + ".jpg")
+
+    def thumbnail_url(self, url):
+        """Return the local URL of a cover's thumbnail, or None if not cached"""
+        path = self.thumbnail_path(url)
+        with self._lock:
+            if self._scanned_at is None:
+                self._rescan()
+            if path not in self._files:
+                return None
+            self._files.move_to_end(path)
+            self._used.add(path)
+        return f"{THUMBNAIL_URL_PREFIX}/{os.path.basename(path)}"
+
+    def fetch(self, url):
+        """Download a cover and build its thumbnail; return the thumbnail path
+
+        Does nothing if the thumbnail already exists. Raises OSError or
+        ValueError if the cover cannot be downloaded or decoded.
+        """
+        thumbnail_path = self.thumbnail_path(url)
+        if os.path.exists(thumbnail_path):
+            self._add(thumbnail_path)
+            return thumbnail_path
+        if Image is None:
+            raise ValueError("Pillow is required to build cover thumbnails")
+
+        original_path = self.original_path(url)
+        if not os.path.exists(original_path):
+            self._download(url, original_path)
+            self._add(original_path)
+        self._make_thumbnail(original_path, thumbnail_path)
+        self._add(thumbnail_path)
+        self.evict()
+        return thumbnail_path
+
+    def _add(self, path):
+        """Record a cached file as the most recently used"""
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._bytes += size - self._files.pop(path, 0)
+            self._files[path] = size
+            self._used.add(path)
+
+    def _rescan(self):
+        """Rebuild the in-memory index from the cache directories
+
+        Files used since the last rescan get their modification time
+        refreshed first, so the rebuilt order, other processes and the next
+        start all see them as recently used. Called with the lock held.
+        """
+        for path in self._used:
+            with contextlib.suppress(OSError):
+                os.utime(path)
+        self._used.clear()
+        files = []
+        for entry in self._cached_files():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # Evicted by another process meanwhile
+                continue
+            files.append((stat.st_mtime, entry.path, stat.st_size))
+        self._files = collections.OrderedDict((path, size) for _, path, size in sorted(files))
+        self._bytes = sum(self._files.values())
+        self._scanned_at = time.monotonic()
+
+    def _download(self, url, path):
+        os.makedirs(self.originals_dir, exist_ok=True)
+        # Write to a temporary file and rename, so readers never see a
+        # partial download
+        fd, tmp_path = tempfile.mkstemp(dir=self.originals_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp, \
+                    open_url(url) as response:
+                copied = 0
+                while True:
+                    chunk = response.read(64 * 1024)
+                    if not chunk:
+                        break
+                    copied += len(chunk)
+                    if copied > MAX_DOWNLOAD_BYTES:
+                        raise ValueError(f"cover larger than {MAX_DOWNLOAD_BYTES} bytes: {url}")
+                    tmp.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+
+    def _make_thumbnail(self, original_path, thumbnail_path):
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+        try:
+            with Image.open(original_path) as image:
+                thumbnail = ImageOps.fit(image.convert("RGB"), THUMBNAIL_SIZE)
+        except Exception as e:
+            # Drop an original that is not a readable image so it is retried
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(original_path)
+            raise ValueError(f"cover is not a readable image: {e}") from e
+        fd, tmp_path = tempfile.mkstemp(dir=self.thumbnail_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                thumbnail.save(tmp, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+            os.replace(tmp_path, thumbnail_path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+
+    def prefetch(self, url):
+        """Fetch a cover in the background unless it is cached or in flight"""
+        if Image is None or not is_remote_url(url):
+            return
+        with self._lock:
+            if self.thumbnail_path(url) in self._files or url in self._pending:
+                return
+            failed_at = self._failed.get(url)
+            if failed_at is not None and time.monotonic() - failed_at < FAILED_RETRY_SECONDS:
+                return
+            self._pending.add(url)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=DOWNLOAD_WORKERS, thread_name_prefix="cover-fetch"
+                )
+        self._executor.submit(self._prefetch, url)
+
+    def _prefetch(self, url):
+        try:
+            self.fetch(url)
+        except (OSError, ValueError):
+            # The card keeps showing the remote URL or the default cover
+            with self._lock:
+                self._failed[url] = time.monotonic()
+        finally:
+            with self._lock:
+                self._pending.discard(url)
+
+    def _cached_files(self):
+        for directory in (self.originals_dir, self.thumbnail_dir):
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_file():
+                    yield entry
+
+    def disk_usage(self):
+        """Total bytes used by originals and thumbnails"""
+        return sum(entry.stat().st_size for entry in self._cached_files())
+
+    def evict(self):
+        """Delete least recently used files until the cache fits in max_bytes"""
+        with self._lock:
+            if self._scanned_at is None or time.monotonic() - self._scanned_at >= RESCAN_SECONDS:
+                self._rescan()
+            while self._bytes > self.max_bytes and self._files:
+                path, size = self._files.popitem(last=False)
+                self._bytes -= size
+                self._used.discard(path)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    def clear(self):
+        """Delete every cached original and thumbnail"""
+        with self._lock:
+            for directory in (self.originals_dir, self.thumbnail_dir):
+                shutil.rmtree(directory, ignore_errors=True)
+            self._files.clear()
+            self._bytes = 0
+            self._used.clear()
+
+cover_cache = CoverCache()
+
+def local_cover_url(url):
+    """Return a local thumbnail URL for a cover, queueing a download if needed
+
+    Returns None while the cover is not cached yet; the caller should show
+    the remote URL in the meantime.
+    """
+    if not url:
+        return None
+    local_url = cover_cache.thumbnail_url(url)
+    if local_url is None:
+        cover_cache.prefetch(url)
+    return local_url
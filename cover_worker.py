@@ -0,0 +1,144 @@
+"""Background checker for book cover URLs
+
+Every cover URL in ``books`` is checked on a bounded thread pool.
+Suggestions are left alone: their URLs come from anonymous visitors and are
+only fetched once a librarian has approved the book. Status, content type
+and size are recorded in ``cover_checks``, valid covers are prefetched into
+the local cover cache, and broken ones are marked so the card renderer shows
+the default cover straight away. Run once from the command line with:
+
+    python cover_worker.py --workers 8
+"""
+import argparse
+import logging
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+from cover_cache import cover_cache, is_remote_url, open_url, CACHE_AVAILABLE
+
+logger = logging.getLogger(__name__)
+
+# Concurrent URL checks
+CHECK_WORKERS = 8
+
+# Results written to the database per transaction
+RECORD_BATCH_SIZE = 100
+
+# How often the in-app worker looks for covers due for a check
+CHECK_INTERVAL_SECONDS = 15 * 60
+
+def check_cover(url):
+    """Check one cover URL, prefetch it if valid, and return the result dict"""
+    result = {
+        'url': url,
+        'status': 'broken',
+        'http_status': None,
+        'content_type': None,
+        'content_length': None,
+        'error': None,
+    }
+    if not is_remote_url(url):
+        result['error'] = "not an http(s) URL"
+        return result
+
+    try:
+        request = urllib.request.Request(url, method="HEAD")
+        with open_url(request) as response:
+            result['http_status'] = getattr(response, 'status', None)
+            result['content_type'] = response.headers.get('Content-Type')
+            length = response.headers.get('Content-Length')
+            result['content_length'] = int(length) if length and length.isdigit() else None
+    except urllib.error.HTTPError as e:
+        result['http_status'] = e.code
+        # Some servers refuse HEAD; let the download below decide
+        if e.code not in (405, 501):
+            result['error'] = f"HTTP {e.code}"
+            return result
+    except (OSError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+
+    content_type = result['content_type'] or ""
+    if content_type and not content_type.startswith("image/"):
+        result['error'] = f"not an image ({content_type})"
+        return result
+
+    if CACHE_AVAILABLE:
+        # Downloading and decoding the image is the real test of a cover
+        try:
+            cover_cache.fetch(url)
+        except (OSError, ValueError) as e:
+            result['error'] = str(e)
+            return result
+
+    result['status'] = 'ok'
+    return result
+
+def check_covers(urls, workers=CHECK_WORKERS, progress=None):
+    """Check URLs concurrently and record results in batches
+
+    Returns a dict counting ok and broken covers. ``progress`` is called with
+    that dict after every recorded batch.
+    """
+    counts = {'ok': 0, 'broken': 0}
+    batch = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cover-check") as executor:
+        for result in executor.map(check_cover, urls):
+            counts[result['status']] += 1
+            batch.append(result)
+            if len(batch) >= RECORD_BATCH_SIZE:
+                database.record_cover_checks(batch)
+                batch = []
+                if progress:
+                    progress(counts)
+    if batch:
+        database.record_cover_checks(batch)
+    return counts
+
+def run_once(workers=CHECK_WORKERS, recheck_after_hours=24, progress=None):
+    """Check every cover URL that is due and return the ok/broken counts"""
+    database.initialize_database()
+    urls = database.get_cover_urls_to_check(recheck_after_hours)
+    return check_covers(urls, workers=workers, progress=progress)
+
+_worker_thread = None
+_worker_lock = threading.Lock()
+
+def start_background_worker(interval=CHECK_INTERVAL_SECONDS):
+    """Start the periodic cover checker on a daemon thread, once per process"""
+    global _worker_thread
+    with _worker_lock:
+        if _worker_thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    run_once()
+                except Exception:  # Keep the worker alive for the next round
+                    logger.exception("Cover check failed")
+                time.sleep(interval)
+
+        _worker_thread = threading.Thread(target=loop, name="cover-worker", daemon=True)
+        _worker_thread.start()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=database.DB_FILE, help="database file to check")
+    parser.add_argument("--workers", type=int, default=CHECK_WORKERS)
+    parser.add_argument("--recheck-after-hours", type=float, default=24)
+    args = parser.parse_args()
+
+    database.DB_FILE = args.db
+    start = time.perf_counter()
+    counts = run_once(args.workers, args.recheck_after_hours,
+                      progress=lambda counts: print(counts))
+    elapsed = time.perf_counter() - start
+    print(f"{counts['ok']} ok, {counts['broken']} broken in {elapsed:.1f}s")
+
+if __name__ == "__main__":
+    main()
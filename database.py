@@ -1,24 +1,250 @@
 import sqlite3
+import functools
+import hashlib
+import inspect
+import logging
 import os
+import queue
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+import numpy as np
 import pandas as pd
+from instrumentation import timed, TimedConnection
 from sample_data import SAMPLE_BOOKS
 
+logger = logging.getLogger(__name__)
+
 # Database file
 DB_FILE = "library.db"
 
+# Serve queries from long-lived pooled connections instead of opening a new
+# connection per call (set to False to fall back to one connection per query)
+USE_CONNECTION_POOL = True
+
+# Number of idle connections the pool keeps open between requests
+POOL_SIZE = 8
+
+# Prepared statements cached per connection by the sqlite3 module
+CACHED_STATEMENTS = 256
+
+# Serve the cached catalog reads from in-memory copies of the database,
+# taken again by a background thread once the catalog version on disk moves
+# on. Reads then lag writes by up to SNAPSHOT_REFRESH_SECONDS. Each of the
+# SNAPSHOT_COPIES readers has a private copy, so the snapshot needs that
+# many times the database file's size in memory, plus one while renewed;
+# readers beyond those read from disk.
+USE_MEMORY_SNAPSHOT = False
+SNAPSHOT_REFRESH_SECONDS = 1.0
+SNAPSHOT_COPIES = 4
+
+# Pragmas applied to every pooled connection. WAL lets readers keep going
+# while a suggestion is being written, and NORMAL sync is safe under WAL.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",      # ~16 MB page cache per connection
+    "PRAGMA mmap_size = 268435456",    # 256 MB memory-mapped reads
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Relative BM25 weights of the title, author and description search columns
+SEARCH_WEIGHTS = (10.0, 5.0, 1.0)
+SEARCH_RANK = "bm25(books_fts, ?, ?, ?)"
+
+# Age groups a book can be catalogued under
+AGE_GROUPS = ("Small Kids", "Teens & Adults")
+
+# Number of books shown per page of the catalog grid
+PAGE_SIZE = 30
+
+# Serve repeated catalog reads from an in-process result cache that is
+# invalidated whenever the catalog version changes
+USE_QUERY_CACHE = True
+
+# Maximum number of query results kept by the cache before LRU eviction
+QUERY_CACHE_SIZE = 256
+
+# Fuzzy search: indexed words fetched as spelling candidates per query word,
+# candidates kept per word, and matching books re-ranked by similarity.
+# Trigrams held by more than FUZZY_TRIGRAM_TERMS words are left out of the
+# candidate lookup, up to a quarter of a query word's trigrams.
+FUZZY_CANDIDATE_TERMS = 30
+FUZZY_TRIGRAM_TERMS = 250
+FUZZY_TERMS_PER_WORD = 5
+FUZZY_CANDIDATE_BOOKS = 200
+
+# Two-hour visit slots offered every day as (start, end) in 24-hour time, and
+# the number of visitors the library can host in one slot
+VISIT_SLOTS = (
+    ("09:00", "11:00"),
+    ("11:00", "13:00"),
+    ("13:00", "15:00"),
+    ("15:00", "17:00"),
+    ("17:00", "19:00"),
+)
+VISIT_SLOT_CAPACITY = 30
+
+# Days a book is lent for
+LOAN_DAYS = 21
+
+# Duplicate detection: MinHash signatures of BANDS x ROWS_PER_BAND hashes,
+# bucketed per band for locality-sensitive lookup, and the shingle (Jaccard)
+# similarity at which two normalized title/author keys may be one book.
+# Keys at similarity 0.9 share a bucket almost surely, at 0.8 97% of the
+# time and at 0.7 78%, while unrelated keys below 0.3 rarely do. Keys that
+# differ must also be within DUPLICATE_MAX_EDITS typos of each other.
+DUPLICATE_BANDS = 12
+DUPLICATE_ROWS_PER_BAND = 6
+DUPLICATE_SIMILARITY = 0.7
+DUPLICATE_MAX_EDITS = 2
+
+# Rows bucketed per batch when the duplicate index catches up after a bulk load
+DUPLICATE_INDEX_BATCH_SIZE = 5000
+
 def get_db_connection():
     """Create a connection to the SQLite database"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
-def initialize_database():
-    """Initialize the database with tables if they don't exist"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+class PoolClosedError(sqlite3.ProgrammingError):
+    """A connection was asked of a pool that has been closed"""
+
+# Pooled connections checked out per thread id, for interrupt_thread()
+_checked_out = {}
+
+class ConnectionPool:
+    """A thread-safe pool of long-lived, pre-configured SQLite connections
+
+    Streamlit runs every session on its own thread, so a connection is checked
+    out by exactly one thread at a time and returned to the pool afterwards.
+    Connections beyond ``size`` are opened on demand and closed on release,
+    as is every connection released after close().
+    """
+
+    def __init__(self, db_file, size=POOL_SIZE):
+        self.db_file = db_file
+        self.size = size
+        self.closed = False
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=5.0,
+            check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS,
+            factory=TimedConnection
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a ``with`` block
+
+        Raises PoolClosedError once the pool has been closed.
+        """
+        if self.closed:
+            raise PoolClosedError(f"the pool for {self.db_file} is closed")
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+
+        in_use = _checked_out.setdefault(threading.get_ident(), [])
+        in_use.append(conn)
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            in_use.remove(conn)
+            self._release(conn)
+
+    def _release(self, conn):
+        with self._lock:
+            if not self.closed:
+                try:
+                    self._idle.put_nowait(conn)
+                    conn = None
+                except queue.Full:
+                    pass
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        """Close every idle connection; ones checked out are closed on release"""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process-wide connection pool for the current DB_FILE"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_file != DB_FILE:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DB_FILE)
+        return _pool
+
+def close_pool():
+    """Close the process-wide connection pool and any in-memory snapshot"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+    close_snapshot()
+
+def interrupt_thread(thread_id):
+    """Abort the statements another thread is running on pooled connections
+
+    Covers the database pool and snapshot pools alike. The interrupted call
+    raises sqlite3.OperationalError("interrupted"); statements started after
+    it has returned are not affected.
+    """
+    for conn in list(_checked_out.get(thread_id, ())):
+        conn.interrupt()
+
+@contextmanager
+def connection():
+    """Yield a database connection, pooled unless pooling is switched off"""
+    if USE_CONNECTION_POOL:
+        with get_pool().connection() as conn:
+            yield conn
+    else:
+        conn = get_db_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+def _migrate_base_tables(conn):
+    """Create the books and suggestions tables"""
     # Create books table
-    cursor.execute('''
+    conn.execute('''
     CREATE TABLE IF NOT EXISTS books (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         title TEXT NOT NULL,
@@ -32,7 +258,7 @@ def initialize_database():
     ''')
     
     # Create suggestions table
-    cursor.execute('''
+    conn.execute('''
     CREATE TABLE IF NOT EXISTS suggestions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         title TEXT NOT NULL,
@@ -44,86 +270,2302 @@ def initialize_database():
         submission_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     ''')
+
+def _migrate_search_index(conn):
+    """Create the full-text search index over books"""
+    # An external content table stores only the index and reads the text
+    # back from books; the triggers below keep the two in sync.
+    conn.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        title, author, description,
+        content='books', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts (rowid, title, author, description)
+        VALUES (new.id, new.title, new.author, new.description);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts (books_fts, rowid, title, author, description)
+        VALUES ('delete', old.id, old.title, old.author, old.description);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_update
+    AFTER UPDATE OF title, author, description ON books BEGIN
+        INSERT INTO books_fts (books_fts, rowid, title, author, description)
+        VALUES ('delete', old.id, old.title, old.author, old.description);
+        INSERT INTO books_fts (rowid, title, author, description)
+        VALUES (new.id, new.title, new.author, new.description);
+    END
+    ''')
+    # Index any books that were added before the search index existed
+    conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+
+def _migrate_catalog_indexes(conn):
+    """Create indexes matching the catalog access patterns"""
+    # Every listing is ordered by popularity, optionally after an equality
+    # filter on genre, age group or both.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_books_popularity ON books (popularity DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_books_genre_popularity ON books (genre, popularity DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_books_age_group_popularity ON books (age_group, popularity DESC)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_books_genre_age_group_popularity "
+        "ON books (genre, age_group, popularity DESC)"
+    )
+
+def _migrate_catalog_version(conn):
+    """Create the catalog version counter bumped by every change to books"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS catalog_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_version_{event.lower()} AFTER {event} ON books BEGIN
+            UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+        END
+        ''')
+
+def _migrate_sample_data(conn):
+    """Populate an empty catalog with the sample books"""
+    if conn.execute("SELECT EXISTS (SELECT 1 FROM books)").fetchone()[0]:
+        return
+    conn.executemany('''
+    INSERT INTO books (title, author, genre, age_group, description, cover_url, popularity)
+    VALUES (:title, :author, :genre, :age_group, :description, :cover_url, :popularity)
+    ''', SAMPLE_BOOKS)
+
+def _migrate_book_key_index(conn):
+    """Index books on (title, author), the key catalog imports upsert on"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_books_title_author ON books (title, author)")
+
+def _migrate_collection_stats(conn):
+    """Create aggregate tables for the collection overview and fill them
+
+    Triggers on books keep per-genre and per-author book counts current, and
+    triggers on those tables keep the distinct genre and author totals, so
+    reading the overview never touches books.
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS collection_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_books INTEGER NOT NULL,
+        unique_genres INTEGER NOT NULL,
+        unique_authors INTEGER NOT NULL
+    )
+    ''')
+    for column in ("genre", "author"):
+        table = f"{column}_counts"
+        conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            {column} TEXT PRIMARY KEY,
+            book_count INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON {table} BEGIN
+            UPDATE collection_stats SET unique_{column}s = unique_{column}s + 1 WHERE id = 1;
+        END
+        ''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON {table} BEGIN
+            UPDATE collection_stats SET unique_{column}s = unique_{column}s - 1 WHERE id = 1;
+        END
+        ''')
     
-    # Check if we need to populate the database with sample data
-    cursor.execute("SELECT COUNT(*) FROM books")
-    book_count = cursor.fetchone()[0]
+    # Adding a book counts it under its genre and author; removing it uncounts
+    # it and drops a genre or author once nothing is left under it
+    add_book = '''
+        INSERT INTO genre_counts (genre, book_count) VALUES (new.genre, 1)
+            ON CONFLICT (genre) DO UPDATE SET book_count = book_count + 1;
+        INSERT INTO author_counts (author, book_count) VALUES (new.author, 1)
+            ON CONFLICT (author) DO UPDATE SET book_count = book_count + 1;
+    '''
+    remove_book = '''
+        UPDATE genre_counts SET book_count = book_count - 1 WHERE genre = old.genre;
+        DELETE FROM genre_counts WHERE genre = old.genre AND book_count <= 0;
+        UPDATE author_counts SET book_count = book_count - 1 WHERE author = old.author;
+        DELETE FROM author_counts WHERE author = old.author AND book_count <= 0;
+    '''
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS books_stats_insert AFTER INSERT ON books BEGIN
+        {add_book}
+        UPDATE collection_stats SET total_books = total_books + 1 WHERE id = 1;
+    END
+    ''')
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS books_stats_delete AFTER DELETE ON books BEGIN
+        {remove_book}
+        UPDATE collection_stats SET total_books = total_books - 1 WHERE id = 1;
+    END
+    ''')
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS books_stats_update AFTER UPDATE OF genre, author ON books BEGIN
+        {remove_book}
+        {add_book}
+    END
+    ''')
     
-    if book_count == 0:
-        # Populate with sample data if database is empty
-        for book in SAMPLE_BOOKS:
-            cursor.execute('''
-            INSERT INTO books (title, author, genre, age_group, description, cover_url, popularity)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                book['title'],
-                book['author'],
-                book['genre'],
-                book['age_group'],
-                book['description'],
-                book['cover_url'],
-                book['popularity']
-            ))
+    # Recompute everything from books, which also repairs the tables after a
+    # bulk load that ran with the triggers suspended
+    conn.execute("DELETE FROM genre_counts")
+    conn.execute("DELETE FROM author_counts")
+    conn.execute("INSERT INTO genre_counts SELECT genre, COUNT(*) FROM books GROUP BY genre")
+    conn.execute("INSERT INTO author_counts SELECT author, COUNT(*) FROM books GROUP BY author")
+    conn.execute('''
+    INSERT OR REPLACE INTO collection_stats (id, total_books, unique_genres, unique_authors)
+    VALUES (
+        1,
+        (SELECT COUNT(*) FROM books),
+        (SELECT COUNT(*) FROM genre_counts),
+        (SELECT COUNT(*) FROM author_counts)
+    )
+    ''')
+
+def _migrate_cover_checks(conn):
+    """Create the table recording the outcome of cover URL checks
+
+    Cover URLs are indexed too, so the cover worker reads the distinct URLs
+    in order.
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS cover_checks (
+        url TEXT PRIMARY KEY,
+        status TEXT NOT NULL CHECK (status IN ('ok', 'broken')),
+        http_status INTEGER,
+        content_type TEXT,
+        content_length INTEGER,
+        error TEXT,
+        checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cover_checks_status ON cover_checks (status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_books_cover_url ON books (cover_url)")
+
+def normalize_words(text):
+    """Split text into lowercase words with diacritics removed"""
+    text = text or ""
+    if not text.isascii():
+        decomposed = unicodedata.normalize("NFKD", text)
+        text = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return re.findall(r"[^\W_]+", text.casefold())
+
+def _search_terms(texts):
+    """Return the distinct words of three or more characters in some texts"""
+    return {word for text in texts for word in normalize_words(text) if len(word) >= 3}
+
+def _trigrams(word):
+    """Return the trigrams of a word padded with two spaces before and one after"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _term_trigram_rows(term_id, term):
+    return ((trigram, len(term), term_id) for trigram in _trigrams(term))
+
+def _migrate_search_terms(conn):
+    """Create the trigram index of title and author words used by fuzzy search
+
+    search_terms holds every distinct normalized word of a title or author and
+    search_term_trigrams is the inverted index from trigram to those words,
+    keyed by word length as well so a lookup only reads words of about the
+    right length. search_trigrams counts the words holding each trigram, so
+    a lookup can skip the most common ones. Words are split in Python, so the
+    triggers on books only queue new or renamed books in search_terms_pending
+    for index_pending_search_terms(), which the writes adding books call
+    before they commit. Words of deleted books linger until the next rebuild,
+    which only costs a wasted candidate.
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS search_terms (
+        id INTEGER PRIMARY KEY,
+        term TEXT NOT NULL UNIQUE
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS search_term_trigrams (
+        trigram TEXT NOT NULL,
+        length INTEGER NOT NULL,
+        term_id INTEGER NOT NULL,
+        PRIMARY KEY (trigram, length, term_id)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS search_trigrams (
+        trigram TEXT PRIMARY KEY,
+        terms INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS search_terms_pending (
+        book_id INTEGER PRIMARY KEY
+    )
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_terms_insert AFTER INSERT ON books BEGIN
+        INSERT OR IGNORE INTO search_terms_pending (book_id) VALUES (new.id);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_terms_update AFTER UPDATE OF title, author ON books BEGIN
+        INSERT OR IGNORE INTO search_terms_pending (book_id) VALUES (new.id);
+    END
+    ''')
     
+    # Rebuild from books, which also picks up rows added by a bulk load
+    conn.execute("DELETE FROM search_trigrams")
+    conn.execute("DELETE FROM search_term_trigrams")
+    conn.execute("DELETE FROM search_terms")
+    conn.execute("DELETE FROM search_terms_pending")
+    rows = conn.execute("SELECT title, author FROM books")
+    terms = list(enumerate(sorted(_search_terms(text for row in rows for text in row)), start=1))
+    conn.executemany("INSERT INTO search_terms (id, term) VALUES (?, ?)", terms)
+    conn.executemany(
+        "INSERT INTO search_term_trigrams (trigram, length, term_id) VALUES (?, ?, ?)",
+        (row for term_id, term in terms for row in _term_trigram_rows(term_id, term))
+    )
+    conn.execute('''
+    INSERT INTO search_trigrams (trigram, terms)
+    SELECT trigram, COUNT(*) FROM search_term_trigrams GROUP BY trigram
+    ''')
+
+# Titles and authors of the books queued for the fuzzy index, looked up by
+# rowid; a join would scan books for the few queued ids
+PENDING_SEARCH_TERM_BOOKS_QUERY = '''
+SELECT title, author FROM books
+WHERE id IN (SELECT book_id FROM search_terms_pending)
+'''
+
+COUNT_SEARCH_TRIGRAM_QUERY = '''
+INSERT INTO search_trigrams (trigram, terms) VALUES (?, 1)
+ON CONFLICT (trigram) DO UPDATE SET terms = terms + 1
+'''
+
+def index_pending_search_terms(conn):
+    """Add the words of books queued in search_terms_pending to the fuzzy index
+
+    The caller owns the transaction, so books are searchable by spelling as
+    soon as they are committed and fuzzy searches only ever read.
+    """
+    if not conn.execute("SELECT EXISTS (SELECT 1 FROM search_terms_pending)").fetchone()[0]:
+        return
+    rows = conn.execute(PENDING_SEARCH_TERM_BOOKS_QUERY)
+    for term in sorted(_search_terms(text for row in rows for text in row)):
+        cursor = conn.execute("INSERT OR IGNORE INTO search_terms (term) VALUES (?)", (term,))
+        if cursor.rowcount:
+            conn.executemany(
+                "INSERT INTO search_term_trigrams (trigram, length, term_id) VALUES (?, ?, ?)",
+                _term_trigram_rows(cursor.lastrowid, term)
+            )
+            conn.executemany(COUNT_SEARCH_TRIGRAM_QUERY, ((trigram,) for trigram in _trigrams(term)))
+    conn.execute("DELETE FROM search_terms_pending")
+
+def _migrate_similar_books(conn):
+    """Create the tables behind "more like this" recommendations
+
+    recommendations.py fills book_vectors (each book's strongest TF-IDF
+    terms), recommendation_terms (document counts for IDF) and similar_books
+    (each book's nearest neighbours by rank). Triggers on books queue added,
+    changed and deleted books in similar_books_pending for the next refresh,
+    along with the books that lose a neighbour. A book queued after a change
+    or a delete keeps the author, genre, age group and description it had at
+    the last refresh, so the next one can take its old terms out of the
+    counts before adding the new ones; a book queued for losing a neighbour
+    keeps its current values, and one never vectorized has NULLs. Every book
+    is queued here so a bulk load is followed by a full rebuild.
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS similar_books (
+        book_id INTEGER NOT NULL,
+        rank INTEGER NOT NULL,
+        similar_id INTEGER NOT NULL,
+        score REAL NOT NULL,
+        PRIMARY KEY (book_id, rank)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_similar_books_similar_id ON similar_books (similar_id)")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS recommendation_terms (
+        id INTEGER PRIMARY KEY,
+        term TEXT NOT NULL UNIQUE,
+        book_count INTEGER NOT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS book_vectors (
+        book_id INTEGER NOT NULL,
+        term_id INTEGER NOT NULL,
+        weight REAL NOT NULL,
+        PRIMARY KEY (book_id, term_id)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_book_vectors_term ON book_vectors (term_id, book_id, weight)")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS similar_books_pending (
+        book_id INTEGER PRIMARY KEY,
+        old_author TEXT,
+        old_genre TEXT,
+        old_age_group TEXT,
+        old_description TEXT
+    )
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_similar_insert AFTER INSERT ON books BEGIN
+        INSERT OR IGNORE INTO similar_books_pending (book_id) VALUES (new.id);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_similar_update
+    AFTER UPDATE OF author, genre, age_group, description ON books BEGIN
+        INSERT OR IGNORE INTO similar_books_pending
+            (book_id, old_author, old_genre, old_age_group, old_description)
+        VALUES (new.id, old.author, old.genre, old.age_group, old.description);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_similar_delete AFTER DELETE ON books BEGIN
+        INSERT OR IGNORE INTO similar_books_pending
+            (book_id, old_author, old_genre, old_age_group, old_description)
+            SELECT books.id, books.author, books.genre, books.age_group, books.description
+            FROM similar_books AS similar
+            JOIN books ON books.id = similar.book_id
+            WHERE similar.similar_id = old.id;
+        DELETE FROM similar_books WHERE similar_id = old.id;
+        DELETE FROM similar_books WHERE book_id = old.id;
+        DELETE FROM book_vectors WHERE book_id = old.id;
+        INSERT OR IGNORE INTO similar_books_pending
+            (book_id, old_author, old_genre, old_age_group, old_description)
+        VALUES (old.id, old.author, old.genre, old.age_group, old.description);
+    END
+    ''')
+    conn.execute("INSERT OR IGNORE INTO similar_books_pending (book_id) SELECT id FROM books")
+
+def _migrate_suggestion_counts(conn):
+    """Count how many times each book has been suggested"""
+    conn.execute("ALTER TABLE suggestions ADD COLUMN times_suggested INTEGER NOT NULL DEFAULT 1")
+
+# Title words ignored by duplicate detection, so "Hobbit, The" matches "The
+# Hobbit" and "War & Peace" matches "War and Peace"
+TITLE_STOPWORDS = frozenset(("the", "a", "an", "and"))
+
+def duplicate_key(title, author):
+    """Normalize a title and author into the key duplicate detection compares
+
+    Letter case, punctuation, diacritics, articles and "and" are ignored, as
+    are the order of the author's names and their initials, so "The Hobbit"
+    by "Tolkien, J.R.R." and "hobbit" by "J. R. R. Tolkien" share a key.
+    Returns an empty string if the title has no words.
+    """
+    title_words = [word for word in normalize_words(title) if word not in TITLE_STOPWORDS]
+    if not title_words:
+        return ""
+    author_words = sorted(word for word in normalize_words(author) if len(word) > 1)
+    return " ".join(title_words + ["/"] + author_words)
+
+def _key_shingles(key):
+    """Return the character trigrams of a duplicate key"""
+    return frozenset(key[i:i + 3] for i in range(max(1, len(key) - 2)))
+
+# Cached for the comparisons of a submission with its candidates, which see
+# the same few keys again; bucketing calls _key_shingles() directly so a bulk
+# load does not fill the cache with keys it never compares
+_shingles = functools.lru_cache(maxsize=4096)(_key_shingles)
+
+def key_similarity(a, b):
+    """Jaccard similarity of two duplicate keys' trigrams
+
+    Keys whose numbers differ never match, so volume 2 of a series is not
+    taken for volume 1.
+    """
+    if a == b:
+        return 1.0
+    if re.findall(r"\d+", a) != re.findall(r"\d+", b):
+        return 0.0
+    a, b = _shingles(a), _shingles(b)
+    return len(a & b) / len(a | b)
+
+def confirmed_similarity(a, b):
+    """Return the key_similarity() of two keys of one book, or 0.0 if they differ
+
+    A bucket shared in the LSH index only makes keys candidates. Equal keys
+    are confirmed; others need DUPLICATE_SIMILARITY and at most
+    DUPLICATE_MAX_EDITS edits between them, since a title that adds a word,
+    like "Macorbelel Returns" and "Inalmaan Macorbelel Returns" by one
+    author, shares most of its trigrams but is another book.
+    """
+    similarity = key_similarity(a, b)
+    if similarity < 1.0 and (similarity < DUPLICATE_SIMILARITY or
+                             edit_distance(a, b, DUPLICATE_MAX_EDITS) > DUPLICATE_MAX_EDITS):
+        return 0.0
+    return similarity
+
+# MinHash uses hash functions (a * x + b) mod p over 32-bit shingle hashes.
+# The coefficients are derived from fixed strings because stored buckets are
+# only comparable while they stay the same.
+MINHASH_PRIME = 4294967291  # 2**32 - 5
+_MINHASH_COEFFICIENTS = np.array([
+    int.from_bytes(hashlib.blake2b(f"minhash {i}".encode(), digest_size=4).digest(), "big")
+    % (MINHASH_PRIME - 1) + 1
+    for i in range(2 * DUPLICATE_BANDS * DUPLICATE_ROWS_PER_BAND)
+], dtype=np.uint64).reshape(2, -1)
+
+def duplicate_buckets(keys, batch_size=1024):
+    """Return the LSH bucket of each non-empty key in every band
+
+    Each key's trigrams are MinHashed and the signature is cut into
+    DUPLICATE_BANDS bands of DUPLICATE_ROWS_PER_BAND hashes; a band's hashes
+    are folded into one 64-bit bucket, so similar keys are likely to share
+    the bucket of at least one band. Returns one list of bucket integers per
+    key.
+    """
+    a, b = _MINHASH_COEFFICIENTS
+    buckets = []
+    for first in range(0, len(keys), batch_size):
+        shingle_sets = [_key_shingles(key) for key in keys[first:first + batch_size]]
+        # Hash every distinct trigram of the batch once, then take each key's
+        # minimum over its own trigrams
+        vocabulary, shingle_ids = np.unique(
+            np.array([shingle for shingles in shingle_sets for shingle in shingles]),
+            return_inverse=True
+        )
+        hashes = np.array([zlib.crc32(shingle.encode()) for shingle in vocabulary.tolist()], dtype=np.uint64)
+        permuted = (hashes[:, None] * a + b) % np.uint64(MINHASH_PRIME)
+        starts = np.cumsum([0] + [len(shingles) for shingles in shingle_sets[:-1]])
+        signatures = np.minimum.reduceat(permuted[shingle_ids], starts, axis=0)
+        bands = signatures.reshape(len(shingle_sets), DUPLICATE_BANDS, DUPLICATE_ROWS_PER_BAND)
+        folded = bands[:, :, 0].copy()
+        for row in range(1, DUPLICATE_ROWS_PER_BAND):
+            folded = folded * np.uint64(0x100000001B3) + bands[:, :, row]
+        buckets.extend(folded.view(np.int64).tolist())
+    return buckets
+
+def _bucket_rows(source, items):
+    """Rows of duplicate_buckets for (id, title, author) items of one source"""
+    items = [(item_id, duplicate_key(title, author)) for item_id, title, author in items]
+    items = [(item_id, key) for item_id, key in items if key]
+    buckets = duplicate_buckets([key for _, key in items])
+    return [
+        (band, bucket, source, item_id)
+        for (item_id, _), item_buckets in zip(items, buckets)
+        for band, bucket in enumerate(item_buckets)
+    ]
+
+def _migrate_duplicate_index(conn):
+    """Create the locality-sensitive hash index used to spot duplicate books
+
+    duplicate_buckets maps each band's MinHash bucket to the books and
+    suggestions in it, so a submission is compared only with the handful of
+    titles sharing a bucket. Keys are computed in Python, so the triggers on
+    books and suggestions queue added or retitled rows in
+    duplicate_buckets_pending for _index_pending_duplicates().
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS duplicate_buckets (
+        band INTEGER NOT NULL,
+        bucket INTEGER NOT NULL,
+        source TEXT NOT NULL CHECK (source IN ('book', 'suggestion')),
+        item_id INTEGER NOT NULL,
+        PRIMARY KEY (band, bucket, source, item_id)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_duplicate_buckets_item ON duplicate_buckets (source, item_id)")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS duplicate_buckets_pending (
+        source TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        PRIMARY KEY (source, item_id)
+    ) WITHOUT ROWID
+    ''')
+    for table, source in (("books", "book"), ("suggestions", "suggestion")):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_duplicates_insert AFTER INSERT ON {table} BEGIN
+            INSERT OR IGNORE INTO duplicate_buckets_pending (source, item_id) VALUES ('{source}', new.id);
+        END
+        ''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_duplicates_update
+        AFTER UPDATE OF title, author ON {table} BEGIN
+            INSERT OR IGNORE INTO duplicate_buckets_pending (source, item_id) VALUES ('{source}', new.id);
+        END
+        ''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_duplicates_delete AFTER DELETE ON {table} BEGIN
+            DELETE FROM duplicate_buckets WHERE source = '{source}' AND item_id = old.id;
+            DELETE FROM duplicate_buckets_pending WHERE source = '{source}' AND item_id = old.id;
+        END
+        ''')
+    
+    # Bucket the rows that have no buckets yet: every row the first time, and
+    # after a bulk load the books it added while the triggers were dropped
+    # (it never changes a title or author). Rows are read in id order a batch
+    # at a time, so memory stays flat however large the load was. Rows whose
+    # key is empty have no buckets and are looked at again, which is cheap.
+    for table, source in (("books", "book"), ("suggestions", "suggestion")):
+        last_id = 0
+        while True:
+            rows = conn.execute(f'''
+            SELECT id, title, author FROM {table} AS items
+            WHERE id > ? AND NOT EXISTS (
+                SELECT 1 FROM duplicate_buckets
+                WHERE source = ? AND item_id = items.id
+            )
+            ORDER BY id
+            LIMIT ?
+            ''', (last_id, source, DUPLICATE_INDEX_BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            # In key order, so the inserts walk the index instead of hopping
+            conn.executemany(
+                "INSERT OR IGNORE INTO duplicate_buckets (band, bucket, source, item_id) VALUES (?, ?, ?, ?)",
+                sorted(_bucket_rows(source, rows))
+            )
+            last_id = rows[-1][0]
+
+def _index_pending_duplicates(conn):
+    """Bucket the books and suggestions queued in duplicate_buckets_pending
+
+    The caller owns the write transaction.
+    """
+    if not conn.execute("SELECT EXISTS (SELECT 1 FROM duplicate_buckets_pending)").fetchone()[0]:
+        return
+    conn.execute('''
+    DELETE FROM duplicate_buckets
+    WHERE (source, item_id) IN (SELECT source, item_id FROM duplicate_buckets_pending)
+    ''')
+    for table, source in (("books", "book"), ("suggestions", "suggestion")):
+        rows = conn.execute(f'''
+        SELECT items.id, items.title, items.author
+        FROM duplicate_buckets_pending AS pending
+        JOIN {table} AS items ON items.id = pending.item_id
+        WHERE pending.source = ?
+        ''', (source,)).fetchall()
+        conn.executemany(
+            "INSERT INTO duplicate_buckets (band, bucket, source, item_id) VALUES (?, ?, ?, ?)",
+            _bucket_rows(source, rows)
+        )
+    conn.execute("DELETE FROM duplicate_buckets_pending")
+
+def _migrate_suggestion_review_index(conn):
+    """Index suggestions in the order librarians review them"""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_suggestions_times_suggested "
+        "ON suggestions (times_suggested DESC, id)"
+    )
+
+def _migrate_visits(conn):
+    """Create the visit slot and booking tables
+
+    visit_slots holds the capacity and places booked of each slot that has
+    had a booking; slots without a row are empty at VISIT_SLOT_CAPACITY.
+    The CHECK makes overbooking impossible even for a buggy writer.
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS visit_slots (
+        visit_date TEXT NOT NULL,
+        start_time TEXT NOT NULL,
+        capacity INTEGER NOT NULL,
+        booked INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (visit_date, start_time),
+        CHECK (booked BETWEEN 0 AND capacity)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS visits (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        visit_date TEXT NOT NULL,
+        start_time TEXT NOT NULL,
+        num_visitors INTEGER NOT NULL CHECK (num_visitors > 0),
+        visitor_name TEXT NOT NULL,
+        visitor_email TEXT NOT NULL,
+        visitor_phone TEXT,
+        purpose TEXT,
+        notes TEXT,
+        booked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_visits_slot ON visits (visit_date, start_time)")
+
+def _migrate_circulation(conn):
+    """Create the copies, loans and holds tables and per-title counters
+
+    book_availability keeps each title's total and available copies and its
+    waiting holds, updated in the same transaction as the copy, loan or hold
+    it counts, so listings never aggregate loans. Every book starts with one
+    copy on the shelf: a trigger shelves one for each book added, and books
+    without counters get one here, which is every book the first time and
+    after a bulk load the books it added while the trigger was dropped.
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS book_copies (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        book_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'available'
+            CHECK (status IN ('available', 'on_loan', 'on_hold')),
+        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_book_copies_book_status ON book_copies (book_id, status)")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS loans (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        copy_id INTEGER NOT NULL,
+        book_id INTEGER NOT NULL,
+        patron TEXT NOT NULL,
+        loaned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        due_date TEXT NOT NULL,
+        returned_at TIMESTAMP
+    )
+    ''')
+    # A copy can be on at most one open loan
+    conn.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_loans_open_copy ON loans (copy_id)
+    WHERE returned_at IS NULL
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_loans_open_patron ON loans (patron) WHERE returned_at IS NULL")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS holds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        book_id INTEGER NOT NULL,
+        patron TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'waiting'
+            CHECK (status IN ('waiting', 'ready', 'fulfilled', 'cancelled')),
+        copy_id INTEGER,
+        placed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        ready_at TIMESTAMP
+    )
+    ''')
+    # Hold queues are served in id order, and a patron has one open hold per title
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_holds_queue ON holds (book_id, status, id)")
+    conn.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_holds_open_patron ON holds (patron, book_id)
+    WHERE status IN ('waiting', 'ready')
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS book_availability (
+        book_id INTEGER PRIMARY KEY,
+        copies_total INTEGER NOT NULL DEFAULT 0,
+        copies_available INTEGER NOT NULL DEFAULT 0,
+        holds_waiting INTEGER NOT NULL DEFAULT 0,
+        CHECK (copies_available BETWEEN 0 AND copies_total),
+        CHECK (holds_waiting >= 0)
+    )
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_copies_insert AFTER INSERT ON books BEGIN
+        INSERT INTO book_copies (book_id) VALUES (new.id);
+        INSERT INTO book_availability (book_id, copies_total, copies_available) VALUES (new.id, 1, 1)
+        ON CONFLICT (book_id) DO UPDATE SET copies_total = copies_total + 1,
+                                            copies_available = copies_available + 1;
+    END
+    ''')
+    conn.execute('''
+    INSERT INTO book_copies (book_id)
+    SELECT id FROM books
+    WHERE NOT EXISTS (SELECT 1 FROM book_availability WHERE book_id = books.id)
+    ORDER BY id
+    ''')
+    conn.execute('''
+    INSERT INTO book_availability (book_id, copies_total, copies_available)
+    SELECT book_id, COUNT(*), SUM(status = 'available') FROM book_copies
+    WHERE NOT EXISTS (SELECT 1 FROM book_availability WHERE book_id = book_copies.book_id)
+    GROUP BY book_id
+    ''')
+
+def _migrate_event_log(conn):
+    """Create the event log and the decayed popularity scores rolled up from it
+
+    events.py buffers card impressions, searches and checkouts in memory and
+    appends them here in batches. The rollup folds new events into
+    book_scores, tracking the last event folded in popularity_rollup.
+    """
+    # AUTOINCREMENT so pruning old events never lets an id be reused below
+    # the rollup's last_event_id; created_at is Unix time for the decay math
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL CHECK (kind IN ('impression', 'search', 'checkout')),
+        book_id INTEGER,
+        query TEXT,
+        results INTEGER,
+        created_at REAL NOT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS book_scores (
+        book_id INTEGER PRIMARY KEY,
+        score REAL NOT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS popularity_rollup (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_event_id INTEGER NOT NULL,
+        score_epoch REAL NOT NULL,
+        rolled_up_at REAL
+    )
+    ''')
+    conn.execute(
+        "INSERT OR IGNORE INTO popularity_rollup (id, last_event_id, score_epoch) VALUES (1, 0, ?)",
+        (time.time(),)
+    )
+
+# Ordered schema migrations as (version, name, function). Each one runs once
+# per database file inside its own transaction and is recorded in
+# schema_migrations; append new migrations with the next version number.
+MIGRATIONS = [
+    (1, "base tables", _migrate_base_tables),
+    (2, "full-text search index", _migrate_search_index),
+    (3, "catalog indexes", _migrate_catalog_indexes),
+    (4, "catalog version counter", _migrate_catalog_version),
+    (5, "sample data", _migrate_sample_data),
+    (6, "book key index", _migrate_book_key_index),
+    (7, "collection statistics", _migrate_collection_stats),
+    (8, "cover checks", _migrate_cover_checks),
+    (9, "fuzzy search terms", _migrate_search_terms),
+    (10, "similar books", _migrate_similar_books),
+    (11, "suggestion counts", _migrate_suggestion_counts),
+    (12, "duplicate detection index", _migrate_duplicate_index),
+    (13, "suggestion review index", _migrate_suggestion_review_index),
+    (14, "visit scheduling", _migrate_visits),
+    (15, "circulation", _migrate_circulation),
+    (16, "event log", _migrate_event_log),
+]
+
+# Migrations that build the per-row indexes and triggers on books. bulk_load()
+# drops those for the duration of a load and re-runs these to restore them,
+# so they must be idempotent and bring anything derived from books up to date.
+CATALOG_MAINTENANCE = (
+    _migrate_search_index,
+    _migrate_catalog_indexes,
+    _migrate_catalog_version,
+    _migrate_collection_stats,
+    _migrate_cover_checks,
+    _migrate_search_terms,
+    _migrate_similar_books,
+    _migrate_duplicate_index,
+    _migrate_circulation,
+)
+
+# Indexes bulk_load() leaves in place because the load itself reads them
+BULK_LOAD_KEEP_INDEXES = {"idx_books_title_author"}
+
+def get_schema_version(conn):
+    """Return the highest migration version applied to a database"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+
+def run_migrations(conn):
+    """Apply any pending migrations and return the names of those applied
+
+    Each migration takes the write lock with BEGIN IMMEDIATE and re-checks the
+    schema version, so processes starting at the same time never apply the
+    same migration twice.
+    """
+    applied = []
+    if get_schema_version(conn) >= MIGRATIONS[-1][0]:
+        return applied
+    
+    for version, name, migrate in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) < version:
+                migrate(conn)
+                conn.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (?, ?)",
+                    (version, name)
+                )
+                applied.append(name)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return applied
+
+@contextmanager
+def bulk_load(conn):
+    """Suspend per-row index and trigger maintenance on books for a bulk load
+
+    Triggers and secondary indexes on books are dropped on entry and rebuilt in
+    one pass on exit, with a single catalog version bump. Searches and sorted
+    listings are incomplete while the load runs.
+    """
+    suspended = conn.execute('''
+    SELECT type, name FROM sqlite_master
+    WHERE tbl_name = 'books' AND type IN ('trigger', 'index') AND sql IS NOT NULL
+    ''').fetchall()
+    for object_type, name in suspended:
+        if name not in BULK_LOAD_KEEP_INDEXES:
+            conn.execute(f'DROP {object_type.upper()} IF EXISTS "{name}"')
     conn.commit()
-    conn.close()
+    
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        conn.execute("BEGIN IMMEDIATE")
+        for migrate in CATALOG_MAINTENANCE:
+            migrate(conn)
+        conn.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+        conn.commit()
 
+def upsert_books(conn, books):
+    """Insert or update a batch of books keyed on (title, author)
+
+    The batch is staged in a temporary table and merged with one set-based
+    UPDATE and one INSERT ... SELECT; later duplicates within a batch win.
+    The caller owns the transaction. Returns ``(inserted, updated)``.
+    """
+    conn.execute('''
+    CREATE TEMP TABLE IF NOT EXISTS book_import (
+        title TEXT NOT NULL,
+        author TEXT NOT NULL,
+        genre TEXT NOT NULL,
+        age_group TEXT NOT NULL,
+        description TEXT,
+        cover_url TEXT,
+        popularity INTEGER,
+        PRIMARY KEY (title, author)
+    )
+    ''')
+    conn.execute("DELETE FROM book_import")
+    conn.executemany('''
+    INSERT OR REPLACE INTO book_import (title, author, genre, age_group, description, cover_url, popularity)
+    VALUES (:title, :author, :genre, :age_group, :description, :cover_url, :popularity)
+    ''', books)
+    
+    updated = conn.execute('''
+    UPDATE books SET
+        genre = staged.genre,
+        age_group = staged.age_group,
+        description = staged.description,
+        cover_url = staged.cover_url,
+        popularity = staged.popularity
+    FROM book_import AS staged
+    WHERE books.title = staged.title AND books.author = staged.author
+    ''').rowcount
+    inserted = conn.execute('''
+    INSERT INTO books (title, author, genre, age_group, description, cover_url, popularity)
+    SELECT title, author, genre, age_group, description, cover_url, popularity
+    FROM book_import AS staged
+    WHERE NOT EXISTS (
+        SELECT 1 FROM books
+        WHERE books.title = staged.title AND books.author = staged.author
+    )
+    ''').rowcount
+    index_pending_search_terms(conn)
+    return inserted, updated
+
+# Database files already migrated by this process
+_initialized_files = set()
+_initialize_lock = threading.Lock()
+
+@timed
+def initialize_database():
+    """Bring the database schema up to date, once per process and file
+
+    Calls after the first for the same DB_FILE return immediately, so this is
+    safe to call on every Streamlit rerun.
+    """
+    if DB_FILE in _initialized_files:
+        return
+    with _initialize_lock:
+        if DB_FILE in _initialized_files:
+            return
+        with connection() as conn:
+            run_migrations(conn)
+        _initialized_files.add(DB_FILE)
+
+CATALOG_VERSION_QUERY = "SELECT version FROM catalog_version WHERE id = 1"
+
+def get_catalog_version():
+    """Return the catalog version, which changes whenever books change
+
+    With USE_MEMORY_SNAPSHOT on this is the version of the snapshot catalog
+    reads are served from, which trails the database briefly.
+    """
+    if USE_MEMORY_SNAPSHOT:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            return snapshot.version
+    with connection() as conn:
+        return conn.execute(CATALOG_VERSION_QUERY).fetchone()[0]
+
+class SnapshotBusyError(sqlite3.OperationalError):
+    """Every private copy of a snapshot is checked out"""
+
+class SnapshotPool(ConnectionPool):
+    """A pool of the private in-memory copies of one snapshot
+
+    Once every copy is checked out, connection() raises SnapshotBusyError
+    rather than make another.
+    """
+
+    def __init__(self, copies):
+        super().__init__(":memory:", len(copies))
+        for conn in copies:
+            self._idle.put_nowait(conn)
+
+    def _connect(self):
+        raise SnapshotBusyError("every snapshot copy is in use")
+
+class Snapshot:
+    """Private in-memory copies of the database taken at one catalog version
+
+    A shared-cache memory database steps one statement at a time across all
+    its connections, so each of the SNAPSHOT_COPIES readers gets a separate
+    copy instead. The first is backed up from disk and the others from it,
+    so all hold the same version.
+    """
+
+    def __init__(self):
+        self.db_file = DB_FILE
+        copies = []
+        try:
+            for _ in range(SNAPSHOT_COPIES):
+                conn = sqlite3.connect(
+                    ":memory:",
+                    check_same_thread=False,
+                    cached_statements=CACHED_STATEMENTS,
+                    factory=TimedConnection
+                )
+                conn.row_factory = sqlite3.Row
+                copies.append(conn)
+                if len(copies) == 1:
+                    with connection() as disk:
+                        disk.backup(conn)
+                else:
+                    copies[0].backup(conn)
+            for conn in copies:
+                conn.execute("PRAGMA query_only = ON")
+            self.version = copies[0].execute(CATALOG_VERSION_QUERY).fetchone()[0]
+        except BaseException:
+            for conn in copies:
+                conn.close()
+            raise
+        self.pool = SnapshotPool(copies)
+
+    def close(self):
+        """Free the copies, each once the reader using it is done"""
+        self.pool.close()
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+_snapshot_retry_at = 0.0
+_refresher_thread = None
+
+@timed
+def take_snapshot():
+    """Copy the database to memory, once per pooled reader"""
+    return Snapshot()
+
+def refresh_snapshot():
+    """Take a new snapshot if there is none or the version on disk has moved on
+
+    Returns the snapshot reads are served from now, or None if taking one
+    has failed; reads then go to disk and no new snapshot is tried for
+    SNAPSHOT_REFRESH_SECONDS. The new copies are built while readers keep
+    using the old ones and replace them in a single assignment.
+    """
+    global _snapshot, _snapshot_retry_at
+    with _snapshot_lock:
+        snapshot = _snapshot
+        if snapshot is not None and snapshot.db_file == DB_FILE:
+            with connection() as conn:
+                if conn.execute(CATALOG_VERSION_QUERY).fetchone()[0] == snapshot.version:
+                    return snapshot
+        elif time.monotonic() < _snapshot_retry_at:
+            return None
+        try:
+            _snapshot = take_snapshot()
+        except (sqlite3.Error, MemoryError):
+            logger.exception("Taking an in-memory snapshot failed; serving reads from disk")
+            _snapshot = None
+            _snapshot_retry_at = time.monotonic() + SNAPSHOT_REFRESH_SECONDS
+        if snapshot is not None:
+            snapshot.close()
+        _start_snapshot_refresher()
+        return _snapshot
+
+def get_snapshot():
+    """Return the snapshot of DB_FILE, taking the first one if needed"""
+    snapshot = _snapshot
+    if snapshot is None or snapshot.db_file != DB_FILE:
+        snapshot = refresh_snapshot()
+    return snapshot
+
+def close_snapshot():
+    """Drop the in-memory snapshot; the next snapshot read takes a new one"""
+    global _snapshot
+    with _snapshot_lock:
+        if _snapshot is not None:
+            _snapshot.close()
+            _snapshot = None
+
+def _start_snapshot_refresher():
+    """Check for catalog changes from a daemon thread, once per process"""
+    global _refresher_thread
+    if _refresher_thread is not None:
+        return
+
+    def loop():
+        while True:
+            time.sleep(SNAPSHOT_REFRESH_SECONDS)
+            snapshot = _snapshot
+            # A snapshot of another file is replaced by the next read instead
+            if not USE_MEMORY_SNAPSHOT or snapshot is None or snapshot.db_file != DB_FILE:
+                continue
+            try:
+                refresh_snapshot()
+            except Exception:  # Keep serving the current snapshot
+                logger.exception("Snapshot refresh failed")
+
+    _refresher_thread = threading.Thread(target=loop, name="snapshot-refresher", daemon=True)
+    _refresher_thread.start()
+
+@contextmanager
+def read_connection():
+    """Yield a connection for catalog reads, from the snapshot if one is in use"""
+    while USE_MEMORY_SNAPSHOT:
+        snapshot = get_snapshot()
+        if snapshot is None:
+            break
+        with ExitStack() as stack:
+            try:
+                conn = stack.enter_context(snapshot.pool.connection())
+            except PoolClosedError:
+                # Replaced by a refresh since get_snapshot(); use the new one
+                continue
+            except SnapshotBusyError:
+                # More readers at once than copies; this one reads from disk
+                break
+            yield conn
+            return
+    with connection() as conn:
+        yield conn
+
+class QueryCache:
+    """A thread-safe, size-bounded LRU cache of catalog query results
+
+    Every entry remembers the catalog version it was computed at and only
+    counts as a hit while that version is still current.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        """Return ``(True, value)`` for a current entry, else ``(False, None)``"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, version, value):
+        """Store a result, evicting the least recently used entries if full"""
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every cached result and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return the hit/miss counters and current size of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+query_cache = QueryCache()
+
+def cached_read(func):
+    """Cache a catalog read function's results by its arguments
+
+    Results are shared between callers, so they must be treated as read-only.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not USE_QUERY_CACHE:
+            return func(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (DB_FILE, func.__name__, tuple(bound.arguments.items()))
+        version = get_catalog_version()
+        found, value = query_cache.get(key, version)
+        if not found:
+            value = func(*args, **kwargs)
+            query_cache.put(key, version, value)
+        return value
+
+    return wrapper
+
+def get_cache_stats():
+    """Return hit/miss counters for the catalog read cache"""
+    return query_cache.stats()
+
+# Columns of the books table, in table order
+BOOK_COLUMNS = ("id", "title", "author", "genre", "age_group", "description", "cover_url", "popularity")
+
+# Queries issued by the read functions below, kept at module level so the
+# query-plan checks in benchmark.py can EXPLAIN exactly what the app runs
+ALL_BOOKS_QUERY = "SELECT * FROM books ORDER BY popularity DESC, id"
+ALL_GENRES_QUERY = "SELECT genre FROM genre_counts ORDER BY genre"
+COLLECTION_STATS_QUERY = '''
+SELECT stats.total_books, stats.unique_genres, stats.unique_authors,
+       genres.genre, genres.book_count
+FROM collection_stats AS stats
+LEFT JOIN genre_counts AS genres
+ORDER BY genres.book_count DESC, genres.genre
+'''
+
+@timed
+@cached_read
 def get_all_books():
     """Retrieve all books from the database"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM books ORDER BY popularity DESC")
-    books = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return books
-
-def get_books_by_filter(genre=None, age_group=None, search_query=None):
-    """Get books filtered by genre, age group, and/or search query"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    query = "SELECT * FROM books WHERE 1=1"
+    with read_connection() as conn:
+        cursor = conn.execute(ALL_BOOKS_QUERY)
+        return [dict(row) for row in cursor.fetchall()]
+
+def build_search_expression(search_query):
+    """Turn free text into an FTS5 query matching every word as a prefix
+
+    Each word is quoted so punctuation in the input can never be read as FTS5
+    query syntax. Returns None when the text contains no searchable words.
+    """
+    words = re.findall(r"\w+", search_query or "")
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+def _filter_clause(genre=None, age_group=None, search_query=None, search_expression=None,
+                   available_only=False):
+    """Build the FROM/WHERE clause shared by the filtered catalog queries
+
+    ``search_expression`` is a ready-made FTS5 query used instead of the one
+    built from ``search_query``. ``available_only`` keeps books with a copy
+    on the shelf, read from the book_availability counters. Returns
+    the SQL, its parameters and whether the full-text index is used.
+    """
+    if search_expression is None:
+        search_expression = build_search_expression(search_query)
     params = []
     
+    if search_expression:
+        clause = '''
+        FROM books_fts
+        JOIN books ON books.id = books_fts.rowid
+        WHERE books_fts MATCH ?
+        '''
+        params.append(search_expression)
+    else:
+        clause = "FROM books WHERE 1=1"
+    
     if genre:
-        query += " AND genre = ?"
+        clause += " AND books.genre = ?"
         params.append(genre)
     
     if age_group:
-        query += " AND age_group = ?"
+        clause += " AND books.age_group = ?"
         params.append(age_group)
     
-    if search_query:
-        query += " AND (title LIKE ? OR author LIKE ?)"
-        search_param = f"%{search_query}%"
-        params.extend([search_param, search_param])
+    # One primary-key probe of the title's counters per candidate book keeps
+    # the popularity index order, so a page still stops after PAGE_SIZE rows
+    if available_only:
+        clause += '''
+        AND EXISTS (
+            SELECT 1 FROM book_availability
+            WHERE book_availability.book_id = books.id AND copies_available > 0
+        )'''
+    
+    return clause, params, bool(search_expression)
+
+def build_filter_query(genre=None, age_group=None, search_query=None, available_only=False):
+    """Build the SQL and parameters used by get_books_by_filter"""
+    clause, params, is_search = _filter_clause(genre, age_group, search_query,
+                                               available_only=available_only)
+    
+    if is_search:
+        query = f"SELECT books.* {clause} ORDER BY {SEARCH_RANK}, books.popularity DESC, books.id"
+        params.extend(SEARCH_WEIGHTS)
+    else:
+        query = f"SELECT books.* {clause} ORDER BY books.popularity DESC, books.id"
+    
+    return query, params
+
+def build_page_query(genre=None, age_group=None, search_query=None,
+                     cursor=None, page_size=PAGE_SIZE, available_only=False):
+    """Build the SQL and parameters for one keyset-paginated catalog page
+
+    Browsing pages are keyed on (popularity, id) so each page is a range read
+    from the popularity indexes. Search pages keep the BM25 relevance order
+    and are keyed on (score, popularity, id). ``cursor`` is the key of the
+    last book on the previous page, or None for the first page.
+    """
+    clause, params, is_search = _filter_clause(genre, age_group, search_query,
+                                               available_only=available_only)
+    
+    if is_search:
+        query = f"SELECT * FROM (SELECT books.*, {SEARCH_RANK} AS search_score {clause})"
+        params = [*SEARCH_WEIGHTS, *params]
+        if cursor:
+            score, popularity, book_id = cursor
+            query += " WHERE (search_score, -popularity, id) > (?, ?, ?)"
+            params.extend([score, -popularity, book_id])
+        query += " ORDER BY search_score, popularity DESC, id LIMIT ?"
+    else:
+        query = f"SELECT books.* {clause}"
+        if cursor:
+            popularity, book_id = cursor
+            query += " AND books.popularity <= ? AND (books.popularity < ? OR books.id > ?)"
+            params.extend([popularity, popularity, book_id])
+        query += " ORDER BY books.popularity DESC, books.id LIMIT ?"
+    
+    # Fetch one extra row to learn whether another page follows
+    params.append(page_size + 1)
+    return query, params
+
+def build_count_query(genre=None, age_group=None, search_query=None, available_only=False):
+    """Build the SQL and parameters counting the books matching a filter"""
+    clause, params, _ = _filter_clause(genre, age_group, search_query,
+                                       available_only=available_only)
+    return f"SELECT COUNT(*) {clause}", params
+
+# The trigrams of a query word held by the most indexed words, commonest first
+COMMON_TRIGRAMS_QUERY = '''
+SELECT trigram FROM search_trigrams
+WHERE trigram IN ({placeholders}) AND terms > ?
+ORDER BY terms DESC
+LIMIT ?
+'''
+
+# Spelling candidates for one query word: indexed words of about its length
+# sharing at least a given number of its trigrams, most shared first
+FUZZY_TERMS_QUERY = '''
+SELECT search_terms.term
+FROM (
+    SELECT term_id, COUNT(*) AS shared
+    FROM search_term_trigrams
+    WHERE trigram IN ({placeholders}) AND length BETWEEN ? AND ?
+    GROUP BY term_id
+    HAVING shared >= ?
+    ORDER BY shared DESC
+    LIMIT ?
+) AS candidates
+JOIN search_terms ON search_terms.id = candidates.term_id
+ORDER BY candidates.shared DESC
+'''
+
+def edit_distance(a, b, limit=None):
+    """Count the insertions, deletions, substitutions and adjacent
+    transpositions needed to turn one word into the other
+
+    With a ``limit``, gives up as soon as the distance must exceed it and
+    returns ``limit + 1``.
+    """
+    if limit is not None and abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous, current = None, list(range(len(b) + 1))
+    for i, a_char in enumerate(a, start=1):
+        before, previous, current = previous, current, [i]
+        for j, b_char in enumerate(b, start=1):
+            distance = previous[j - 1] + (a_char != b_char)
+            if previous[j] < distance:
+                distance = previous[j] + 1
+            if current[j - 1] < distance:
+                distance = current[j - 1] + 1
+            if (i > 1 and j > 1 and a_char == b[j - 2] and a[i - 2] == b_char
+                    and before[j - 2] < distance):
+                distance = before[j - 2] + 1
+            current.append(distance)
+        # A transposition can reach back two rows, so both must be over
+        if limit is not None and min(current) > limit and min(previous) > limit:
+            return limit + 1
+    if limit is not None:
+        return min(current[-1], limit + 1)
+    return current[-1]
+
+def _max_edits(word):
+    """Edits tolerated in a query word: more for longer words"""
+    return 1 if len(word) <= 4 else 2 if len(word) <= 8 else 3
+
+def _fuzzy_term_matches(conn, word):
+    """Return {indexed word: similarity} for the spellings closest to a query word
+
+    One edit changes at most four of a word's padded trigrams, so a word
+    within _max_edits() shares at least that many fewer trigrams with the
+    query; the index lookup drops everything else. Trigrams common enough to
+    match hundreds of words are left out of the lookup, which then reads a
+    bounded number of index rows. Candidates are scored by the mean of their
+    trigram similarity and normalized edit similarity. The fewest edits a
+    candidate's length and shared trigrams allow give it a best possible
+    score, and the edit distance is only computed while that could still
+    place it among the best FUZZY_TERMS_PER_WORD, which are kept.
+    """
+    if len(word) < 3:
+        return {}
+    trigrams = _trigrams(word)
+    max_edits = _max_edits(word)
+    common = conn.execute(
+        COMMON_TRIGRAMS_QUERY.format(placeholders=", ".join("?" * len(trigrams))),
+        (*trigrams, FUZZY_TRIGRAM_TERMS, len(trigrams) // 4)
+    )
+    lookup = sorted(trigrams.difference(trigram for (trigram,) in common))
+    query = FUZZY_TERMS_QUERY.format(placeholders=", ".join("?" * len(lookup)))
+    params = (*lookup, len(word) - max_edits, len(word) + max_edits,
+              max(1, len(lookup) - 4 * max_edits), FUZZY_CANDIDATE_TERMS)
+    candidates = []
+    for (term,) in conn.execute(query, params):
+        term_trigrams = _trigrams(term)
+        shared = len(trigrams & term_trigrams)
+        similarity = shared / (len(trigrams) + len(term_trigrams) - shared)
+        fewest_edits = max(abs(len(word) - len(term)), -(-(len(trigrams) - shared) // 4))
+        if fewest_edits <= max_edits:
+            best_score = (similarity + 1 - fewest_edits / max(len(word), len(term))) / 2
+            candidates.append((best_score, similarity, term))
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    
+    matches = {}
+    for best_score, similarity, term in candidates:
+        if len(matches) == FUZZY_TERMS_PER_WORD and best_score <= min(matches.values()):
+            break
+        distance = edit_distance(word, term, max_edits)
+        if distance <= max_edits:
+            edit_similarity = 1 - distance / max(len(word), len(term))
+            matches[term] = (similarity + edit_similarity) / 2
+            if len(matches) > FUZZY_TERMS_PER_WORD:
+                del matches[min(matches, key=matches.get)]
+    return dict(sorted(matches.items(), key=lambda match: match[1], reverse=True))
+
+def build_fuzzy_expression(word_matches):
+    """Build the FTS5 query for fuzzy search from per-word spelling matches
+
+    ``word_matches`` pairs each query word with its _fuzzy_term_matches().
+    Every word must match a title or author word, either one of its close
+    spellings or a word it is a prefix of. Words with no close spelling and
+    room for typos are left out. Returns None if no word is left.
+    """
+    groups = []
+    for word, matches in word_matches:
+        if not matches and len(word) >= 3:
+            continue
+        alternatives = [f'"{term}"' for term in matches]
+        alternatives.append(f'"{word}"*')
+        groups.append("(" + " OR ".join(alternatives) + ")")
+    if not groups:
+        return None
+    return "{title author} : (" + " AND ".join(groups) + ")"
+
+def build_fuzzy_query(search_expression, genre=None, age_group=None, limit=FUZZY_CANDIDATE_BOOKS,
+                      available_only=False):
+    """Build the SQL and parameters fetching the candidate books of a fuzzy search"""
+    clause, params, _ = _filter_clause(genre, age_group, search_expression=search_expression,
+                                       available_only=available_only)
+    query = f"SELECT books.* {clause} ORDER BY books.popularity DESC, books.id LIMIT ?"
+    params.append(limit)
+    return query, params
+
+def _fuzzy_score(book, word_matches):
+    """Score a book by how closely its title and author words match the query"""
+    book_words = normalize_words(f"{book['title']} {book['author']}")
+    total = 0.0
+    for word, matches in word_matches:
+        best = 0.0
+        for book_word in book_words:
+            if book_word in matches:
+                best = max(best, matches[book_word])
+            elif book_word.startswith(word):
+                best = max(best, len(word) / len(book_word))
+        total += best
+    return total / len(word_matches)
+
+@timed
+@cached_read
+def get_books_by_filter(genre=None, age_group=None, search_query=None, available_only=False):
+    """Get books filtered by genre, age group, search query and/or availability
+
+    The search query is matched against title, author and description through
+    the full-text index, with results ranked by BM25 relevance.
+    ``available_only`` keeps books with at least one copy on the shelf.
+    """
+    query, params = build_filter_query(genre, age_group, search_query, available_only)
+    with read_connection() as conn:
+        cursor = conn.execute(query, params)
+        return [dict(row) for row in cursor.fetchall()]
+
+def iter_books(genre=None, age_group=None, search_query=None, chunk_size=1000,
+               available_only=False):
+    """Yield the filtered books in chunks of rows straight from the cursor
+
+    Rows are sqlite3.Row tuples in BOOK_COLUMNS order. Only one chunk is held
+    in memory at a time, so this suits exports of the whole catalog.
+    """
+    query, params = build_filter_query(genre, age_group, search_query, available_only)
+    with connection() as conn:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+@timed
+@cached_read
+def get_books_page(genre=None, age_group=None, search_query=None,
+                   cursor=None, page_size=PAGE_SIZE, available_only=False):
+    """Get one page of filtered books and the cursor for the next page
+
+    Returns ``(books, next_cursor)``; ``next_cursor`` is None on the last page.
+    """
+    query, params = build_page_query(genre, age_group, search_query, cursor, page_size,
+                                     available_only)
+    with read_connection() as conn:
+        books = [dict(row) for row in conn.execute(query, params).fetchall()]
+    
+    next_cursor = None
+    if len(books) > page_size:
+        books = books[:page_size]
+        last = books[-1]
+        if 'search_score' in last:
+            next_cursor = (last['search_score'], last['popularity'], last['id'])
+        else:
+            next_cursor = (last['popularity'], last['id'])
     
-    query += " ORDER BY popularity DESC"
+    for book in books:
+        book.pop('search_score', None)
+    return books, next_cursor
+
+@timed
+@cached_read
+def count_books(genre=None, age_group=None, search_query=None, available_only=False):
+    """Count the books matching a filter without fetching them"""
+    query, params = build_count_query(genre, age_group, search_query, available_only)
+    with read_connection() as conn:
+        return conn.execute(query, params).fetchone()[0]
+
+@timed
+@cached_read
+def get_books_fuzzy(search_query, genre=None, age_group=None, limit=PAGE_SIZE,
+                    available_only=False):
+    """Find books whose title or author approximately matches the search query
+
+    Each query word is matched against the trigram index of title and author
+    words to find close spellings ("tolkein" finds "tolkien"), and the books
+    containing them are fetched through the full-text index with the genre
+    age group and availability filters applied. The FUZZY_CANDIDATE_BOOKS most
+    popular of those are re-ranked by similarity to the query and the best
+    ``limit`` returned. They are not ranked by BM25, which would have to
+    count every close spelling across the whole index first.
+    """
+    words = list(dict.fromkeys(normalize_words(search_query)))
+    if not words:
+        return []
+    
+    with read_connection() as conn:
+        word_matches = [(word, _fuzzy_term_matches(conn, word)) for word in words]
+        search_expression = build_fuzzy_expression(word_matches)
+        if search_expression is None:
+            return []
+        query, params = build_fuzzy_query(search_expression, genre, age_group,
+                                          available_only=available_only)
+        books = [dict(row) for row in conn.execute(query, params).fetchall()]
     
-    cursor.execute(query, params)
-    books = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return books
+    # Candidates arrive in catalog order, so ties keep the more popular book first
+    scores = {book['id']: _fuzzy_score(book, word_matches) for book in books}
+    books.sort(key=lambda book: -scores[book['id']])
+    return books[:limit]
 
+@timed
+@cached_read
 def get_all_genres():
     """Get all unique genres from the database"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT genre FROM books ORDER BY genre")
-    genres = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return genres
+    with read_connection() as conn:
+        cursor = conn.execute(ALL_GENRES_QUERY)
+        return [row[0] for row in cursor.fetchall()]
+
+@timed
+@cached_read
+def get_collection_stats():
+    """Get the collection overview from the maintained aggregate tables
+
+    Returns total_books, unique_genres, unique_authors and genre_counts, a list
+    of (genre, book_count) pairs from most to least common. The cost depends
+    on the number of genres, not the size of the catalog.
+    """
+    with read_connection() as conn:
+        rows = conn.execute(COLLECTION_STATS_QUERY).fetchall()
+    
+    first = rows[0]
+    return {
+        'total_books': first['total_books'],
+        'unique_genres': first['unique_genres'],
+        'unique_authors': first['unique_authors'],
+        'genre_counts': [(row['genre'], row['book_count']) for row in rows if row['genre'] is not None]
+    }
+
+# Precomputed neighbours of a set of books, read straight off the
+# similar_books primary key
+SIMILAR_BOOKS_QUERY = '''
+SELECT similar.book_id AS similar_to, books.*
+FROM similar_books AS similar
+JOIN books ON books.id = similar.similar_id
+WHERE similar.book_id IN ({placeholders})
+ORDER BY similar.book_id, similar.rank
+'''
+
+@timed
+@cached_read
+def get_similar_books(book_ids):
+    """Get the precomputed "more like this" books for each of some books
+
+    ``book_ids`` is a tuple. Returns {book_id: [book, ...]} with the most
+    similar book first; books whose neighbours are not computed yet map to
+    an empty list. No similarity is computed here.
+    """
+    similar = {book_id: [] for book_id in book_ids}
+    if not book_ids:
+        return similar
+    query = SIMILAR_BOOKS_QUERY.format(placeholders=", ".join("?" * len(book_ids)))
+    with read_connection() as conn:
+        for row in conn.execute(query, book_ids).fetchall():
+            book = dict(row)
+            similar[book.pop('similar_to')].append(book)
+    return similar
+
+def explain_query_plan(query, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for a query"""
+    with connection() as conn:
+        cursor = conn.execute("EXPLAIN QUERY PLAN " + query, params)
+        return [row["detail"] for row in cursor.fetchall()]
+
+# Distinct catalogued cover URLs never checked, or last checked before the
+# cutoff passed as a SQLite datetime modifier such as '-24 hours'; read in
+# order from idx_books_cover_url, probing cover_checks by URL
+COVER_URLS_TO_CHECK_QUERY = '''
+SELECT DISTINCT cover_url AS url FROM books
+WHERE cover_url > ''
+AND NOT EXISTS (
+    SELECT 1 FROM cover_checks
+    WHERE url = books.cover_url AND checked_at > datetime('now', ?)
+)
+'''
+
+@timed
+def get_cover_urls_to_check(recheck_after_hours=24):
+    """Get the cover URLs of catalogued books that are due for a check
+
+    A URL is due if it has never been checked, or its last check is older
+    than ``recheck_after_hours``. Suggested covers are not checked: they
+    are untrusted until a librarian approves the book.
+    """
+    with connection() as conn:
+        cursor = conn.execute(COVER_URLS_TO_CHECK_QUERY, (f"-{recheck_after_hours} hours",))
+        return [row[0] for row in cursor.fetchall()]
+
+@timed
+def record_cover_checks(results):
+    """Store the outcome of cover URL checks
+
+    ``results`` are dicts with url, status ('ok' or 'broken'), http_status,
+    content_type, content_length and error. When a URL changes between ok
+    and broken the catalog version is bumped, so cached pages pick up the
+    change in which cover is shown.
+    """
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        changed = False
+        for result in results:
+            row = conn.execute("SELECT status FROM cover_checks WHERE url = ?", (result['url'],)).fetchone()
+            # Covers that were never checked are shown as if they were ok
+            changed = changed or (row[0] if row else 'ok') != result['status']
+        conn.executemany('''
+        INSERT INTO cover_checks (url, status, http_status, content_type, content_length, error, checked_at)
+        VALUES (:url, :status, :http_status, :content_type, :content_length, :error, CURRENT_TIMESTAMP)
+        ON CONFLICT (url) DO UPDATE SET
+            status = excluded.status,
+            http_status = excluded.http_status,
+            content_type = excluded.content_type,
+            content_length = excluded.content_length,
+            error = excluded.error,
+            checked_at = excluded.checked_at
+        ''', results)
+        if changed:
+            conn.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+        conn.commit()
+
+BROKEN_COVER_URLS_QUERY = "SELECT url FROM cover_checks WHERE status = 'broken'"
 
+@timed
+@cached_read
+def get_broken_cover_urls():
+    """Get the set of cover URLs the last check found broken"""
+    with read_connection() as conn:
+        cursor = conn.execute(BROKEN_COVER_URLS_QUERY)
+        return frozenset(row[0] for row in cursor.fetchall())
+
+# Books and suggestions sharing a bucket with a key in any band, read as one
+# primary-key probe per band; an item found in several bands repeats
+DUPLICATE_CANDIDATES_QUERY = '''
+SELECT source, item_id FROM duplicate_buckets
+WHERE {bands}
+'''
+
+def _find_duplicates(conn, title, author):
+    """Return the closest duplicate book and suggestion of a title and author
+
+    Either may be None. Each is a dict of the row's id, title and author
+    (and times_suggested for a suggestion) plus its key similarity.
+    """
+    key = duplicate_key(title, author)
+    if not key:
+        return None, None
+    buckets = list(enumerate(duplicate_buckets([key])[0]))
+    query = DUPLICATE_CANDIDATES_QUERY.format(bands=" OR ".join(["(band = ? AND bucket = ?)"] * len(buckets)))
+    candidates = {'book': set(), 'suggestion': set()}
+    for source, item_id in conn.execute(query, [value for bucket in buckets for value in bucket]):
+        candidates[source].add(item_id)
+    
+    best = {}
+    for source, columns, table in (
+        ('book', "id, title, author", "books"),
+        ('suggestion', "id, title, author, times_suggested", "suggestions"),
+    ):
+        best[source] = None
+        ids = sorted(candidates[source])
+        if not ids:
+            continue
+        rows = conn.execute(
+            f"SELECT {columns} FROM {table} WHERE id IN ({', '.join('?' * len(ids))}) ORDER BY id",
+            ids
+        )
+        for row in rows:
+            similarity = confirmed_similarity(key, duplicate_key(row['title'], row['author']))
+            if similarity and (best[source] is None or similarity > best[source]['similarity']):
+                best[source] = {**dict(row), 'similarity': similarity}
+    return best['book'], best['suggestion']
+
+@timed
+def find_duplicates(title, author):
+    """Look up a title and author among the books and suggestions
+
+    Returns ``(book, suggestion)``, the closest match in each or None.
+    """
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _index_pending_duplicates(conn)
+        duplicates = _find_duplicates(conn, title, author)
+        conn.commit()
+    return duplicates
+
+@timed
 def add_book_suggestion(title, author, genre, age_group, description, cover_url):
-    """Add a book suggestion to the database"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    """Add a book suggestion unless the book is already known
+
+    Returns a dict whose 'status' is one of:
+
+    - 'in_catalog': the library already has the book, given as 'book'
+    - 'already_suggested': someone suggested it before, so that suggestion's
+      counter is incremented instead of adding a row; 'times_suggested' is
+      the count before this submission
+    - 'added': the suggestion was stored with id 'suggestion_id'
+    """
+    with connection() as conn:
+        # Hold the write lock from the check to the write, so two people
+        # suggesting the same book at once still produce one row
+        conn.execute("BEGIN IMMEDIATE")
+        _index_pending_duplicates(conn)
+        book, suggestion = _find_duplicates(conn, title, author)
+        if book is not None:
+            result = {'status': 'in_catalog', 'book': book}
+        elif suggestion is not None:
+            conn.execute(
+                "UPDATE suggestions SET times_suggested = times_suggested + 1 WHERE id = ?",
+                (suggestion['id'],)
+            )
+            result = {
+                'status': 'already_suggested',
+                'suggestion_id': suggestion['id'],
+                'times_suggested': suggestion['times_suggested'],
+            }
+        else:
+            cursor = conn.execute('''
+            INSERT INTO suggestions (title, author, genre, age_group, description, cover_url)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (title, author, genre, age_group, description, cover_url))
+            _index_pending_duplicates(conn)
+            result = {'status': 'added', 'suggestion_id': cursor.lastrowid}
+        conn.commit()
+    return result
+
+# Temporary table of the duplicates dedupe_suggestions() folds into older rows
+SUGGESTION_MERGE_TABLE = '''
+CREATE TEMP TABLE IF NOT EXISTS suggestion_merge (
+    duplicate_id INTEGER PRIMARY KEY,
+    keep_id INTEGER NOT NULL
+)
+'''
+
+# Add each group's counters to the row it is folded into, then drop the rest
+MERGE_SUGGESTION_COUNTS_QUERY = '''
+UPDATE suggestions SET times_suggested = times_suggested + merged.total
+FROM (
+    SELECT pair.keep_id, SUM(duplicate.times_suggested) AS total
+    FROM suggestion_merge AS pair
+    -- CROSS JOIN keeps the few merged pairs as the outer loop
+    CROSS JOIN suggestions AS duplicate ON duplicate.id = pair.duplicate_id
+    GROUP BY pair.keep_id
+) AS merged
+WHERE suggestions.id = merged.keep_id
+'''
+REMOVE_MERGED_SUGGESTIONS_QUERY = "DELETE FROM suggestions WHERE id IN (SELECT duplicate_id FROM suggestion_merge)"
+
+@timed
+def dedupe_suggestions():
+    """Merge duplicate rows of the suggestions table
+
+    Suggestions sharing an LSH bucket are compared with
+    confirmed_similarity(), and each group of duplicates is folded into its
+    oldest row, whose counter becomes the sum of the group's. Returns the
+    number of suggestions before the merge, the duplicate groups found and
+    the rows removed.
+    """
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _index_pending_duplicates(conn)
+        keys = {
+            row['id']: duplicate_key(row['title'], row['author'])
+            for row in conn.execute("SELECT id, title, author FROM suggestions")
+        }
+        members = {}
+        for band, bucket, item_id in conn.execute(
+                "SELECT band, bucket, item_id FROM duplicate_buckets WHERE source = 'suggestion'"):
+            members.setdefault((band, bucket), []).append(item_id)
+        
+        # Union-find over the verified pairs in each bucket, rooted at the
+        # oldest suggestion of each group
+        parent = {}
+        def find(item_id):
+            root = item_id
+            while parent.get(root, root) != root:
+                root = parent[root]
+            parent[item_id] = root
+            return root
+        for ids in members.values():
+            ids.sort()
+            for i, first in enumerate(ids):
+                for second in ids[i + 1:]:
+                    first_root, second_root = find(first), find(second)
+                    if first_root != second_root and confirmed_similarity(keys[first], keys[second]):
+                        parent[max(first_root, second_root)] = min(first_root, second_root)
+        merges = [(item_id, find(item_id)) for item_id in parent if find(item_id) != item_id]
+        
+        conn.execute(SUGGESTION_MERGE_TABLE)
+        conn.execute("DELETE FROM suggestion_merge")
+        conn.executemany("INSERT INTO suggestion_merge (duplicate_id, keep_id) VALUES (?, ?)", merges)
+        conn.execute(MERGE_SUGGESTION_COUNTS_QUERY)
+        conn.execute(REMOVE_MERGED_SUGGESTIONS_QUERY)
+        conn.commit()
+    return {
+        'suggestions': len(keys),
+        'groups': len({keep_id for _, keep_id in merges}),
+        'removed': len(merges),
+    }
+
+# Suggestions awaiting review, most requested first
+SUGGESTIONS_QUERY = '''
+SELECT id, title, author, genre, age_group, description, cover_url,
+       times_suggested, submission_date
+FROM suggestions
+ORDER BY times_suggested DESC, id
+LIMIT ?
+'''
+
+@timed
+def get_suggestions(limit=1000):
+    """Get up to ``limit`` suggestions awaiting review, most requested first"""
+    with connection() as conn:
+        cursor = conn.execute(SUGGESTIONS_QUERY, (limit,))
+        return [dict(row) for row in cursor.fetchall()]
+
+COUNT_SUGGESTIONS_QUERY = "SELECT COUNT(*) FROM suggestions"
+
+@timed
+def count_suggestions():
+    """Count the suggestions awaiting review"""
+    with connection() as conn:
+        return conn.execute(COUNT_SUGGESTIONS_QUERY).fetchone()[0]
+
+# Temporary table of the suggestion ids being approved or rejected
+SUGGESTION_REVIEW_TABLE = "CREATE TEMP TABLE IF NOT EXISTS suggestion_review (id INTEGER PRIMARY KEY)"
+
+# The oldest of the staged suggestions for each title and author the
+# catalog does not have yet, copied into books
+APPROVE_SUGGESTIONS_QUERY = '''
+INSERT INTO books (title, author, genre, age_group, description, cover_url)
+SELECT title, author, genre, age_group, description, cover_url
+FROM suggestions
+WHERE id IN (
+    SELECT MIN(suggestions.id)
+    FROM suggestion_review
+    JOIN suggestions ON suggestions.id = suggestion_review.id
+    GROUP BY suggestions.title, suggestions.author
+)
+AND NOT EXISTS (
+    SELECT 1 FROM books
+    WHERE books.title = suggestions.title AND books.author = suggestions.author
+)
+ORDER BY id
+'''
+REMOVE_REVIEWED_SUGGESTIONS_QUERY = "DELETE FROM suggestions WHERE id IN (SELECT id FROM suggestion_review)"
+
+def _stage_suggestion_ids(conn, suggestion_ids):
+    """Load suggestion ids into a temporary table for set-based statements"""
+    conn.execute(SUGGESTION_REVIEW_TABLE)
+    conn.execute("DELETE FROM suggestion_review")
+    conn.executemany("INSERT OR IGNORE INTO suggestion_review (id) VALUES (?)",
+                     ((suggestion_id,) for suggestion_id in suggestion_ids))
+
+@timed
+def approve_suggestions(suggestion_ids):
+    """Add suggestions to the catalog and remove them from the review queue
+
+    One INSERT ... SELECT copies the suggestions into books and one DELETE
+    removes them, in a single transaction. The triggers on books update the
+    search index, collection statistics and catalog version (and so the read
+    cache) as part of the same statements. Suggestions for a title and
+    author already in the catalog are removed without adding a copy.
+    Returns the number of books added and suggestions removed.
+    """
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _stage_suggestion_ids(conn, suggestion_ids)
+        added = conn.execute(APPROVE_SUGGESTIONS_QUERY).rowcount
+        index_pending_search_terms(conn)
+        removed = conn.execute(REMOVE_REVIEWED_SUGGESTIONS_QUERY).rowcount
+        conn.commit()
+    return {'added': added, 'removed': removed}
+
+@timed
+def reject_suggestions(suggestion_ids):
+    """Remove suggestions from the review queue in one statement
+
+    Returns the number of suggestions removed.
+    """
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _stage_suggestion_ids(conn, suggestion_ids)
+        removed = conn.execute(REMOVE_REVIEWED_SUGGESTIONS_QUERY).rowcount
+        conn.commit()
+    return removed
+
+# Remaining capacity of every slot on every day of a date range, read with
+# one primary-key probe per slot; days are generated, not stored
+VISIT_AVAILABILITY_QUERY = '''
+WITH RECURSIVE days (day) AS (
+    SELECT date(?)
+    UNION ALL
+    SELECT date(day, '+1 day') FROM days WHERE day < date(?)
+),
+times (start_time, end_time) AS (VALUES {slot_values})
+SELECT days.day AS visit_date, times.start_time, times.end_time,
+       COALESCE(slots.capacity, ?) AS capacity,
+       COALESCE(slots.capacity, ?) - COALESCE(slots.booked, 0) AS remaining
+FROM days
+CROSS JOIN times
+LEFT JOIN visit_slots AS slots
+    ON slots.visit_date = days.day AND slots.start_time = times.start_time
+ORDER BY days.day, times.start_time
+'''
+
+def build_visit_availability_query(start_date, end_date):
+    """Build the SQL and parameters used by get_visit_availability"""
+    query = VISIT_AVAILABILITY_QUERY.format(slot_values=", ".join(["(?, ?)"] * len(VISIT_SLOTS)))
+    params = [str(start_date), str(end_date)]
+    params.extend(time for slot in VISIT_SLOTS for time in slot)
+    params.extend([VISIT_SLOT_CAPACITY, VISIT_SLOT_CAPACITY])
+    return query, params
+
+@timed
+def get_visit_availability(start_date, end_date):
+    """Get the capacity and places left in every visit slot between two dates
+
+    Dates are ``datetime.date`` objects or ISO strings, both inclusive.
+    Returns dicts with visit_date, start_time, end_time, capacity and
+    remaining, ordered by date and time.
+    """
+    query, params = build_visit_availability_query(start_date, end_date)
+    with connection() as conn:
+        return [dict(row) for row in conn.execute(query, params).fetchall()]
+
+@timed
+def book_visit(visit_date, start_time, num_visitors, visitor_name, visitor_email,
+               visitor_phone=None, purpose=None, notes=None):
+    """Book places for a group in a visit slot if it has room for all of them
+
+    The places are taken with one conditional UPDATE inside a BEGIN
+    IMMEDIATE transaction, so concurrent bookings for the same slot are
+    serialized and can never overbook it. Returns a dict whose 'status' is
+    'booked', with the new 'visit_id', or 'full'; 'remaining' is the number
+    of places left in the slot either way. Raises ValueError for a slot that
+    is not offered or a group larger than a slot.
+    """
+    visit_date = str(visit_date)
+    slot_ends = dict(VISIT_SLOTS)
+    if start_time not in slot_ends:
+        raise ValueError(f"no visit slot starts at {start_time}")
+    if not 0 < num_visitors <= VISIT_SLOT_CAPACITY:
+        raise ValueError(f"a visit is for 1 to {VISIT_SLOT_CAPACITY} visitors")
     
-    cursor.execute('''
-    INSERT INTO suggestions (title, author, genre, age_group, description, cover_url)
-    VALUES (?, ?, ?, ?, ?, ?)
-    ''', (title, author, genre, age_group, description, cover_url))
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute('''
+        INSERT OR IGNORE INTO visit_slots (visit_date, start_time, capacity)
+        VALUES (?, ?, ?)
+        ''', (visit_date, start_time, VISIT_SLOT_CAPACITY))
+        taken = conn.execute('''
+        UPDATE visit_slots SET booked = booked + ?
+        WHERE visit_date = ? AND start_time = ? AND booked + ? <= capacity
+        ''', (num_visitors, visit_date, start_time, num_visitors)).rowcount
+        if taken:
+            visit_id = conn.execute('''
+            INSERT INTO visits (visit_date, start_time, num_visitors, visitor_name,
+                                visitor_email, visitor_phone, purpose, notes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (visit_date, start_time, num_visitors, visitor_name,
+                  visitor_email, visitor_phone, purpose, notes)).lastrowid
+        remaining = conn.execute(
+            "SELECT capacity - booked FROM visit_slots WHERE visit_date = ? AND start_time = ?",
+            (visit_date, start_time)
+        ).fetchone()[0]
+        conn.commit()
     
-    conn.commit()
-    conn.close()
+    if not taken:
+        return {'status': 'full', 'remaining': remaining}
+    return {'status': 'booked', 'visit_id': visit_id, 'remaining': remaining}
+
+@timed
+def cancel_visit(visit_id):
+    """Cancel a booked visit and give its places back to the slot
+
+    Returns False if there is no such visit.
+    """
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        visit = conn.execute(
+            "SELECT visit_date, start_time, num_visitors FROM visits WHERE id = ?", (visit_id,)
+        ).fetchone()
+        if visit is None:
+            conn.rollback()
+            return False
+        conn.execute("DELETE FROM visits WHERE id = ?", (visit_id,))
+        conn.execute('''
+        UPDATE visit_slots SET booked = booked - ?
+        WHERE visit_date = ? AND start_time = ?
+        ''', (visit['num_visitors'], visit['visit_date'], visit['start_time']))
+        conn.commit()
+    return True
+
+# Circulation. Every change to a copy, loan or hold updates the title's
+# book_availability counters in the same BEGIN IMMEDIATE transaction, so the
+# counters always agree with the rows they count. The catalog version is only
+# bumped when a title goes on or off the shelf, the one change the "available
+# now" filter can see, so busy circulation desks do not keep emptying the
+# catalog cache.
+
+def _availability(conn, book_id):
+    """Read a title's counters inside the caller's transaction"""
+    row = conn.execute(
+        "SELECT copies_total, copies_available, holds_waiting FROM book_availability WHERE book_id = ?",
+        (book_id,)
+    ).fetchone()
+    if row is None:
+        return {'copies_total': 0, 'copies_available': 0, 'holds_waiting': 0}
+    return dict(row)
+
+def _require_book(conn, book_id):
+    """Make sure a book exists and has a counters row; raises ValueError if not"""
+    if conn.execute("SELECT 1 FROM books WHERE id = ?", (book_id,)).fetchone() is None:
+        raise ValueError(f"no book with id {book_id}")
+    conn.execute("INSERT OR IGNORE INTO book_availability (book_id) VALUES (?)", (book_id,))
+
+# Circulation lookups made inside the write transactions below: the oldest
+# waiting hold on a title, a patron's ready hold on it, a copy on its shelf,
+# a copy's open loan, a patron's open hold on a title and a waiting hold's
+# place in the queue
+NEXT_WAITING_HOLD_QUERY = '''
+SELECT id, patron FROM holds WHERE book_id = ? AND status = 'waiting' ORDER BY id LIMIT 1
+'''
+READY_HOLD_QUERY = '''
+SELECT id, copy_id FROM holds WHERE book_id = ? AND status = 'ready' AND patron = ?
+'''
+SHELF_COPY_QUERY = "SELECT id FROM book_copies WHERE book_id = ? AND status = 'available' LIMIT 1"
+OPEN_LOAN_QUERY = "SELECT id, book_id FROM loans WHERE copy_id = ? AND returned_at IS NULL"
+OPEN_HOLD_QUERY = '''
+SELECT id, status FROM holds
+WHERE patron = ? AND book_id = ? AND status IN ('waiting', 'ready')
+'''
+HOLD_POSITION_QUERY = "SELECT COUNT(*) FROM holds WHERE book_id = ? AND status = 'waiting' AND id <= ?"
+
+def _shelve_copy(conn, book_id, copy_id):
+    """Set a copy aside for the oldest waiting hold on its title, or shelve it
+
+    The caller owns the transaction. Returns the hold the copy went to as
+    ``(hold_id, patron)``, or None if it went back on the shelf.
+    """
+    hold = conn.execute(NEXT_WAITING_HOLD_QUERY, (book_id,)).fetchone()
+    if hold:
+        conn.execute('''
+        UPDATE holds SET status = 'ready', copy_id = ?, ready_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (copy_id, hold['id']))
+        conn.execute("UPDATE book_copies SET status = 'on_hold' WHERE id = ?", (copy_id,))
+        conn.execute(
+            "UPDATE book_availability SET holds_waiting = holds_waiting - 1 WHERE book_id = ?",
+            (book_id,)
+        )
+        return hold['id'], hold['patron']
+    
+    conn.execute("UPDATE book_copies SET status = 'available' WHERE id = ?", (copy_id,))
+    conn.execute(
+        "UPDATE book_availability SET copies_available = copies_available + 1 WHERE book_id = ?",
+        (book_id,)
+    )
+    if _availability(conn, book_id)['copies_available'] == 1:
+        conn.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+    return None
+
+AVAILABILITY_QUERY = '''
+SELECT book_id, copies_total, copies_available, holds_waiting
+FROM book_availability WHERE book_id IN ({placeholders})
+'''
+
+@timed
+def get_availability(book_ids):
+    """Get copies_total, copies_available and holds_waiting for each book id
+
+    Books without copies are left out of the returned dict.
+    """
+    book_ids = list(book_ids)
+    if not book_ids:
+        return {}
+    query = AVAILABILITY_QUERY.format(placeholders=", ".join("?" * len(book_ids)))
+    with connection() as conn:
+        cursor = conn.execute(query, book_ids)
+        return {row['book_id']: dict(row) for row in cursor.fetchall()}
+
+@timed
+def add_copies(book_id, count=1):
+    """Add copies of a catalogued book, serving its hold queue first
+
+    Returns the title's counters afterwards. Raises ValueError for an unknown
+    book or a count below one.
+    """
+    if count < 1:
+        raise ValueError("add at least one copy")
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _require_book(conn, book_id)
+        conn.execute(
+            "UPDATE book_availability SET copies_total = copies_total + ? WHERE book_id = ?",
+            (count, book_id)
+        )
+        for _ in range(count):
+            copy_id = conn.execute(
+                "INSERT INTO book_copies (book_id, status) VALUES (?, 'on_hold')", (book_id,)
+            ).lastrowid
+            _shelve_copy(conn, book_id, copy_id)
+        availability = _availability(conn, book_id)
+        conn.commit()
+    return availability
+
+@timed
+def checkout_book(book_id, patron, loan_days=LOAN_DAYS):
+    """Lend a copy of a book to a patron
+
+    A copy set aside for the patron's ready hold is lent first. Otherwise a
+    shelf copy is claimed with one conditional UPDATE of the title's counter,
+    so concurrent checkouts can never lend more copies than are on the shelf.
+    Returns a dict whose 'status' is 'loaned', with 'loan_id', 'copy_id' and
+    'due_date', or 'unavailable', with the title's 'holds_waiting'. Raises
+    ValueError for an unknown book or a missing patron.
+    """
+    patron = patron.strip()
+    if not patron:
+        raise ValueError("a patron is required")
+    
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _require_book(conn, book_id)
+        hold = conn.execute(READY_HOLD_QUERY, (book_id, patron)).fetchone()
+        if hold:
+            copy_id = hold['copy_id']
+            conn.execute("UPDATE holds SET status = 'fulfilled' WHERE id = ?", (hold['id'],))
+        else:
+            taken = conn.execute('''
+            UPDATE book_availability SET copies_available = copies_available - 1
+            WHERE book_id = ? AND copies_available > 0
+            ''', (book_id,)).rowcount
+            if not taken:
+                holds_waiting = _availability(conn, book_id)['holds_waiting']
+                conn.rollback()
+                return {'status': 'unavailable', 'holds_waiting': holds_waiting}
+            copy_id = conn.execute(SHELF_COPY_QUERY, (book_id,)).fetchone()[0]
+            if _availability(conn, book_id)['copies_available'] == 0:
+                conn.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+        
+        conn.execute("UPDATE book_copies SET status = 'on_loan' WHERE id = ?", (copy_id,))
+        cursor = conn.execute('''
+        INSERT INTO loans (copy_id, book_id, patron, due_date)
+        VALUES (?, ?, ?, date('now', ?))
+        ''', (copy_id, book_id, patron, f"+{loan_days} days"))
+        loan = conn.execute("SELECT id, due_date FROM loans WHERE id = ?", (cursor.lastrowid,)).fetchone()
+        conn.commit()
+    return {'status': 'loaned', 'loan_id': loan['id'], 'copy_id': copy_id, 'due_date': loan['due_date']}
+
+@timed
+def return_book(copy_id):
+    """Check a lent copy back in and pass it to the next hold on its title
+
+    Returns a dict whose 'status' is 'returned', with the 'book_id' and the
+    'hold_id' and 'held_for' patron the copy is now set aside for (both None
+    if it went back on the shelf), or 'not_on_loan'.
+    """
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        loan = conn.execute(OPEN_LOAN_QUERY, (copy_id,)).fetchone()
+        if loan is None:
+            conn.rollback()
+            return {'status': 'not_on_loan'}
+        conn.execute("UPDATE loans SET returned_at = CURRENT_TIMESTAMP WHERE id = ?", (loan['id'],))
+        hold = _shelve_copy(conn, loan['book_id'], copy_id)
+        conn.commit()
+    
+    hold_id, held_for = hold or (None, None)
+    return {'status': 'returned', 'book_id': loan['book_id'], 'hold_id': hold_id, 'held_for': held_for}
+
+@timed
+def place_hold(book_id, patron):
+    """Put a patron in the hold queue of a book with no copy on the shelf
+
+    Returns a dict whose 'status' is 'placed' or 'already_held', with the
+    'hold_id' and its 'position' in the queue (0 once a copy is set aside),
+    or 'available' when a copy can simply be checked out. Raises ValueError
+    for an unknown book or a missing patron.
+    """
+    patron = patron.strip()
+    if not patron:
+        raise ValueError("a patron is required")
+    
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _require_book(conn, book_id)
+        existing = conn.execute(OPEN_HOLD_QUERY, (patron, book_id)).fetchone()
+        if existing:
+            status, hold_id, hold_status = 'already_held', existing['id'], existing['status']
+        elif _availability(conn, book_id)['copies_available']:
+            conn.rollback()
+            return {'status': 'available'}
+        else:
+            status, hold_status = 'placed', 'waiting'
+            hold_id = conn.execute(
+                "INSERT INTO holds (book_id, patron) VALUES (?, ?)", (book_id, patron)
+            ).lastrowid
+            conn.execute(
+                "UPDATE book_availability SET holds_waiting = holds_waiting + 1 WHERE book_id = ?",
+                (book_id,)
+            )
+        position = 0
+        if hold_status == 'waiting':
+            position = conn.execute(HOLD_POSITION_QUERY, (book_id, hold_id)).fetchone()[0]
+        conn.commit()
+    return {'status': status, 'hold_id': hold_id, 'position': position}
+
+@timed
+def cancel_hold(hold_id):
+    """Cancel a waiting or ready hold
+
+    A copy that was set aside for the hold goes to the next patron in the
+    queue. Returns False if there is no open hold with this id.
+    """
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        hold = conn.execute(
+            "SELECT book_id, status, copy_id FROM holds WHERE id = ?", (hold_id,)
+        ).fetchone()
+        if hold is None or hold['status'] not in ('waiting', 'ready'):
+            conn.rollback()
+            return False
+        conn.execute("UPDATE holds SET status = 'cancelled' WHERE id = ?", (hold_id,))
+        if hold['status'] == 'waiting':
+            conn.execute(
+                "UPDATE book_availability SET holds_waiting = holds_waiting - 1 WHERE book_id = ?",
+                (hold['book_id'],)
+            )
+        else:
+            _shelve_copy(conn, hold['book_id'], hold['copy_id'])
+        conn.commit()
     return True
+
+# A patron's open loans and holds with the book titles, for the circulation
+# desk; holds carry their place in the queue (0 once a copy is set aside)
+PATRON_LOANS_QUERY = '''
+SELECT loans.id AS loan_id, loans.copy_id, books.id AS book_id, books.title, books.author,
+       loans.loaned_at, loans.due_date
+FROM loans JOIN books ON books.id = loans.book_id
+WHERE loans.patron = ? AND loans.returned_at IS NULL
+ORDER BY loans.due_date, loans.id
+'''
+PATRON_HOLDS_QUERY = '''
+SELECT holds.id AS hold_id, holds.status, holds.copy_id, books.id AS book_id,
+       books.title, books.author, holds.placed_at,
+       CASE holds.status WHEN 'waiting' THEN (
+           SELECT COUNT(*) FROM holds AS queue
+           WHERE queue.book_id = holds.book_id AND queue.status = 'waiting' AND queue.id <= holds.id
+       ) ELSE 0 END AS position
+FROM holds JOIN books ON books.id = holds.book_id
+WHERE holds.patron = ? AND holds.status IN ('waiting', 'ready')
+ORDER BY holds.id
+'''
+
+@timed
+def get_patron_circulation(patron):
+    """Get a patron's open loans and holds as ``(loans, holds)`` lists of dicts"""
+    patron = patron.strip()
+    with connection() as conn:
+        loans = [dict(row) for row in conn.execute(PATRON_LOANS_QUERY, (patron,)).fetchall()]
+        holds = [dict(row) for row in conn.execute(PATRON_HOLDS_QUERY, (patron,)).fetchall()]
+    return loans, holds
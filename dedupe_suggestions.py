@@ -0,0 +1,31 @@
+"""Merge duplicate rows of the book suggestions table
+
+Suggestions whose normalized titles and authors match, allowing for letter
+case, punctuation and transliteration, are folded into the oldest one and
+counted in its ``times_suggested``. New submissions are checked as they
+arrive; run this once to clean up older rows:
+
+    python dedupe_suggestions.py --db library.db
+"""
+import argparse
+import time
+
+import database
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=database.DB_FILE, help="database file to clean up")
+    args = parser.parse_args()
+
+    database.DB_FILE = args.db
+    database.initialize_database()
+    start = time.perf_counter()
+    counts = database.dedupe_suggestions()
+    elapsed = time.perf_counter() - start
+    print(f"{counts['suggestions']} suggestions: merged {counts['removed']} duplicates "
+          f"into {counts['groups']} suggestions in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
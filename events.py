@@ -0,0 +1,252 @@
+"""Write-behind event log and the popularity rollup it feeds
+
+Card impressions, searches and checkouts are appended to an in-process
+buffer, which costs the page that records them no database access at all.
+A background thread drains the buffer every second, writing each batch of
+events in one transaction, and every few minutes folds the new events into
+exponentially decayed per-book scores and rewrites ``books.popularity``
+from them. Run a rollup by hand with:
+
+    python events.py --db library.db
+"""
+import argparse
+import atexit
+import logging
+import threading
+import time
+from collections import Counter, deque
+
+import database
+from instrumentation import timed
+
+EVENT_KINDS = ("impression", "search", "checkout")
+
+# Score added to a book per event; searches name no book and only feed the log
+EVENT_WEIGHTS = {'impression': 1.0, 'checkout': 20.0}
+
+# An event counts half as much after this long
+HALF_LIFE_SECONDS = 90 * 24 * 3600
+
+# Decayed score a book needs for 2, 3, 4 and 5 stars. Each star takes four
+# times the score of the one below, so an untouched book loses a star every
+# two half-lives. Imported ratings are seeded halfway between thresholds.
+STAR_THRESHOLDS = (3.0, 15.0, 63.0, 255.0)
+SEED_SCORES = (1.0, 7.0, 31.0, 127.0, 511.0)
+
+# The writer wakes at least this often, and straight away once a batch is full
+FLUSH_INTERVAL_SECONDS = 1.0
+FLUSH_BATCH_SIZE = 500
+
+# Events held in memory at most; beyond this new events are dropped rather
+# than making the page that records them wait for the writer
+MAX_BUFFERED_EVENTS = 100000
+
+ROLLUP_INTERVAL_SECONDS = 10 * 60
+
+# Events older than this are pruned once rolled up
+EVENT_RETENTION_SECONDS = 180 * 24 * 3600
+
+# Scores are stored scaled up to the current time rather than decayed in
+# place (see rollup_popularity); rescale them before the factor gets large
+MAX_SCORE_GROWTH = 2.0 ** 64
+
+logger = logging.getLogger(__name__)
+
+_buffer = deque()
+_buffer_full = threading.Event()
+_dropped = Counter()
+
+
+def record_event(kind, book_id=None, query=None, results=None):
+    """Queue one event for the background writer without touching the database
+
+    Returns False if the buffer is full and the event was dropped.
+    """
+    if kind not in EVENT_KINDS:
+        raise ValueError(f"unknown event kind {kind!r}")
+    if len(_buffer) >= MAX_BUFFERED_EVENTS:
+        _dropped[kind] += 1
+        return False
+    _buffer.append((kind, book_id, query, results, time.time()))
+    if len(_buffer) >= FLUSH_BATCH_SIZE:
+        _buffer_full.set()
+    return True
+
+
+def record_impressions(book_ids):
+    """Queue an impression for each book shown on a page"""
+    for book_id in book_ids:
+        record_event("impression", book_id)
+
+
+def record_search(query, results):
+    """Queue a catalog search and the number of books it found"""
+    record_event("search", query=query, results=results)
+
+
+def record_checkout(book_id):
+    """Queue a checkout of a book"""
+    record_event("checkout", book_id)
+
+
+def get_buffer_stats():
+    """Return the number of events waiting in memory and dropped per kind"""
+    return {'buffered': len(_buffer), 'dropped': dict(_dropped)}
+
+
+@timed
+def flush_events():
+    """Write every buffered event, FLUSH_BATCH_SIZE per transaction
+
+    Returns the number of events written. A batch that fails to write is put
+    back at the front of the buffer before the error is raised.
+    """
+    written = 0
+    while True:
+        batch = []
+        while len(batch) < FLUSH_BATCH_SIZE:
+            try:
+                batch.append(_buffer.popleft())
+            except IndexError:
+                break
+        if not batch:
+            return written
+
+        try:
+            with database.connection() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany('''
+                INSERT INTO events (kind, book_id, query, results, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                ''', batch)
+                conn.commit()
+        except Exception:
+            _buffer.extendleft(reversed(batch))
+            raise
+        written += len(batch)
+
+
+@timed
+def rollup_popularity(now=None):
+    """Fold new events into each book's decayed score and rewrite popularity
+
+    A score is kept as the sum of event weights times 2 ** (age / half-life)
+    measured from ``score_epoch``, i.e. scaled up to the epoch instead of
+    decayed towards the present. Every book's score then shrinks by the same
+    factor as time passes, so old rows never need rewriting: the star
+    thresholds are scaled up by that factor instead. Books without a score
+    are seeded from their current popularity, so imported ratings carry over
+    and fade unless readers keep the book busy. Returns a dict with the
+    number of 'events' folded in and of books whose popularity 'changed'.
+    """
+    now = time.time() if now is None else now
+    with database.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        state = conn.execute(
+            "SELECT last_event_id, score_epoch FROM popularity_rollup WHERE id = 1"
+        ).fetchone()
+        epoch = state['score_epoch']
+        growth = 2.0 ** ((now - epoch) / HALF_LIFE_SECONDS)
+        if growth > MAX_SCORE_GROWTH:
+            conn.execute("UPDATE book_scores SET score = score / ?", (growth,))
+            epoch, growth = now, 1.0
+
+        conn.execute(f'''
+        INSERT INTO book_scores (book_id, score)
+        SELECT id, CASE MIN(MAX(COALESCE(popularity, 1), 1), 5)
+                   {" ".join(f"WHEN {stars} THEN ?" for stars in range(1, 6))} END * ?
+        FROM books
+        WHERE NOT EXISTS (SELECT 1 FROM book_scores WHERE book_scores.book_id = books.id)
+        ''', (*SEED_SCORES, growth))
+
+        last_event_id = conn.execute(
+            "SELECT COALESCE(MAX(id), ?) FROM events", (state['last_event_id'],)
+        ).fetchone()[0]
+        cursor = conn.execute('''
+        SELECT book_id, kind, created_at FROM events
+        WHERE id > ? AND id <= ? AND book_id IS NOT NULL
+        ''', (state['last_event_id'], last_event_id))
+        scores = Counter()
+        folded = 0
+        for book_id, kind, created_at in cursor:
+            scores[book_id] += EVENT_WEIGHTS.get(kind, 0.0) * 2.0 ** ((created_at - epoch) / HALF_LIFE_SECONDS)
+            folded += 1
+        conn.executemany('''
+        INSERT INTO book_scores (book_id, score) VALUES (?, ?)
+        ON CONFLICT (book_id) DO UPDATE SET score = score + excluded.score
+        ''', scores.items())
+
+        # Only rows whose stars change are written, so a quiet rollup leaves
+        # the popularity indexes and the catalog cache alone
+        thresholds = [threshold * growth for threshold in reversed(STAR_THRESHOLDS)]
+        changed = conn.execute('''
+        UPDATE books SET popularity = rated.popularity
+        FROM (
+            SELECT book_id, CASE WHEN score >= ? THEN 5 WHEN score >= ? THEN 4
+                                 WHEN score >= ? THEN 3 WHEN score >= ? THEN 2 ELSE 1 END AS popularity
+            FROM book_scores
+        ) AS rated
+        WHERE books.id = rated.book_id AND books.popularity IS NOT rated.popularity
+        ''', thresholds).rowcount
+
+        conn.execute(
+            "DELETE FROM events WHERE id <= ? AND created_at < ?",
+            (last_event_id, now - EVENT_RETENTION_SECONDS)
+        )
+        conn.execute('''
+        UPDATE popularity_rollup SET last_event_id = ?, score_epoch = ?, rolled_up_at = ?
+        WHERE id = 1
+        ''', (last_event_id, epoch, now))
+        conn.commit()
+    return {'events': folded, 'changed': changed}
+
+
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+
+def start_background_writer(flush_interval=FLUSH_INTERVAL_SECONDS,
+                            rollup_interval=ROLLUP_INTERVAL_SECONDS):
+    """Flush events and roll up popularity from a daemon thread, once per process"""
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is not None:
+            return
+
+        def loop():
+            next_rollup = time.monotonic()
+            while True:
+                _buffer_full.wait(flush_interval)
+                _buffer_full.clear()
+                try:
+                    flush_events()
+                except Exception:  # The events stay buffered for the next round
+                    logger.exception("Event flush failed")
+                if time.monotonic() >= next_rollup:
+                    try:
+                        rollup_popularity()
+                    except Exception:  # Retry on the next round
+                        logger.exception("Popularity rollup failed")
+                    next_rollup = time.monotonic() + rollup_interval
+
+        _writer_thread = threading.Thread(target=loop, name="event-writer", daemon=True)
+        _writer_thread.start()
+        # Events still buffered when the process exits are written on the way out
+        atexit.register(flush_events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=database.DB_FILE, help="database file to update")
+    args = parser.parse_args()
+
+    database.DB_FILE = args.db
+    database.initialize_database()
+    start = time.perf_counter()
+    counts = rollup_popularity()
+    print(f"{counts['events']} events rolled up, popularity changed for {counts['changed']} books "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
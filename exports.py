@@ -0,0 +1,72 @@
+import csv
+import io
+import tempfile
+
+from database import BOOK_COLUMNS, iter_books
+from instrumentation import timed
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is offered only when pyarrow is installed
+    pa = None
+
+# Exports larger than this spill from memory to a temporary file on disk
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+# Rows fetched from SQLite and written per chunk
+EXPORT_CHUNK_ROWS = 5000
+
+def write_csv(chunks, binary_file):
+    """Write chunks of book rows to a binary file as UTF-8 CSV"""
+    text_file = io.TextIOWrapper(binary_file, encoding="utf-8", newline="")
+    writer = csv.writer(text_file)
+    writer.writerow(BOOK_COLUMNS)
+    for rows in chunks:
+        writer.writerows(rows)
+    text_file.flush()
+    text_file.detach()  # Leave the underlying file open for the caller
+
+def _parquet_schema():
+    return pa.schema([
+        ("id", pa.int64()),
+        ("title", pa.string()),
+        ("author", pa.string()),
+        ("genre", pa.string()),
+        ("age_group", pa.string()),
+        ("description", pa.string()),
+        ("cover_url", pa.string()),
+        ("popularity", pa.int64()),
+    ])
+
+def write_parquet(chunks, binary_file):
+    """Write chunks of book rows to a binary file as Parquet, one row group per chunk"""
+    schema = _parquet_schema()
+    with pq.ParquetWriter(binary_file, schema, compression="zstd") as writer:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            writer.write_batch(pa.record_batch(columns, schema=schema))
+
+# Export formats as label -> (writer, file extension, MIME type)
+EXPORT_FORMATS = {
+    "CSV": (write_csv, "csv", "text/csv"),
+}
+if pa is not None:
+    EXPORT_FORMATS["Parquet"] = (write_parquet, "parquet", "application/vnd.apache.parquet")
+
+@timed
+def export_books(export_format, genre=None, age_group=None, search_query=None,
+                 available_only=False):
+    """Export the filtered books in the given format
+
+    Rows are streamed from the SQLite cursor in chunks into a spooled file
+    that moves to disk once it grows past SPOOL_MAX_BYTES. Returns the file
+    rewound to the start, with its file name and MIME type.
+    """
+    writer, extension, mime = EXPORT_FORMATS[export_format]
+    export_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    chunks = iter_books(genre, age_group, search_query, chunk_size=EXPORT_CHUNK_ROWS,
+                        available_only=available_only)
+    writer(chunks, export_file)
+    export_file.seek(0)
+    return export_file, f"library_books.{extension}", mime
@@ -0,0 +1,310 @@
+"""Timing instrumentation for database calls, SQL statements and render phases
+
+Functions decorated with ``@timed`` and blocks wrapped in ``timer(name)``
+record their wall time in a rolling histogram per name. Every SQL statement
+run on a ``TimedConnection`` is timed too, and statements slower than
+SLOW_QUERY_MS are kept in a slow-query log with their SQL, and their
+parameters if LOG_SQL_PARAMS is on.
+Time spent waiting for SQLite's write lock is recorded as "sql.lock_wait".
+The app brackets each Streamlit rerun with begin_rerun()/end_rerun() and
+marks its phases with checkpoint() to get a per-rerun breakdown.
+snapshot() returns everything as a JSON-ready dict, which is also written
+to METRICS_FILE for operators to scrape.
+"""
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Switch off to measure the cost of the instrumentation itself
+ENABLED = True
+
+# Statements taking at least this long go into the slow-query log
+SLOW_QUERY_MS = 100.0
+
+# Most recent durations kept per name for the rolling percentiles
+ROLLING_SAMPLES = 2048
+
+SLOW_LOG_SIZE = 200
+RECENT_RERUNS = 50
+
+# Writers take SQLite's write lock with these, so their duration is the time
+# spent waiting for other writers to commit
+LOCK_STATEMENTS = frozenset({"BEGIN IMMEDIATE", "BEGIN EXCLUSIVE"})
+
+# Parameters hold library cards, emails and phone numbers, so the slow-query
+# log only counts them unless this is switched on to debug a statement
+LOG_SQL_PARAMS = False
+
+# Parameter lists in the slow-query log are cut to this many characters
+MAX_PARAMS_CHARS = 300
+
+# Where end_rerun() writes snapshot() as JSON, at most once per interval;
+# it can hold SQL parameters, so it is kept out of the served static/ directory
+METRICS_FILE = os.path.join(APP_DIR, "metrics.json")
+METRICS_WRITE_SECONDS = 10.0
+
+
+class Histogram:
+    """Lifetime count, total and maximum plus a rolling window of durations"""
+
+    def __init__(self, size=ROLLING_SAMPLES):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, milliseconds):
+        self.samples.append(milliseconds)
+        self.count += 1
+        self.total_ms += milliseconds
+        self.max_ms = max(self.max_ms, milliseconds)
+
+    def summary(self):
+        """Return count, total, mean and max over the lifetime, percentiles over the window"""
+        with self.lock:
+            samples = sorted(self.samples)
+        summary = {
+            'count': self.count,
+            'total_ms': round(self.total_ms, 3),
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+            'max_ms': round(self.max_ms, 3),
+        }
+        for p in (50, 95, 99):
+            value = samples[min(len(samples) - 1, len(samples) * p // 100)] if samples else 0.0
+            summary[f'p{p}_ms'] = round(value, 3)
+        return summary
+
+
+_histograms = {}
+_slow_queries = deque(maxlen=SLOW_LOG_SIZE)
+_recent_reruns = deque(maxlen=RECENT_RERUNS)
+_lock = threading.Lock()
+_local = threading.local()
+_last_write = 0.0
+
+
+def _stack():
+    """Names of the timers open on this thread, innermost last"""
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def record(name, milliseconds):
+    """Add one duration to a name's histogram and to the current rerun, if any"""
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _lock:
+            histogram = _histograms.setdefault(name, Histogram())
+    with histogram.lock:
+        histogram.add(milliseconds)
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is not None:
+        phase = rerun['phases'].setdefault(name, [0, 0.0])
+        phase[0] += 1
+        phase[1] += milliseconds
+
+
+@contextmanager
+def timer(name):
+    """Time the body of a ``with`` block under ``name``"""
+    if not ENABLED:
+        yield
+        return
+    stack = _stack()
+    stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        stack.pop()
+        record(name, elapsed)
+
+
+def timed(func):
+    """Time every call of a function under its module-qualified name"""
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    # The body of timer() inlined, as this wraps every database call
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        stack = _stack()
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            stack.pop()
+            record(name, elapsed)
+
+    return wrapper
+
+
+def _format_params(parameters):
+    if isinstance(parameters, str):
+        text = parameters
+    elif LOG_SQL_PARAMS:
+        text = repr(parameters)
+    else:
+        text = f"({len(parameters)} redacted)"
+    if len(text) > MAX_PARAMS_CHARS:
+        text = text[:MAX_PARAMS_CHARS] + "..."
+    return text
+
+
+def _record_statement(sql, parameters, start):
+    """Record one SQL statement's duration and log it if it was slow"""
+    elapsed = (time.perf_counter() - start) * 1000
+    record("sql", elapsed)
+    if sql in LOCK_STATEMENTS:
+        record("sql.lock_wait", elapsed)
+    if elapsed >= SLOW_QUERY_MS:
+        stack = _stack()
+        _slow_queries.append({
+            'at': time.time(),
+            'ms': round(elapsed, 3),
+            'sql': " ".join(sql.split()),
+            'params': _format_params(parameters),
+            'caller': stack[-1] if stack else None,
+            'thread': threading.current_thread().name,
+        })
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that times every statement run through it
+
+    The time measured is until the first row is ready, which includes any
+    sorting or aggregation; fetching further rows is not counted.
+    """
+
+    def execute(self, sql, parameters=()):
+        if not ENABLED:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_statement(sql, parameters, start)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not ENABLED:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # The parameter rows may be a generator that is now used up
+            _record_statement(sql, "(executemany)", start)
+
+    def executescript(self, sql_script):
+        if not ENABLED:
+            return super().executescript(sql_script)
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            _record_statement(sql_script, "(script)", start)
+
+
+def begin_rerun():
+    """Start collecting a per-rerun breakdown on this thread
+
+    A rerun cut short by st.rerun() or st.stop() never reaches end_rerun()
+    and is simply replaced by the next one.
+    """
+    start = time.perf_counter()
+    _local.rerun = {'started_at': time.time(), 'start': start, 'mark': start, 'phases': {}}
+
+
+def checkpoint(name):
+    """Record the time since the rerun began or since the last checkpoint under ``name``
+
+    Checkpoints split a top-to-bottom script like a Streamlit app into
+    consecutive phases without wrapping each one in a ``with`` block.
+    """
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is None or not ENABLED:
+        return
+    now = time.perf_counter()
+    record(name, (now - rerun['mark']) * 1000)
+    rerun['mark'] = now
+
+
+def end_rerun():
+    """Finish this thread's rerun; returns its breakdown, or None if none was started"""
+    rerun = _local.__dict__.pop('rerun', None)
+    if rerun is None:
+        return None
+    total = (time.perf_counter() - rerun['start']) * 1000
+    if ENABLED:
+        record("rerun", total)
+    summary = {
+        'started_at': rerun['started_at'],
+        'total_ms': round(total, 3),
+        # Nested timings are also counted in the phases that contain them
+        'phases': {
+            name: {'count': count, 'total_ms': round(milliseconds, 3)}
+            for name, (count, milliseconds) in sorted(rerun['phases'].items(), key=lambda item: -item[1][1])
+        },
+    }
+    _recent_reruns.append(summary)
+    _write_metrics_if_due()
+    return summary
+
+
+def snapshot():
+    """Return every histogram, recent reruns and the slow-query log as a dict"""
+    with _lock:
+        histograms = sorted(_histograms.items())
+    timings = {name: histogram.summary() for name, histogram in histograms}
+    return {
+        'generated_at': time.time(),
+        'pid': os.getpid(),
+        'slow_query_ms': SLOW_QUERY_MS,
+        'timings': timings,
+        'recent_reruns': list(_recent_reruns),
+        'slow_queries': list(_slow_queries),
+    }
+
+
+def write_metrics(path=None):
+    """Write snapshot() as JSON, replacing the file atomically"""
+    path = path or METRICS_FILE
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as metrics_file:
+        json.dump(snapshot(), metrics_file, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _write_metrics_if_due():
+    global _last_write
+    now = time.monotonic()
+    with _lock:
+        if now - _last_write < METRICS_WRITE_SECONDS:
+            return
+        _last_write = now
+    try:
+        write_metrics()
+    except OSError as e:  # Metrics must never break a page
+        print(f"Writing metrics failed: {e}")
+
+
+def reset():
+    """Forget every recorded timing, rerun and slow query"""
+    with _lock:
+        _histograms.clear()
+    _slow_queries.clear()
+    _recent_reruns.clear()
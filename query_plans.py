@@ -0,0 +1,123 @@
+"""The queries the app reads the catalog with, and checks of their plans
+
+explain_queries() runs EXPLAIN QUERY PLAN on every query of
+catalog_queries() and flags table scans and avoidable sorts. It is run by
+``python benchmark.py plans``, which prints every plan, and by
+test_query_plans.py in CI.
+"""
+import re
+
+import database
+
+
+def catalog_queries():
+    """Yield (name, sql, params, allow_sort) for every query that reads the catalog
+
+    ``allow_sort`` marks queries whose ORDER BY cannot come from an index,
+    such as BM25 relevance ranking or ordering genres by their book count,
+    where sorting the (small) result is expected.
+    """
+    yield "get_all_books", database.ALL_BOOKS_QUERY, (), False
+    yield "get_all_genres", database.ALL_GENRES_QUERY, (), False
+    yield "get_collection_stats", database.COLLECTION_STATS_QUERY, (), True
+    for genre in (None, "Fantasy"):
+        for age_group in (None, "Small Kids"):
+            for search_query in (None, "harry"):
+                filters = f"genre={genre!r}, age_group={age_group!r}, search_query={search_query!r}"
+                query, params = database.build_filter_query(genre, age_group, search_query)
+                yield f"get_books_by_filter({filters})", query, params, bool(search_query)
+                cursor = (-1.0, 3, 10) if search_query else (3, 10)
+                query, params = database.build_page_query(genre, age_group, search_query, cursor)
+                yield f"get_books_page({filters}, cursor={cursor})", query, params, bool(search_query)
+                query, params = database.build_count_query(genre, age_group, search_query)
+                yield f"count_books({filters})", query, params, False
+            # Fuzzy candidates are put in catalog order after the full-text
+            # match, which always needs a sort
+            expression = database.build_fuzzy_expression([("poter", {"potter": 0.8})])
+            query, params = database.build_fuzzy_query(expression, genre, age_group)
+            yield f"get_books_fuzzy(genre={genre!r}, age_group={age_group!r})", query, params, True
+        for search_query in (None, "harry"):
+            filters = f"genre={genre!r}, search_query={search_query!r}, available_only=True"
+            cursor = (-1.0, 3, 10) if search_query else (3, 10)
+            query, params = database.build_page_query(genre, None, search_query, cursor, available_only=True)
+            yield f"get_books_page({filters}, cursor={cursor})", query, params, bool(search_query)
+            query, params = database.build_count_query(genre, None, search_query, available_only=True)
+            yield f"count_books({filters})", query, params, False
+    page_ids = tuple(range(1, database.PAGE_SIZE + 1))
+    query = database.SIMILAR_BOOKS_QUERY.format(placeholders=", ".join("?" * len(page_ids)))
+    yield "get_similar_books(page)", query, page_ids, False
+    trigrams = sorted(database._trigrams("tolkein"))
+    query = database.COMMON_TRIGRAMS_QUERY.format(placeholders=", ".join("?" * len(trigrams)))
+    yield "fuzzy common trigrams", query, (*trigrams, database.FUZZY_TRIGRAM_TERMS, 2), True
+    query = database.FUZZY_TERMS_QUERY.format(placeholders=", ".join("?" * len(trigrams)))
+    yield "fuzzy spelling candidates", query, (*trigrams, 5, 9, 1, 30), True
+    buckets = list(enumerate(range(database.DUPLICATE_BANDS)))
+    query = database.DUPLICATE_CANDIDATES_QUERY.format(
+        bands=" OR ".join(["(band = ? AND bucket = ?)"] * len(buckets))
+    )
+    yield "duplicate suggestion candidates", query, [value for bucket in buckets for value in bucket], False
+    yield "get_suggestions", database.SUGGESTIONS_QUERY, (1000,), False
+    yield "count_suggestions", database.COUNT_SUGGESTIONS_QUERY, (), False
+    yield "get_broken_cover_urls", database.BROKEN_COVER_URLS_QUERY, (), False
+    # Availability is sorted over the generated days and slots, not table rows
+    query, params = database.build_visit_availability_query("2030-01-01", "2030-01-14")
+    yield "get_visit_availability", query, params, True
+    # A patron's few loans and holds are sorted by due date and queue order
+    yield "patron loans", database.PATRON_LOANS_QUERY, ("P1",), True
+    yield "patron holds", database.PATRON_HOLDS_QUERY, ("P1",), True
+    query = database.AVAILABILITY_QUERY.format(placeholders=", ".join("?" * len(page_ids)))
+    yield "get_availability(page)", query, page_ids, False
+    # The lookups inside checkout_book, return_book, place_hold and the
+    # copies going back on the shelf
+    yield "ready hold", database.READY_HOLD_QUERY, (1, "P1"), False
+    yield "shelf copy", database.SHELF_COPY_QUERY, (1,), False
+    yield "open loan", database.OPEN_LOAN_QUERY, (1,), False
+    yield "open hold", database.OPEN_HOLD_QUERY, ("P1", 1), False
+    yield "hold position", database.HOLD_POSITION_QUERY, (1, 10), False
+    yield "next waiting hold", database.NEXT_WAITING_HOLD_QUERY, (1,), False
+    # The background and review writes read the catalog too
+    yield "get_cover_urls_to_check", database.COVER_URLS_TO_CHECK_QUERY, ("-24 hours",), False
+    yield "index pending search terms", database.PENDING_SEARCH_TERM_BOOKS_QUERY, (), False
+    # Staged suggestions are grouped by title and merged pairs by the row kept
+    yield "approve suggestions", database.APPROVE_SUGGESTIONS_QUERY, (), True
+    yield "remove reviewed suggestions", database.REMOVE_REVIEWED_SUGGESTIONS_QUERY, (), False
+    yield "merge duplicate suggestion counts", database.MERGE_SUGGESTION_COUNTS_QUERY, (), True
+    yield "remove merged suggestions", database.REMOVE_MERGED_SUGGESTIONS_QUERY, (), False
+
+# Plan lines that mean a query regressed: a scan of a table that uses no
+# index, or a temporary B-tree built to satisfy ORDER BY / DISTINCT. A scan
+# in index order reads rows as ORDER BY wants them and stops at the LIMIT.
+FULL_SCAN = re.compile(r"^SCAN (\w+)(?: LEFT-JOIN)?$")
+TEMP_SORT = re.compile(r"USE TEMP B-TREE")
+
+# Tables of one row, or one per genre, which are read whole
+SMALL_TABLES = {"collection_stats", "genre_counts"}
+
+# "FROM table AS alias" and "JOIN table AS alias", to name the table scanned
+TABLE_ALIAS = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)\s+AS\s+(\w+)", re.IGNORECASE)
+
+
+def explain_queries(conn):
+    """Return (name, plan, problems) for every query of catalog_queries()
+
+    ``problems`` are the plan lines that scan a table or sort where the
+    query should not, so an empty list means the plan is fine.
+    """
+    # The review and merge statements read temporary tables of their
+    # connection; scanning those staged ids is the point of them
+    conn.execute(database.SUGGESTION_REVIEW_TABLE)
+    conn.execute(database.SUGGESTION_MERGE_TABLE)
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    results = []
+    for name, query, params, allow_sort in catalog_queries():
+        plan = [row['detail'] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+        aliases = {alias: table for table, alias in TABLE_ALIAS.findall(query)}
+        problems = []
+        for line in plan:
+            scan = FULL_SCAN.match(line)
+            scanned = scan and aliases.get(scan[1], scan[1])
+            if (scanned in tables and scanned not in SMALL_TABLES) or \
+                    (TEMP_SORT.search(line) and not allow_sort):
+                problems.append(line)
+        results.append((name, plan, problems))
+    return results
@@ -0,0 +1,578 @@
+"""Content-based "more like this" recommendations for the library catalog
+
+Every book becomes a sparse TF-IDF vector over the words of its description
+plus its author, cut down to its strongest terms. Nearest neighbours are
+found in batches with NumPy by walking the postings of each batch's terms,
+so only books sharing a term are ever compared, and the top matches are
+stored in ``similar_books`` where the app reads them with one indexed
+lookup. Books added or changed later are vectorized and matched on their
+own. Everything is computed outside the write lock, which is only held to
+store the results. Rebuild everything with:
+
+    python recommendations.py --rebuild
+"""
+import argparse
+import logging
+import math
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+import database
+from instrumentation import timed
+
+# Neighbours stored per book
+SIMILAR_BOOKS_K = 6
+
+# Terms kept in each book's vector, strongest TF-IDF weight first
+MAX_TERMS_PER_BOOK = 24
+
+# Terms found in more books than this say little about any of them and are
+# left out of the vectors; this also bounds the pairs compared per book
+MAX_TERM_BOOKS = 500
+
+# Weight of the author term relative to a description word used once
+AUTHOR_WEIGHT = 2.0
+
+# Bonus added to the cosine similarity of two books' vectors when they share
+# a genre or an age group
+GENRE_WEIGHT = 0.3
+AGE_GROUP_WEIGHT = 0.1
+
+# Books whose neighbours are computed per NumPy batch
+BATCH_BOOKS = 256
+
+# Rebuild everything instead of updating incrementally once this share of
+# the catalog is waiting
+FULL_REBUILD_SHARE = 0.2
+
+# Books whose vectors and neighbours a rebuild stores per write transaction,
+# so other writers never wait long for the write lock
+REBUILD_WRITE_BOOKS = 2000
+
+# Pause between those transactions. A writer waiting for the lock polls for
+# it, up to 100 ms apart, and would miss it between back-to-back batches
+REBUILD_WRITE_PAUSE_SECONDS = 0.1
+
+# How often the in-app refresher looks for added or changed books
+REFRESH_INTERVAL_SECONDS = 60
+
+BOOK_QUERY = "SELECT id, author, genre, age_group, description, popularity FROM books"
+
+# Columns a book's vector and neighbours depend on, as in the books_similar_update trigger
+CONTENT_COLUMNS = ("author", "genre", "age_group", "description")
+
+# Queued books with their CONTENT_COLUMNS values at the last refresh
+PENDING_QUERY = "SELECT book_id, old_author, old_genre, old_age_group, old_description FROM similar_books_pending"
+
+logger = logging.getLogger(__name__)
+
+
+def _chunks(values, size=500):
+    """Split a list into slices small enough for one IN (...) list"""
+    return [values[first:first + size] for first in range(0, len(values), size)]
+
+
+def book_terms(book):
+    """Return the weighted term frequencies of a book
+
+    Description words get a sublinear ``1 + log(count)`` weight and the whole
+    author name is one term weighted AUTHOR_WEIGHT.
+    """
+    counts = Counter(
+        word for word in database.normalize_words(book['description']) if len(word) >= 3
+    )
+    terms = {word: 1 + math.log(count) for word, count in counts.items()}
+    author = " ".join(database.normalize_words(book['author']))
+    if author:
+        terms[f"author:{author}"] = AUTHOR_WEIGHT
+    return terms
+
+
+def book_vector(terms, book_counts, num_books):
+    """Turn weighted term frequencies into a unit-length TF-IDF vector
+
+    Returns a list of (term, weight) pairs, strongest first, cut down to
+    MAX_TERMS_PER_BOOK.
+    """
+    weights = [
+        (term, tf * (math.log((1 + num_books) / (1 + book_counts[term])) + 1))
+        for term, tf in terms.items()
+        if book_counts[term] <= MAX_TERM_BOOKS
+    ]
+    weights.sort(key=lambda item: item[1], reverse=True)
+    del weights[MAX_TERMS_PER_BOOK:]
+    norm = math.sqrt(sum(weight * weight for _, weight in weights)) or 1.0
+    return [(term, weight / norm) for term, weight in weights]
+
+
+def top_pairs(a, b, scores, k=SIMILAR_BOOKS_K):
+    """Keep the ``k`` best-scoring pairs for each value of ``a``
+
+    Returns (a, b, scores, rank) arrays sorted by ``a`` and then by score.
+    """
+    # One sort on a combined key: scores never reach the spacing between
+    # consecutive values of ``a``
+    top = scores.max() if len(scores) else 0.0
+    spacing = top - scores.min() + 1 if len(scores) else 1.0
+    order = np.argsort(a * spacing + (top - scores))
+    a, b, scores = a[order], b[order], scores[order]
+    rank = np.arange(len(a)) - np.searchsorted(a, a)
+    keep = rank < k
+    return a[keep], b[keep], scores[keep], rank[keep]
+
+
+def nearest_neighbours(rows, terms, weights, genres, ages, k=SIMILAR_BOOKS_K):
+    """Find the ``k`` nearest neighbours of every book from its sparse vector
+
+    ``rows``, ``terms`` and ``weights`` hold the vector entries, grouped by
+    row in ascending order; ``genres`` and ``ages`` are per-row category
+    codes. Scores are cosine similarity plus the genre and age group
+    bonuses. Yields (rows, neighbour rows, scores, ranks) array tuples, one
+    per batch of BATCH_BOOKS books.
+    """
+    num_rows = len(genres)
+    # Postings: the entries again, grouped by term
+    by_term = np.lexsort((rows, terms))
+    posting_rows, posting_terms, posting_weights = rows[by_term], terms[by_term], weights[by_term]
+    posting_start = np.searchsorted(posting_terms, terms, side="left")
+    posting_count = np.searchsorted(posting_terms, terms, side="right") - posting_start
+    row_start = np.searchsorted(rows, np.arange(num_rows + 1))
+
+    for first_row in range(0, num_rows, BATCH_BOOKS):
+        lo = row_start[first_row]
+        hi = row_start[min(first_row + BATCH_BOOKS, num_rows)]
+        # Pair every entry in the batch with each posting of its term
+        counts = posting_count[lo:hi]
+        entries = np.repeat(np.arange(lo, hi), counts)
+        postings = (np.arange(counts.sum())
+                    - np.repeat(np.cumsum(counts) - counts, counts)
+                    + np.repeat(posting_start[lo:hi], counts))
+        a, b = rows[entries], posting_rows[postings]
+        products = weights[entries] * posting_weights[postings]
+        other = a != b
+        keys, inverse = np.unique(a[other] * num_rows + b[other], return_inverse=True)
+        dots = np.bincount(inverse, weights=products[other])
+        a, b = keys // num_rows, keys % num_rows
+        scores = (dots
+                  + GENRE_WEIGHT * (genres[a] == genres[b])
+                  + AGE_GROUP_WEIGHT * (ages[a] == ages[b]))
+        yield top_pairs(a, b, scores, k)
+
+
+def _fill_from_category(conn, book, neighbours, k=SIMILAR_BOOKS_K):
+    """Top up a short neighbour list with popular books of the same genre and age group"""
+    if len(neighbours) >= k:
+        return neighbours
+    taken = {book['id']} | {similar_id for similar_id, _ in neighbours}
+    cursor = conn.execute('''
+    SELECT id FROM books
+    WHERE genre = ? AND age_group = ?
+    ORDER BY popularity DESC
+    LIMIT ?
+    ''', (book['genre'], book['age_group'], k + len(taken)))
+    for (similar_id,) in cursor.fetchall():
+        if len(neighbours) >= k:
+            break
+        if similar_id not in taken:
+            neighbours.append((similar_id, GENRE_WEIGHT + AGE_GROUP_WEIGHT))
+    return neighbours
+
+
+def _fetch(conn, query, ids):
+    """Run a query whose ``IN ({})`` list takes ``ids``, a chunk at a time, and return every row"""
+    return [
+        row
+        for chunk in _chunks(list(ids))
+        for row in conn.execute(query.format(", ".join("?" * len(chunk))), chunk).fetchall()
+    ]
+
+
+def _content(book):
+    """The columns a book's vector and neighbours are computed from"""
+    return tuple(book[column] for column in CONTENT_COLUMNS)
+
+
+def _write_neighbours(conn, neighbours_by_book):
+    """Replace the stored neighbour lists of some books"""
+    conn.executemany("DELETE FROM similar_books WHERE book_id = ?",
+                     ((book_id,) for book_id in neighbours_by_book))
+    conn.executemany(
+        "INSERT INTO similar_books (book_id, rank, similar_id, score) VALUES (?, ?, ?, ?)",
+        (
+            (book_id, rank, similar_id, score)
+            for book_id, neighbours in neighbours_by_book.items()
+            for rank, (similar_id, score) in enumerate(neighbours)
+        )
+    )
+
+
+def compute_rebuild(conn, pending):
+    """Recompute every book's vector and neighbours
+
+    Only reads; returns the changes for write_rebuild(), which also takes
+    the books queued in ``pending`` off the queue.
+    """
+    books = conn.execute(BOOK_QUERY + " ORDER BY id").fetchall()
+    num_books = len(books)
+    book_term_weights = [book_terms(book) for book in books]
+    book_counts = Counter(term for terms in book_term_weights for term in terms)
+    term_ids = {term: term_id for term_id, term in enumerate(sorted(book_counts), start=1)}
+    vectors = [book_vector(terms, book_counts, num_books) for terms in book_term_weights]
+
+    neighbours = {book['id']: [] for book in books}
+    if books:
+        rows = np.repeat(np.arange(num_books), [len(vector) for vector in vectors])
+        terms = np.array([term_ids[term] for vector in vectors for term, _ in vector], dtype=np.int64)
+        weights = np.array([weight for vector in vectors for _, weight in vector], dtype=np.float64)
+        _, genres = np.unique([book['genre'] for book in books], return_inverse=True)
+        _, ages = np.unique([book['age_group'] for book in books], return_inverse=True)
+        for a, b, scores, _ in nearest_neighbours(rows, terms, weights, genres, ages):
+            for row, similar_row, score in zip(a.tolist(), b.tolist(), scores.tolist()):
+                neighbours[books[row]['id']].append((books[similar_row]['id'], score))
+        for book in books:
+            _fill_from_category(conn, book, neighbours[book['id']])
+
+    return {
+        'full': True,
+        'pending': pending,
+        'books': {book['id']: book for book in books},
+        'term_counts': book_counts,
+        'vectors': {book['id']: vector for book, vector in zip(books, vectors)},
+        'neighbours': neighbours,
+    }
+
+
+def compute_update(conn, pending):
+    """Vectorize queued books and work out the neighbour lists they change
+
+    ``pending`` maps each queued book id to its values at the last refresh,
+    in CONTENT_COLUMNS order, or Nones if it was never vectorized. A book
+    that has changed since, or been deleted, has its old terms taken out of
+    the counts and its current ones added. Each changed book is matched
+    against the stored vectors of every other book through the term index,
+    gets its own neighbour list, and is merged into the lists of the books
+    it beats; books whose lists held it, and queued books that have not
+    changed, have theirs recomputed from their stored vectors. IDF weights
+    use the updated counts. Only reads; returns the changes for
+    write_update().
+    """
+    books = _fetch(conn, BOOK_QUERY + " WHERE id IN ({})", pending)
+    num_books = conn.execute("SELECT total_books FROM collection_stats WHERE id = 1").fetchone()[0]
+    revised = [book for book in books if _content(book) != pending[book['id']]]
+    gone = pending.keys() - {book['id'] for book in books}
+
+    # Take out the terms each book was counted with and add its current ones
+    book_term_weights = {book['id']: book_terms(book) for book in revised}
+    term_deltas = Counter(term for terms in book_term_weights.values() for term in terms)
+    for book_id in gone | book_term_weights.keys():
+        author, _, _, description = pending[book_id]
+        if author is not None:
+            for term in book_terms({'author': author, 'description': description}):
+                term_deltas[term] -= 1
+    book_counts = Counter({
+        row['term']: row['book_count']
+        for row in _fetch(conn, "SELECT term, book_count FROM recommendation_terms WHERE term IN ({})",
+                          term_deltas)
+    })
+    book_counts.update(term_deltas)
+    vectors = {
+        book_id: book_vector(terms, book_counts, num_books)
+        for book_id, terms in book_term_weights.items()
+    }
+
+    # A changed book's score with the books listing it is stale, so their
+    # lists are recomputed from their stored vectors
+    holders = {
+        row[0]
+        for row in _fetch(conn, "SELECT DISTINCT book_id FROM similar_books WHERE similar_id IN ({})", vectors)
+    } - pending.keys()
+    listed_books = [book for book in books if book['id'] not in vectors]
+    listed_books += _fetch(conn, BOOK_QUERY + " WHERE id IN ({})", holders)
+    query_vectors = dict(vectors)
+    for row in _fetch(conn, '''
+    SELECT vectors.book_id, terms.term, vectors.weight
+    FROM book_vectors AS vectors
+    JOIN recommendation_terms AS terms ON terms.id = vectors.term_id
+    WHERE vectors.book_id IN ({})
+    ''', [book['id'] for book in listed_books]):
+        query_vectors.setdefault(row['book_id'], []).append((row['term'], row['weight']))
+
+    # Dot products with every book sharing a term, through the term index;
+    # the stored vectors of changed books are stale, so theirs come from above
+    query_terms = {term for vector in query_vectors.values() for term, _ in vector}
+    by_term = {}
+    categories = {book['id']: (book['genre'], book['age_group']) for book in books}
+    for row in _fetch(conn, '''
+    SELECT terms.term, vectors.book_id, vectors.weight, books.genre, books.age_group
+    FROM recommendation_terms AS terms
+    JOIN book_vectors AS vectors ON vectors.term_id = terms.id
+    JOIN books ON books.id = vectors.book_id
+    WHERE terms.term IN ({})
+    ''', query_terms):
+        if row['book_id'] not in vectors:
+            by_term.setdefault(row['term'], []).append((row['book_id'], row['weight']))
+            categories[row['book_id']] = (row['genre'], row['age_group'])
+    for book_id, vector in vectors.items():
+        for term, weight in vector:
+            by_term.setdefault(term, []).append((book_id, weight))
+
+    neighbours = {}
+    incoming = {}
+    for book in revised + listed_books:
+        dots = Counter()
+        for term, weight in query_vectors.get(book['id'], ()):
+            for other_id, other_weight in by_term.get(term, ()):
+                if other_id != book['id']:
+                    dots[other_id] += weight * other_weight
+        scored = []
+        for other_id, dot in dots.items():
+            genre, age_group = categories[other_id]
+            score = (dot
+                     + GENRE_WEIGHT * (genre == book['genre'])
+                     + AGE_GROUP_WEIGHT * (age_group == book['age_group']))
+            scored.append((other_id, score))
+            if book['id'] in vectors:
+                incoming.setdefault(other_id, []).append((book['id'], score))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        neighbours[book['id']] = _fill_from_category(conn, book, scored[:SIMILAR_BOOKS_K])
+
+    # Merge the changed books into the lists of the books they now beat
+    others = [other_id for other_id in incoming if other_id not in neighbours]
+    current = {other_id: [] for other_id in others}
+    for book_id, similar_id, score in _fetch(conn, '''
+    SELECT book_id, similar_id, score FROM similar_books
+    WHERE book_id IN ({})
+    ORDER BY book_id, rank
+    ''', others):
+        current[book_id].append((similar_id, score))
+    for other_id, existing in current.items():
+        candidates = existing + incoming[other_id]
+        candidates.sort(key=lambda item: item[1], reverse=True)
+        merged = candidates[:SIMILAR_BOOKS_K]
+        if merged != existing:
+            neighbours[other_id] = merged
+
+    return {
+        'full': False,
+        'pending': pending,
+        'books': {book['id']: book for book in books},
+        'term_deltas': term_deltas,
+        'vectors': vectors,
+        'neighbours': neighbours,
+    }
+
+
+def _current_books(conn, book_ids):
+    """The values CONTENT_COLUMNS holds now for those of ``book_ids`` still in the catalog"""
+    return {
+        row['id']: row
+        for row in _fetch(conn, "SELECT id, author, genre, age_group, description FROM books WHERE id IN ({})",
+                          book_ids)
+    }
+
+
+def _settle_queue(conn, changes, current):
+    """Take the books ``changes`` read off the queue, as counted the way they were read
+
+    Books changed or deleted since go back on it with the values they were
+    read with, which is what the term counts now hold.
+    """
+    books = changes['books']
+    conn.executemany("DELETE FROM similar_books_pending WHERE book_id = ?",
+                     ((book_id,) for book_id in changes['pending'].keys() | books.keys()))
+    conn.executemany('''
+    INSERT INTO similar_books_pending
+        (book_id, old_author, old_genre, old_age_group, old_description)
+    VALUES (?, ?, ?, ?, ?)
+    ''', (
+        (book_id, *_content(book))
+        for book_id, book in books.items()
+        if book_id not in current or _content(current[book_id]) != _content(book)
+    ))
+
+
+def _write_books(conn, changes, book_ids, term_ids):
+    """Store the vectors and neighbour lists ``changes`` holds for some books
+
+    Books changed or deleted since they were read are left to the refresh
+    that picks them up from the queue. Lists naming a deleted book drop it
+    and the book is queued.
+    """
+    books = changes['books']
+    neighbours = {book_id: changes['neighbours'].get(book_id, []) for book_id in book_ids}
+    listed = {similar_id for similar in neighbours.values() for similar_id, _ in similar}
+    current = _current_books(conn, neighbours.keys() | listed)
+    kept = {}
+    lost = []
+    for book_id, similar in neighbours.items():
+        if book_id not in current:
+            continue
+        if book_id in books and _content(current[book_id]) != _content(books[book_id]):
+            continue
+        kept[book_id] = [(similar_id, score) for similar_id, score in similar if similar_id in current]
+        if len(kept[book_id]) < len(similar):
+            lost.append(book_id)
+
+    vectors = {book_id: changes['vectors'][book_id] for book_id in kept if book_id in changes['vectors']}
+    conn.executemany("DELETE FROM book_vectors WHERE book_id = ?", ((book_id,) for book_id in vectors))
+    conn.executemany(
+        "INSERT INTO book_vectors (book_id, term_id, weight) VALUES (?, ?, ?)",
+        (
+            (book_id, term_ids[term], weight)
+            for book_id, vector in vectors.items()
+            for term, weight in vector
+        )
+    )
+    _write_neighbours(conn, kept)
+    conn.executemany('''
+    INSERT OR IGNORE INTO similar_books_pending
+        (book_id, old_author, old_genre, old_age_group, old_description)
+    VALUES (?, ?, ?, ?, ?)
+    ''', ((book_id, *_content(current[book_id])) for book_id in lost))
+
+
+@timed
+def write_update(conn, changes):
+    """Store the changes from compute_update() in one short transaction
+
+    Returns False without writing if another refresh has taken the queued
+    books meanwhile.
+    """
+    pending = changes['pending']
+    conn.execute("BEGIN IMMEDIATE")
+    queued = {
+        row[0]: tuple(row[1:])
+        for row in _fetch(conn, PENDING_QUERY + " WHERE book_id IN ({})", pending)
+    }
+    if queued != pending:
+        conn.rollback()
+        return False
+
+    term_deltas = changes['term_deltas']
+    conn.executemany('''
+    INSERT INTO recommendation_terms (term, book_count) VALUES (?, ?)
+    ON CONFLICT (term) DO UPDATE SET book_count = book_count + excluded.book_count
+    ''', ((term, delta) for term, delta in term_deltas.items() if delta))
+    conn.executemany("DELETE FROM recommendation_terms WHERE term = ? AND book_count <= 0",
+                     ((term,) for term, delta in term_deltas.items() if delta < 0))
+    term_ids = {
+        row['term']: row['id']
+        for row in _fetch(conn, "SELECT term, id FROM recommendation_terms WHERE term IN ({})",
+                          {term for vector in changes['vectors'].values() for term, _ in vector})
+    }
+    _write_books(conn, changes, changes['neighbours'], term_ids)
+    _settle_queue(conn, changes, _current_books(conn, changes['books']))
+    conn.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+    conn.commit()
+    return True
+
+
+@timed
+def write_rebuild(conn, changes):
+    """Store the changes from compute_rebuild(), REBUILD_WRITE_BOOKS books per transaction
+
+    The term counts are replaced first, keeping the ids of terms still in
+    use so vectors not yet rewritten stay readable; terms no book uses any
+    more are dropped at the end, once nothing refers to them.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    term_counts = changes['term_counts']
+    conn.executemany('''
+    INSERT INTO recommendation_terms (term, book_count) VALUES (?, ?)
+    ON CONFLICT (term) DO UPDATE SET book_count = excluded.book_count
+    ''', term_counts.items())
+    term_ids = dict(conn.execute("SELECT term, id FROM recommendation_terms").fetchall())
+    conn.executemany("UPDATE recommendation_terms SET book_count = 0 WHERE id = ?",
+                     ((term_id,) for term, term_id in term_ids.items() if term not in term_counts))
+    _settle_queue(conn, changes, _current_books(conn, changes['books']))
+    conn.commit()
+
+    for book_ids in _chunks(list(changes['books']), REBUILD_WRITE_BOOKS):
+        time.sleep(REBUILD_WRITE_PAUSE_SECONDS)
+        conn.execute("BEGIN IMMEDIATE")
+        _write_books(conn, changes, book_ids, term_ids)
+        conn.commit()
+
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute('''
+    DELETE FROM recommendation_terms
+    WHERE book_count <= 0 AND NOT EXISTS (SELECT 1 FROM book_vectors WHERE term_id = recommendation_terms.id)
+    ''')
+    conn.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+    conn.commit()
+    return True
+
+
+@timed
+def refresh_similar_books(full=False):
+    """Bring similar_books up to date with the catalog
+
+    Books queued in similar_books_pending are updated incrementally, unless
+    ``full`` is set or so many are queued that a rebuild is cheaper. The
+    work is done on a read snapshot and the write lock is only taken to
+    store the result, so other writers wait for short writes alone. Bumps
+    the catalog version so cached pages pick up the new lists. Returns the
+    number of books vectorized.
+    """
+    database.initialize_database()
+    with database.connection() as conn:
+        # One read transaction, so every query sees the same catalog
+        conn.execute("BEGIN")
+        try:
+            pending = {row[0]: tuple(row[1:]) for row in conn.execute(PENDING_QUERY)}
+            if not pending and not full:
+                return 0
+            num_books = conn.execute("SELECT total_books FROM collection_stats WHERE id = 1").fetchone()[0]
+            if full or len(pending) > FULL_REBUILD_SHARE * num_books:
+                changes = compute_rebuild(conn, pending)
+            else:
+                changes = compute_update(conn, pending)
+        finally:
+            conn.rollback()
+
+        write = write_rebuild if changes['full'] else write_update
+        if not write(conn, changes):
+            return 0
+    return len(changes['books'])
+
+
+_refresh_thread = None
+_refresh_lock = threading.Lock()
+
+
+def start_background_refresh(interval=REFRESH_INTERVAL_SECONDS):
+    """Keep similar_books current from a daemon thread, once per process"""
+    global _refresh_thread
+    with _refresh_lock:
+        if _refresh_thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    refresh_similar_books()
+                except Exception:  # Keep refreshing on the next round
+                    logger.exception("Similar books refresh failed")
+                time.sleep(interval)
+
+        _refresh_thread = threading.Thread(target=loop, name="similar-books", daemon=True)
+        _refresh_thread.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=database.DB_FILE, help="database file to update")
+    parser.add_argument("--rebuild", action="store_true", help="recompute every book, not just queued ones")
+    args = parser.parse_args()
+
+    database.DB_FILE = args.db
+    start = time.perf_counter()
+    updated = refresh_similar_books(full=args.rebuild)
+    print(f"{updated} books updated in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Check the cover cache against a local HTTP server serving a JPEG
+
+    python -m pytest test_cover_cache.py
+"""
+import collections
+import hashlib
+import http.server
+import io
+import os
+import threading
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+import cover_cache
+
+
+@pytest.fixture(scope="module")
+def server():
+    """Serve a 1000x1600 JPEG at any path but /redirect; yield (base URL, requests per path)"""
+    image = io.BytesIO()
+    Image.new("RGB", (1000, 1600), (200, 40, 40)).save(image, "JPEG")
+    body = image.getvalue()
+    requests = collections.Counter()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests[self.path] += 1
+            if self.path == "/redirect":
+                self.send_response(302)
+                self.send_header("Location", "file:///etc/passwd")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{httpd.server_port}", requests
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return cover_cache.CoverCache(originals_dir=str(tmp_path / "originals"),
+                                  thumbnail_dir=str(tmp_path / "thumbnails"))
+
+
+def test_cover_is_downloaded_once_and_keyed_by_sha256(server, cache):
+    base_url, requests = server
+    url = f"{base_url}/once.jpg"
+    digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    assert cache.thumbnail_url(url) is None
+    thumbnail_path = cache.fetch(url)
+    assert thumbnail_path == os.path.join(cache.thumbnail_dir, f"{digest}.jpg")
+    assert os.path.exists(os.path.join(cache.originals_dir, digest))
+    assert cache.thumbnail_url(url) == f"{cover_cache.THUMBNAIL_URL_PREFIX}/{digest}.jpg"
+
+    # A second fetch, and rebuilding a lost thumbnail, reuse the original
+    cache.fetch(url)
+    os.remove(thumbnail_path)
+    cache.fetch(url)
+    assert requests["/once.jpg"] == 1
+
+
+def test_thumbnail_has_the_card_size(server, cache):
+    base_url, _ = server
+    with Image.open(cache.fetch(f"{base_url}/size.jpg")) as thumbnail:
+        assert thumbnail.size == cover_cache.THUMBNAIL_SIZE
+
+
+def test_eviction_keeps_the_cache_within_max_bytes(server, cache):
+    base_url, _ = server
+    first, second, third = (f"{base_url}/evict-{n}.jpg" for n in range(3))
+    cache.fetch(first)
+    original_bytes = os.path.getsize(cache.original_path(first))
+    thumbnail_bytes = os.path.getsize(cache.thumbnail_path(first))
+
+    # Room for one original and two thumbnails; showing the first cover
+    # makes the second the least recently used
+    cache.max_bytes = original_bytes + 2 * thumbnail_bytes
+    cache.fetch(second)
+    assert cache.thumbnail_url(first) is not None
+    cache.fetch(third)
+
+    assert cache.disk_usage() <= cache.max_bytes
+    assert os.path.exists(cache.thumbnail_path(first))
+    assert not os.path.exists(cache.thumbnail_path(second))
+    assert os.path.exists(cache.thumbnail_path(third))
+    assert cache.thumbnail_url(second) is None
+
+
+def test_only_http_urls_are_fetched(server, cache):
+    base_url, requests = server
+    with pytest.raises(ValueError):
+        cache.fetch("file:///etc/passwd")
+    with pytest.raises(OSError):
+        cache.fetch(f"{base_url}/redirect")
+    assert requests["/redirect"] == 1
+
+    cache.prefetch("file:///etc/passwd")
+    assert cache._executor is None
+    assert cache.disk_usage() == 0
@@ -0,0 +1,20 @@
+"""Fail CI when a query plan scans a table or sorts where it need not
+
+Runs the checks of ``python benchmark.py plans`` on a temporary catalog:
+
+    python -m pytest test_query_plans.py
+"""
+import benchmark
+import database
+import query_plans
+
+
+def test_query_plans_use_indexes():
+    with benchmark.temporary_database():
+        benchmark.pad_catalog(5000)
+        with database.connection() as conn:
+            results = query_plans.explain_queries(conn)
+    regressed = {name: plan for name, plan, problems in results if problems}
+    assert not regressed, "\n".join(
+        f"{name}:\n" + "\n".join(f"    {line}" for line in plan) for name, plan in regressed.items()
+    )
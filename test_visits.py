@@ -0,0 +1,40 @@
+"""Check that concurrent bookings can never overbook a visit slot
+
+Books random-sized groups into one slot from several processes, each with
+several threads, the way ``python benchmark.py visits`` does:
+
+    python -m pytest test_visits.py
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import benchmark
+import database
+
+
+def test_parallel_bookings_never_overbook():
+    visit_date, start_time = "2030-01-01", database.VISIT_SLOTS[0][0]
+    with benchmark.temporary_database() as db_file:
+        with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("spawn")) as executor:
+            runs = [executor.submit(benchmark.book_visits, db_file, seed, 4, 10, visit_date, start_time)
+                    for seed in range(2)]
+            attempts = [attempt for run in runs for attempt in run.result()]
+        with database.connection() as conn:
+            booked, capacity = conn.execute(
+                "SELECT booked, capacity FROM visit_slots WHERE visit_date = ? AND start_time = ?",
+                (visit_date, start_time)
+            ).fetchone()
+            visits, visitors = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(num_visitors), 0) FROM visits "
+                "WHERE visit_date = ? AND start_time = ?",
+                (visit_date, start_time)
+            ).fetchone()
+
+    accepted = [(size, result) for size, result, _ in attempts if result['status'] == 'booked']
+    refused = [(size, result) for size, result, _ in attempts if result['status'] == 'full']
+    assert len(attempts) == 80
+    assert booked <= capacity
+    assert visitors == booked == sum(size for size, _ in accepted)
+    assert visits == len(accepted)
+    assert refused, "80 groups of 1-4 should not all fit in one slot"
+    assert all(result['remaining'] < size for size, result in refused)
@@ -1,4 +1,10 @@
+import html
+from string import Template
+from urllib.parse import quote
 import streamlit as st
+from cover_cache import cover_cache, local_cover_url
+from database import get_broken_cover_urls, get_similar_books
+from instrumentation import timed
 
 # Default cover image to use when a book cover is missing
 DEFAULT_COVER_IMAGE_URL = "https://cdn.pixabay.com/photo/2018/01/17/18/43/book-3088775_960_720.jpg"
@@ -7,6 +13,13 @@ def format_book_card(book):
     """Format a book as a card in the Streamlit interface"""
     # Use the provided cover URL or default image
     cover_url = book['cover_url'] if book['cover_url'] else DEFAULT_COVER_IMAGE_URL
+    # st.image() would read anything else as a path on the server
+    if not cover_url.startswith(("http://", "https://")) or cover_url in get_broken_cover_urls():
+        cover_url = DEFAULT_COVER_IMAGE_URL
+    
+    # Show the locally cached thumbnail instead when there is one
+    if local_cover_url(cover_url):
+        cover_url = cover_cache.thumbnail_path(cover_url)
     
     # Handle potential image loading issues
     try:
@@ -83,3 +96,111 @@ def format_book_card(book):
         # If there's an error loading an image, use the default image
         st.warning(f"Could not display book: {book['title']}. Using default image.")
         st.error(str(e))
+
+
+# Templates for the batched card grid, built once at import time. Template's
+# $-placeholders leave the CSS braces alone; every value is escaped first.
+BOOK_GRID_STYLE = """
+<style>
+.book-grid { display: grid; grid-template-columns: repeat(3, minmax(0, 1fr)); gap: 25px; margin-bottom: 25px; }
+@media (max-width: 900px) { .book-grid { grid-template-columns: repeat(2, minmax(0, 1fr)); } }
+@media (max-width: 600px) { .book-grid { grid-template-columns: minmax(0, 1fr); } }
+.book-card { padding: 18px; border-radius: 12px; border: 1px solid #e0e0e0; background-color: white;
+             box-shadow: 0 3px 10px rgba(0,0,0,0.08); height: 480px; overflow: hidden; }
+.book-card .cover { height: 150px; border-radius: 8px; background-size: cover; background-position: center; }
+.book-card h3 { margin-top: 15px; margin-bottom: 8px; font-size: 1.25rem; color: #873600;
+                height: 48px; overflow: hidden; text-overflow: ellipsis; font-weight: 600; }
+.book-card .author { margin-bottom: 12px; font-size: 1rem; color: #555; }
+.book-card .meta { display: flex; justify-content: space-between; margin-bottom: 10px; }
+.book-card .label { font-weight: 600; color: #444; }
+.book-card .value { color: #555; }
+.book-card .description { height: 130px; overflow: hidden; margin-top: 5px; border-top: 1px solid #eee; padding-top: 12px; }
+.book-card .description p { color: #555; font-size: 0.95rem; line-height: 1.4; margin-top: 5px; }
+.book-card .similar { font-size: 0.85rem; color: #666; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }
+</style>
+""".strip()
+
+# The default cover is layered under the book's own cover, so a broken
+# cover link falls back to it without any error handling in the page
+BOOK_CARD_TEMPLATE = Template("""
+<div class="book-card">
+    <div class="cover" style="background-image: url('$cover_url'), url('$default_cover_url');"></div>
+    <h3>$title</h3>
+    <p class="author"><strong>Author:</strong> $author</p>
+    <div class="meta">
+        <div><span class="label">Genre:</span> <span class="value">$genre</span></div>
+        <div><span class="label">Age Group:</span> <span class="value">$age_group</span></div>
+    </div>
+    <p><strong style="color: #444;">Rating:</strong> <span>$stars</span></p>
+    <div class="description">
+        <strong style="color: #444;">Description:</strong>
+        <p>$description</p>
+    </div>
+    <div class="similar">$similar</div>
+</div>
+""".strip())
+
+BOOK_GRID_TEMPLATE = Template("""$style<div class="book-grid">$cards</div>""")
+
+def _css_url(url):
+    """Make a URL safe to embed in a quoted CSS url() inside an HTML attribute"""
+    return html.escape(quote(url, safe=":/?&=%#+,;@~!$*"))
+
+def _cover_css_url(url, broken_covers=frozenset()):
+    """Pick the local thumbnail of a cover if cached, else its remote URL
+
+    Covers known to be broken go straight to the default cover.
+    """
+    if not url or not url.startswith(("http://", "https://")) or url in broken_covers:
+        url = DEFAULT_COVER_IMAGE_URL
+    return _css_url(local_cover_url(url) or url)
+
+# Precomputed similar books named at the bottom of each card
+SIMILAR_TITLES_PER_CARD = 3
+
+def book_card_html(book, broken_covers=frozenset(), similar_books=()):
+    """Build the HTML for one book card with every field escaped"""
+    popularity = min(max(book['popularity'] or 0, 1), 5)  # Ensure between 1-5
+    description = book['description'] or ""
+    if len(description) > 180:
+        description = description[:180] + "..."
+    
+    similar = ""
+    if similar_books:
+        titles = " · ".join(html.escape(other['title']) for other in similar_books[:SIMILAR_TITLES_PER_CARD])
+        similar = f"<strong style=\"color: #444;\">More like this:</strong> {titles}"
+    
+    return BOOK_CARD_TEMPLATE.substitute(
+        cover_url=_cover_css_url(book['cover_url'], broken_covers),
+        default_cover_url=_cover_css_url(DEFAULT_COVER_IMAGE_URL),
+        title=html.escape(book['title']),
+        author=html.escape(book['author']),
+        genre=html.escape(book['genre']),
+        age_group=html.escape(book['age_group']),
+        stars="⭐" * popularity,
+        description=html.escape(description),
+        similar=similar
+    )
+
+@timed
+def book_grid_html(books):
+    """Build the HTML for a whole page of book cards as one fragment"""
+    broken_covers = get_broken_cover_urls()
+    similar = get_similar_books(tuple(book['id'] for book in books))
+    return BOOK_GRID_TEMPLATE.substitute(
+        style=BOOK_GRID_STYLE,
+        cards="".join(book_card_html(book, broken_covers, similar[book['id']]) for book in books)
+    )
+
+def render_book_grid(books):
+    """Render a page of book cards in a responsive grid with a single element"""
+    st.markdown(book_grid_html(books), unsafe_allow_html=True)
+
+def format_visit_time(time_text):
+    """Format a 24-hour "HH:MM" time as "9:00 AM" """
+    hour, minute = (int(part) for part in time_text.split(":"))
+    return f"{hour % 12 or 12}:{minute:02d} {'AM' if hour < 12 else 'PM'}"
+
+def format_visit_slot(slot):
+    """Format a (start, end) visit slot as "9:00 AM - 11:00 AM" """
+    return " - ".join(format_visit_time(time_text) for time_text in slot)